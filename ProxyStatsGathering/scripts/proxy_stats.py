@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""
+Works out proxy coverage from exported snapshots, giving the same answer for each entry as the ProxyStatsGathering
+stream does without launching a task or scanning the index.
+
+Entries come from an NDJSON export of the index (hmac-search.py --export, optionally gzipped), and proxies from NDJSON
+ProxyLocation records (anything with fileId and proxyType fields).  Each entry gets the ProxyHealth that the stream
+would give its GroupedResult:
+
+    DotFile       IsDotFileBranch: the last path component starts with "."
+    GlacierClass  IsGlacierBranch: the storage class is GLACIER or DEEP_ARCHIVE
+    NotNeeded     MimeTypeWantProxyBranch/FileTypeWantProxyBranch want no proxy for it
+    Unproxied, Partial or Proxied
+                  GroupCounter: none, some or all of the wanted VIDEO/AUDIO/THUMBNAIL proxies exist
+
+As in MimeTypeBranch, the file extension is only used when the MIME type is missing, application/binary,
+application/octet-stream or binary/octet-stream.
+
+The data is held as NumPy columns.  The per-value decisions (what a MIME type or extension wants, whether a storage
+class is Glacier) are made once for each distinct value and then spread over the entries by index, so nothing loops
+over the entries in Python apart from parsing the JSON.  --save-columns keeps the parsed columns in a .npz file that
+can be given as --entries next time, which skips the parsing.  NumPy isn't otherwise needed by these scripts, so
+install it first with `pip install -r requirements.txt` from this directory.
+
+Three differences from the stream:
+ - the storage class is the one in the index, where the stream asks S3 for each object.  The stream also drops
+   entries whose S3 object can't be read, which can't be known from here.
+ - ONEZONE_IA, which is what S3 actually reports for one-zone IA, is counted as not Glacier.  IsGlacierBranch only
+   knows "OneZoneInfrequentAccess" and throws "Unrecognised storage class" on ONEZONE_IA, which fails the stream.
+ - the counts are the true counts.  GroupedResultCounter never adds up NotNeeded (its copy is discarded), so the
+   ProblemItemCount stored by the stream always has notNeededCount 0 and a grandTotal that is one short or less.
+"""
+
+import gzip
+import json
+import logging
+import re
+import sys
+from argparse import ArgumentParser
+from typing import Iterable, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# in the order of the ProxyHealth enumeration
+PROXY_HEALTH = ["Proxied", "Partial", "Unproxied", "NotNeeded", "DotFile", "GlacierClass"]
+PROXIED, PARTIAL, UNPROXIED, NOT_NEEDED, DOT_FILE, GLACIER_CLASS = range(len(PROXY_HEALTH))
+
+# the proxy types the stream checks for, in the order of the wanted/have columns
+PROXY_TYPES = ["VIDEO", "AUDIO", "THUMBNAIL"]
+WANT_VIDEO = (True, False, True)
+WANT_AUDIO = (False, True, True)
+WANT_THUMB = (False, False, True)
+WANT_NONE = (False, False, False)
+
+# from FileTypeWantProxyBranch
+VIDEO_EXTENSIONS = ["mpg", "mpe", "mp2", "mp4", "avi", "mov", "mxf", "mkv", "mts"]
+AUDIO_EXTENSIONS = ["mp3", "aif", "aiff", "wav"]
+THUMB_EXTENSIONS = ["cr2", "nef", "jpg", "tif", "tiff", "tga", "dxr"]
+
+# from IsGlacierBranch, which fails the stream on any other storage class (ONEZONE_IA included, see above).  "" is an
+# entry without one.
+GLACIER_CLASSES = ["GLACIER", "DEEP_ARCHIVE"]
+OTHER_CLASSES = ["", "STANDARD", "STANDARD_IA", "REDUCED_REDUNDANCY", "OneZoneInfrequentAccess", "ONEZONE_IA",
+                 "INTELLIGENT_TIERING"]
+
+ENTRY_COLUMNS = ["id", "bucket", "path", "extension", "mime_major", "mime_minor", "storage_class", "proxied"]
+
+
+class UnknownStorageClass(ValueError):
+    pass
+
+
+def file_extension(path:str) -> Union[str,None]:
+    """
+    ArchiveEntry.getFileExtension: whatever follows the last "." in the whole path, if anything does
+    """
+    tokens = re.split(r'\.(?=[^.]+$)', path)
+    return tokens[1] if len(tokens)==2 else None
+
+
+def read_ndjson(path:str) -> Iterable[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for line in f:
+            if line.strip()!="":
+                yield json.loads(line)
+
+
+def entry_columns(entries:Iterable[dict], collection:Union[str,None]=None) -> dict:
+    """
+    Reads entries into columns.  Missing strings become "", which the decisions below treat the same way as the stream
+    treats a missing value.
+    :param collection: only keep the entries in this collection
+    """
+    rows = {name: [] for name in ENTRY_COLUMNS}
+    for entry in entries:
+        if collection is not None and entry.get("bucket")!=collection:
+            continue
+        mime = entry.get("mimeType") or {}
+        extension = entry["file_extension"] if "file_extension" in entry else file_extension(entry["path"])
+        rows["id"].append(entry["id"])
+        rows["bucket"].append(entry.get("bucket") or "")
+        rows["path"].append(entry["path"])
+        rows["extension"].append(extension or "")
+        rows["mime_major"].append(mime.get("major") or "")
+        rows["mime_minor"].append(mime.get("minor") or "")
+        rows["storage_class"].append(entry.get("storageClass") or "")
+        rows["proxied"].append(bool(entry.get("proxied")))
+    columns = {name: np.array(values, dtype=str) for name, values in rows.items() if name!="proxied"}
+    columns["proxied"] = np.array(rows["proxied"], dtype=bool)
+    return columns
+
+
+def proxy_columns(proxies:Iterable[dict]) -> dict:
+    file_ids = []
+    types = []
+    for proxy in proxies:
+        file_ids.append(proxy["fileId"])
+        types.append(proxy["proxyType"])
+    return {"proxy_file_id": np.array(file_ids, dtype=str), "proxy_type": np.array(types, dtype=str)}
+
+
+def save_columns(path:str, columns:dict):
+    np.savez_compressed(path, **columns)
+
+
+def load_columns(path:str) -> dict:
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def select_collection(columns:dict, collection:str) -> dict:
+    keep = columns["bucket"]==collection
+    return dict(columns, **{name: columns[name][keep] for name in ENTRY_COLUMNS})
+
+
+def by_distinct_value(values:np.ndarray, decide, width:int) -> np.ndarray:
+    """
+    calls `decide` once for each distinct value and returns its answers laid out for every element of `values`
+    """
+    distinct, index = np.unique(values, return_inverse=True)
+    table = np.array([decide(v) for v in distinct], dtype=bool).reshape(len(distinct), width)
+    return table[index.reshape(-1)]
+
+
+def mime_wants(mime:str) -> tuple:
+    """
+    MimeTypeWantProxyBranch, for "major/minor"
+    """
+    major, minor = mime.split("/", 1)
+    if major=="video":
+        return WANT_VIDEO
+    if major=="audio":
+        return WANT_AUDIO
+    if major=="image":
+        return WANT_THUMB
+    if major=="model" and minor=="vnd.mts":    # MTS files get mis-identified as this
+        return WANT_VIDEO
+    return WANT_NONE
+
+
+def extension_wants(extension:str) -> tuple:
+    """
+    FileTypeWantProxyBranch
+    """
+    extension = extension.lower()
+    if extension in VIDEO_EXTENSIONS:
+        return WANT_VIDEO
+    if extension in AUDIO_EXTENSIONS:
+        return WANT_AUDIO
+    if extension in THUMB_EXTENSIONS:
+        return WANT_THUMB
+    return WANT_NONE
+
+
+def wanted_proxies(columns:dict) -> np.ndarray:
+    """
+    :return: a boolean array with a row per entry and a column for each of PROXY_TYPES
+    """
+    major = columns["mime_major"]
+    minor = columns["mime_minor"]
+    # MimeTypeBranch: these MIME types say nothing, so the extension is used instead
+    uninformative = ((major=="") |
+                     ((major=="application") & np.isin(minor, ["binary", "octet-stream"])) |
+                     ((major=="binary") & (minor=="octet-stream")))
+    by_mime = by_distinct_value(np.char.add(np.char.add(major, "/"), minor), mime_wants, len(PROXY_TYPES))
+    by_extension = by_distinct_value(columns["extension"], extension_wants, len(PROXY_TYPES))
+    return np.where(uninformative[:, None], by_extension, by_mime)
+
+
+def existing_proxies(columns:dict) -> np.ndarray:
+    """
+    :return: a boolean array with a row per entry and a column for each of PROXY_TYPES
+    """
+    have = np.zeros((len(columns["id"]), len(PROXY_TYPES)), dtype=bool)
+    for i, proxy_type in enumerate(PROXY_TYPES):
+        have[:, i] = np.isin(columns["id"], columns["proxy_file_id"][columns["proxy_type"]==proxy_type])
+    return have
+
+
+def is_glacier(columns:dict) -> np.ndarray:
+    classes = columns["storage_class"]
+    unknown = np.setdiff1d(np.unique(classes), GLACIER_CLASSES + OTHER_CLASSES)
+    if len(unknown)>0:
+        raise UnknownStorageClass("Unrecognised storage class {0}".format(", ".join(unknown)))
+    return np.isin(classes, GLACIER_CLASSES)
+
+
+def is_dot_file(columns:dict) -> np.ndarray:
+    # like path.split("/").last in Scala, which ignores trailing slashes
+    filenames = np.char.rpartition(np.char.rstrip(columns["path"], "/"), "/")[:, 2]
+    return np.char.startswith(filenames, ".")
+
+
+def classify(columns:dict) -> np.ndarray:
+    """
+    :return: the index into PROXY_HEALTH of each entry's result
+    """
+    wanted = wanted_proxies(columns)
+    wanted_count = wanted.sum(axis=1)
+    have_count = (wanted & existing_proxies(columns)).sum(axis=1)
+    return np.select([is_dot_file(columns), is_glacier(columns), wanted_count==0, have_count==0, have_count==wanted_count],
+                     [DOT_FILE, GLACIER_CLASS, NOT_NEEDED, UNPROXIED, PROXIED], PARTIAL).astype(np.int8)
+
+
+def count(results:np.ndarray) -> dict:
+    totals = np.bincount(results, minlength=len(PROXY_HEALTH))
+    return {name: int(totals[i]) for i, name in enumerate(PROXY_HEALTH)}
+
+
+def count_by_collection(buckets:np.ndarray, results:np.ndarray) -> dict:
+    names, index = np.unique(buckets, return_inverse=True)
+    totals = np.bincount(index.reshape(-1)*len(PROXY_HEALTH) + results, minlength=len(names)*len(PROXY_HEALTH))
+    totals = totals.reshape(len(names), len(PROXY_HEALTH))
+    return {str(name): {health: int(totals[i, j]) for j, health in enumerate(PROXY_HEALTH)} for i, name in enumerate(names)}
+
+
+def problem_item_count(counts:dict) -> dict:
+    """
+    the counts with the field names of ProblemItemCount
+    """
+    return {"proxiedCount": counts["Proxied"], "partialCount": counts["Partial"], "unProxiedCount": counts["Unproxied"],
+            "notNeededCount": counts["NotNeeded"], "dotFile": counts["DotFile"], "glacier": counts["GlacierClass"],
+            "grandTotal": sum(counts.values())}
+
+
+def grouped_results(columns:dict, results:np.ndarray) -> Iterable[dict]:
+    """
+    yields a GroupedResult for each entry, as the stream would produce
+    """
+    for file_id, es_record_says, result in zip(columns["id"], columns["proxied"], results):
+        yield {"fileId": str(file_id), "esRecordSays": bool(es_record_says), "result": PROXY_HEALTH[result]}
+
+
+def format_counts(counts:dict) -> str:
+    total = sum(counts.values())
+    return "\n".join("{0:<13} {1:>10} {2:>6.1%}".format(name, value, value/total if total else 0) for name, value in counts.items())
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Works out proxy coverage from exported entries and proxies")
+    parser.add_argument("--entries", dest="entries", required=True, help="NDJSON (or .ndjson.gz) export of the index, or a .npz saved with --save-columns")
+    parser.add_argument("--proxies", dest="proxies", help="NDJSON (or .ndjson.gz) of proxy locations. Not needed with a .npz")
+    parser.add_argument("-c", "--collection", dest="collection", help="only count the entries in this collection")
+    parser.add_argument("--by-collection", dest="by_collection", action="store_true", default=False, help="give the counts for each collection")
+    parser.add_argument("--save-columns", dest="save_columns", help="save the parsed entries and proxies to this .npz file to load quickly next time")
+    parser.add_argument("--grouped-results", dest="grouped_results", help="write each entry's GroupedResult to this NDJSON file")
+    parser.add_argument("--format", dest="format", choices=["text", "json"], default="text", help="output format")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.entries.endswith(".npz"):
+        columns = load_columns(args.entries)
+        if args.collection:
+            columns = select_collection(columns, args.collection)
+    else:
+        if not args.proxies:
+            print("You must give --proxies with an NDJSON export")
+            exit(1)
+        columns = entry_columns(read_ndjson(args.entries), args.collection)
+        columns.update(proxy_columns(read_ndjson(args.proxies)))
+    logger.info("{0} entries, {1} proxies".format(len(columns["id"]), len(columns["proxy_file_id"])))
+    if args.save_columns:
+        save_columns(args.save_columns, columns)
+
+    try:
+        results = classify(columns)
+    except UnknownStorageClass as e:
+        print(str(e))
+        exit(1)
+
+    if args.grouped_results:
+        with open(args.grouped_results, "w") as f:
+            for result in grouped_results(columns, results):
+                f.write(json.dumps(result) + "\n")
+
+    counts = count(results)
+    if args.format=="json":
+        output = problem_item_count(counts)
+        if args.by_collection:
+            output["collections"] = {name: problem_item_count(c) for name, c in count_by_collection(columns["bucket"], results).items()}
+        print(json.dumps(output, indent=2))
+    else:
+        if args.by_collection:
+            for name, collection_counts in count_by_collection(columns["bucket"], results).items():
+                print("{0}:\n{1}\n".format(name, format_counts(collection_counts)))
+        print(format_counts(counts))
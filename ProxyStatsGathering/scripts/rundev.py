@@ -1,14 +1,20 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import boto3
 import subprocess
 import os.path
+import hashlib
+import json
 import yaml
 import logging
 from optparse import OptionParser
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime
-from tzlocal import get_localzone
+
+try:
+    import instrumentation      # testscripts/instrumentation.py, if it is on the PYTHONPATH
+except ImportError:
+    instrumentation = None
 
 logging.basicConfig(level=logging.WARN)
 logger = logging.getLogger(__name__)
@@ -16,27 +22,112 @@ logger.level = logging.INFO
 
 
 class LogViewer(object):
-    def __init__(self, log_group_name, log_stream_name):
+    """
+    Tails one CloudWatch log stream, paging forward from where the last call left off so that events are only
+    downloaded once.  The poll interval shortens while the stream is busy and lengthens while it is idle.
+    """
+    MIN_INTERVAL = 2.0
+    MAX_INTERVAL = 30.0
+
+    def __init__(self, client, log_group_name, log_stream_name, label=None):
         super(LogViewer, self).__init__()
 
         self.log_group_name = log_group_name
         self.log_stream_name = log_stream_name
-        self.most_recent_timestamp=None
-        self._client = boto3.client('logs', region_name=options.region)
+        self.label = label
+        self.interval = self.MIN_INTERVAL
+        self.next_poll = 0
+        self._next_token = None
+        self._client = client
 
     def get_loglines(self):
-        results = self._client.get_log_events(logGroupName = self.log_stream_name, logStreamName = self.log_stream_name, startTime=self.most_recent_timestamp, startFromHead=True)
-
-        if len(results['events'])>0:
-            last_event = results['events'][-1]
-            self.most_recent_timestamp=last_event['timestamp']
+        """
+        returns a list of the formatted log lines written since the last call
+        """
+        args = {
+            "logGroupName": self.log_group_name,
+            "logStreamName": self.log_stream_name,
+            "startFromHead": True,
+        }
+        lines = []
+        while True:
+            if self._next_token:
+                args["nextToken"] = self._next_token
+            try:
+                results = self._client.get_log_events(**args)
+            except self._client.exceptions.ResourceNotFoundException:
+                break   #the stream is not created until the container starts
+            lines.extend(self._format(entry) for entry in results["events"])
+            #get_log_events returns the same token back when there is nothing more to read
+            at_end = results.get("nextForwardToken")==self._next_token or len(results["events"])==0
+            self._next_token = results.get("nextForwardToken", self._next_token)
+            if at_end:
+                break
 
-        return map(lambda entry: "{0}: {1}".format(datetime.from_timestamp(entry['timestamp']), entry['message']), results['events'])
+        if len(lines)>0:
+            self.interval = max(self.MIN_INTERVAL, self.interval/2)
+        else:
+            self.interval = min(self.MAX_INTERVAL, self.interval*1.5)
+        return lines
+
+    def _format(self, entry):
+        line = "{0}: {1}".format(datetime.fromtimestamp(entry['timestamp']/1000.0), entry['message'].rstrip("\n"))
+        if self.label:
+            return "[{0}] {1}".format(self.label, line)
+        return line
+
+
+class LogTailer(object):
+    """
+    Interleaves the logs of many tasks, polling each stream on its own adaptive schedule
+    """
+    def __init__(self, client, log_group_name, stream_prefix, output=print):
+        self.client = client
+        self.log_group_name = log_group_name
+        self.stream_prefix = stream_prefix
+        self.output = output
+        self.viewers = {}
+
+    def add(self, task):
+        task_id = task.task_arn.split("/")[-1]
+        self.viewers[task.task_arn] = LogViewer(self.client, self.log_group_name, "{0}/{1}".format(self.stream_prefix, task_id), task.label)
+
+    def remove(self, task):
+        """
+        outputs whatever is left in the task's log and stops following it
+        """
+        viewer = self.viewers.pop(task.task_arn, None)
+        if viewer:
+            self._show(viewer)
+
+    def _show(self, viewer):
+        try:
+            for line in viewer.get_loglines():
+                self.output(line)
+        except Exception as e:
+            logger.warning("Could not get logs for {0}: {1}".format(viewer.label, e))
+        viewer.next_poll = monotonic() + viewer.interval
+
+    def wait(self, duration):
+        """
+        polls the logs that are due for the next `duration` seconds
+        """
+        end_time = monotonic() + duration
+        while True:
+            now = monotonic()
+            for viewer in list(self.viewers.values()):
+                if viewer.next_poll<=now:
+                    self._show(viewer)
+            now = monotonic()
+            if now>=end_time:
+                return
+            next_due = min([v.next_poll for v in self.viewers.values()] + [end_time])
+            sleep(max(0.0, min(next_due, end_time) - now))
 
 
 def find_sbt_dir(starting_path):
     if starting_path=="" or starting_path=="/":
-        raise StandardError("Could not find a build.sbt file in any specified path")
+        raise RuntimeError("Could not find a build.sbt file in any specified path")
 
     logger.debug("at {0}".format(starting_path))
     if os.path.exists(os.path.join(starting_path, "build.sbt")):
@@ -49,27 +140,106 @@ def build_and_push(host, user, sbtdir):
     proc = subprocess.Popen(["sbt", "-Ddocker.host={0}".format(host), "-Ddocker.username={0}".format(user), "project proxyStatsGathering", "docker:publish"], cwd=sbtdir)
     proc.wait()
     if proc.returncode!=0:
-        raise StandardError("sbt dockerPublish failed")
+        raise RuntimeError("sbt dockerPublish failed")
+
+
+# everything that goes into the ProxyStatsGathering image, relative to the sbt directory
+FINGERPRINT_PATHS = ["ProxyStatsGathering/src", "common/src/main", "build.sbt", "project/plugins.sbt", "project/build.properties"]
+
+
+def source_fingerprint(sbtdir, extra=""):
+    """
+    returns a hash over the names and contents of all the files that the ProxyStatsGathering image is built from
+    :param sbtdir: directory containing build.sbt
+    :param extra: any other settings that should force a rebuild when they change, e.g. the docker host
+    """
+    digest = hashlib.sha256(extra.encode("UTF-8"))
+    for relpath in FINGERPRINT_PATHS:
+        fullpath = os.path.join(sbtdir, relpath)
+        if os.path.isfile(fullpath):
+            files = [fullpath]
+        else:
+            files = []
+            for dirpath, dirnames, filenames in os.walk(fullpath):
+                dirnames.sort()
+                files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+        for filepath in files:
+            digest.update(os.path.relpath(filepath, sbtdir).encode("UTF-8"))
+            digest.update(b"\0")
+            with open(filepath, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+class BuildCache(object):
+    """
+    remembers the source fingerprint and image of the last successful docker:publish, so it can be skipped when
+    nothing has changed
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def image_for(self, fingerprint):
+        content = self.load()
+        if content and content.get("fingerprint")==fingerprint:
+            return content.get("image")
+        return None
+
+    def record(self, fingerprint, image):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.path, "w") as f:
+            json.dump({"fingerprint": fingerprint, "image": image, "pushed_at": datetime.now().isoformat()}, f)
+
+
+def image_name(host, user):
+    #this mirrors the dockerAlias setting for proxyStatsGathering in build.sbt
+    parts = [p for p in [host, user, "proxy-stats-gathering"] if p]
+    return "/".join(parts) + ":DEV"
+
+
+def build_if_changed(host, user, sbtdir, cache, force=False, build=build_and_push):
+    """
+    runs the sbt build and push unless the sources are unchanged since the last successful push
+    :return: the image name
+    """
+    fingerprint = source_fingerprint(sbtdir, "{0}|{1}".format(host, user))
+    cached_image = cache.image_for(fingerprint)
+    if cached_image and not force:
+        logger.info("Sources are unchanged since {0} was pushed, skipping build. Use --force-build to rebuild.".format(cached_image))
+        return cached_image
+
+    build(host, user, sbtdir)
+    image = image_name(host, user)
+    cache.record(fingerprint, image)
+    return image
 
 
 def extract_cf_outputs(cfinfo):
     return dict(map(lambda entry: (entry["OutputKey"], entry["OutputValue"]), cfinfo["Outputs"]))
 
 
-def get_cloudformation_info(stackname):
-    client = boto3.client('cloudformation',  region_name=options.region)
+def get_cloudformation_info(stackname, region):
+    client = boto3.client('cloudformation',  region_name=region)
     result = client.describe_stacks(StackName=stackname)
 
     if len(result["Stacks"])==0:
-        raise StandardError("Could not find cloudformation stack {0}".format(stackname))
+        raise RuntimeError("Could not find cloudformation stack {0}".format(stackname))
 
     info = result["Stacks"][0]
     logger.info("Found stack {0} in status {1}".format(info["StackName"], info["StackStatus"]))
     return extract_cf_outputs(info)
 
 
-def run_task(cluster_id, task_arn, container_name, subnet_list, sg_list, allow_external_ip, collection_name, mode):
-    client = boto3.client('ecs', region_name=options.region)
+def run_task(client, cluster_id, task_arn, container_name, subnet_list, sg_list, allow_external_ip, collection_name, mode):
     network_config = {
         "awsvpcConfiguration": {
             "subnets": subnet_list,
@@ -102,9 +272,9 @@ def run_task(cluster_id, task_arn, container_name, subnet_list, sg_list, allow_e
     result = client.run_task(cluster=cluster_id, taskDefinition=task_arn, networkConfiguration=network_config, overrides=overrides, launchType="FARGATE")
 
     if len(result["failures"])>0:
-        for entry in result.failures:
-            logger.error("\t{0}: {1}".format(entry["arn"], entry["reason"]))
-        raise StandardError("Failed to start up container")
+        for entry in result["failures"]:
+            logger.error("\t{0}: {1}".format(entry.get("arn"), entry.get("reason")))
+        raise RuntimeError("Failed to start up container")
 
     logger.debug(result["tasks"][0])
     return {
@@ -114,67 +284,197 @@ def run_task(cluster_id, task_arn, container_name, subnet_list, sg_list, allow_e
     }
 
 
-def monitor_task(cluster_arn, task_arn): #, log_group_name, log_stream_name):
-    client = boto3.client('ecs', region_name=options.region)
-    while True:
+DESCRIBE_TASKS_BATCH = 100     #maximum number of tasks that describe_tasks accepts in one call
+
+
+class TaskInfo(object):
+    def __init__(self, collection, task_arn, cluster_arn):
+        self.collection = collection
+        self.task_arn = task_arn
+        self.cluster_arn = cluster_arn
+        self.last_status = None
+        self.started_at = None
+        self.stopped_at = None
+        self.exit_code = None
+        self.stopped_reason = None
+        self.finished = False
+
+    @property
+    def duration(self):
+        if self.started_at and self.stopped_at:
+            return self.stopped_at - self.started_at
+        return None
+
+    def update(self, info):
+        if self.last_status != info["lastStatus"]:
+            logger.info("{0}: task status is {1} (desired status {2})".format(self.label, info["lastStatus"], info["desiredStatus"]))
+        self.last_status = info["lastStatus"]
+        self.started_at = info.get("startedAt")
+        self.stopped_at = info.get("stoppedAt")
+        self.stopped_reason = info.get("stoppedReason")
+        containers = info.get("containers", [])
+        if len(containers)>0:
+            self.exit_code = containers[0].get("exitCode")
+        if info["lastStatus"]=="STOPPED":
+            self.finished = True
+            logger.info("{0}: ran from {1} to {2}, total of {3}".format(self.label, self.started_at, self.stopped_at, self.duration))
+
+    @property
+    def label(self):
+        return self.collection if self.collection else self.task_arn.split("/")[-1]
+
+
+def describe_tasks_batched(client, tasks):
+    """
+    Updates the given TaskInfo objects with describe_tasks calls of up to DESCRIBE_TASKS_BATCH tasks each
+    """
+    by_cluster = {}
+    for t in tasks:
+        by_cluster.setdefault(t.cluster_arn, []).append(t)
+
+    for cluster_arn, cluster_tasks in by_cluster.items():
+        for i in range(0, len(cluster_tasks), DESCRIBE_TASKS_BATCH):
+            batch = {t.task_arn: t for t in cluster_tasks[i:i+DESCRIBE_TASKS_BATCH]}
+            response = client.describe_tasks(cluster=cluster_arn, tasks=list(batch.keys()))
+            for info in response["tasks"]:
+                batch[info["taskArn"]].update(info)
+            for failure in response.get("failures", []):
+                if failure.get("arn") in batch:
+                    logger.error("{0}: could not describe task: {1}".format(batch[failure["arn"]].label, failure.get("reason")))
+                    batch[failure["arn"]].finished = True
+                    batch[failure["arn"]].stopped_reason = failure.get("reason")
+
+
+def run_fanout(client, collections, launch, max_concurrent, poll_interval=10, tailer=None):
+    """
+    Launches a task for each collection, keeping no more than `max_concurrent` running at once, and monitors them all
+    until they have finished.
+    :param client: boto3 ECS client
+    :param collections: list of collection names to launch tasks for. None runs a single task for all collections.
+    :param launch: function that takes a collection name and returns the dict from `run_task`
+    :param max_concurrent: maximum number of tasks to have running at once
+    :param poll_interval: seconds to wait between status checks
+    :param tailer: optional LogTailer to show the tasks' logs with
+    :return: list of TaskInfo, in launch order
+    """
+    waiting = list(collections)
+    running = []
+    all_tasks = []
+    while len(waiting)>0 or len(running)>0:
+        while len(waiting)>0 and len(running)<max_concurrent:
+            collection = waiting.pop(0)
+            try:
+                taskinfo = launch(collection)
+            except Exception as e:
+                logger.error("Could not launch task for {0}: {1}".format(collection, e))
+                failed = TaskInfo(collection, "(not started)", None)
+                failed.finished = True
+                failed.stopped_reason = str(e)
+                all_tasks.append(failed)
+                continue
+            logger.debug(str(taskinfo))
+            task = TaskInfo(collection, taskinfo["task_arn"], taskinfo["cluster_arn"])
+            logger.info("{0}: launched task {1}".format(task.label, task.task_arn))
+            running.append(task)
+            all_tasks.append(task)
+            if tailer:
+                tailer.add(task)
+
+        if len(running)==0:
+            break
+        if tailer:
+            tailer.wait(poll_interval)
+        else:
+            sleep(poll_interval)
         try:
-            response = client.describe_tasks(cluster=cluster_arn, tasks=[task_arn],)
-
-            info = response["tasks"][0]
-
-            if "startedAt" in info:
-                start_time = info["startedAt"]
-            else:
-                start_time = None
-
-            if "stoppedAt" in info:
-                finish_time = info["stoppedAt"]
-            else:
-                finish_time = None
-
-            logger.info("Task status is {0} (desired status {1})".format(info["lastStatus"], info["desiredStatus"]))
-            if start_time:
-                logger.info("Running since {0} ({1})".format(start_time, datetime.now(get_localzone())-start_time))
-
-            if finish_time:
-                logger.info("Ran from {0} to {1}, total of {2}".format(start_time, finish_time, finish_time-start_time))
-                break
-
-        except KeyError as e:
-            logger.error(str(e))
-            logger.debug(str(info))
-
-        sleep(10)
+            describe_tasks_batched(client, running)
+        except Exception as e:
+            logger.error("Could not get task status: {0}".format(e))
+        if tailer:
+            for t in running:
+                if t.finished:
+                    tailer.remove(t)
+        running = [t for t in running if not t.finished]
+        if len(running)>0:
+            logger.info("{0} tasks running, {1} waiting to start, {2} finished".format(len(running), len(waiting), len(all_tasks)-len(running)))
+
+    return all_tasks
+
+
+def format_summary(tasks):
+    lines = ["{0:<40} {1:<10} {2:>9} {3:>16}  {4}".format("Collection", "Status", "Exit code", "Duration", "Reason")]
+    for t in tasks:
+        lines.append("{0:<40} {1:<10} {2:>9} {3:>16}  {4}".format(
+            t.collection if t.collection else "(all)",
+            t.last_status if t.last_status else "-",
+            str(t.exit_code) if t.exit_code is not None else "-",
+            str(t.duration) if t.duration is not None else "-",
+            t.stopped_reason if t.stopped_reason else ""))
+    return "\n".join(lines)
+
+
+def read_collections(options):
+    collections = list(options.collection) if options.collection else []
+    if options.collections_file:
+        with open(options.collections_file, "r") as f:
+            collections.extend(line.strip() for line in f if line.strip()!="")
+    return collections
 
 
 ###START MAIN
-parser = OptionParser()
-parser.add_option("-c","--config", dest="configfile", help="Configuration YAML", default="ecs_rundev.yaml")
-parser.add_option("-r","--region", dest="region", help="AWS region", default="eu-west-1")
-parser.add_option("-s","--stackname", dest="stackname", help="Cloudformation stack that contains the deployed task")
-parser.add_option("-m","--mode", dest="mode", help="Run in stats-gathering or index fix mode. Specify either 'stats' or 'indexfix'", default="stats")
-parser.add_option("--collection", dest="collection", help="limit to this ArchiveHunter collection")
-(options, args) = parser.parse_args()
-
-with open(options.configfile,"r") as f:
-    config = yaml.load(f.read())
-
-sbt_dir = find_sbt_dir(os.path.dirname(os.path.realpath(__file__)))
-logger.info("Got SBT directory {0}".format(sbt_dir))
-
-if not "docker" in config:
-    raise StandardError("You must have a docker: section in the yaml config file")
-
-build_and_push(config["docker"].get("host"), config["docker"].get("user"), sbt_dir)
-
-cfinfo = get_cloudformation_info(options.stackname)
-logger.debug(str(cfinfo))
-if not "TaskDefinitionArn" in cfinfo:
-    raise StandardError("No TaskDefinitionArn output in {0}".format(options.stackname))
-logger.info("Got task ARN {0}".format(cfinfo["TaskDefinitionArn"]))
-
-taskinfo = run_task(config["ecs"].get("cluster"), cfinfo["TaskDefinitionArn"], cfinfo["AppContainerName"], config["ecs"].get("subnets"), config["ecs"].get("security_groups"), config["ecs"].get("external_ip"), options.collection, options.mode)
-
-logger.debug(str(taskinfo))
-
-monitor_task(taskinfo["cluster_arn"], taskinfo["task_arn"])
\ No newline at end of file
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c","--config", dest="configfile", help="Configuration YAML", default="ecs_rundev.yaml")
+    parser.add_option("-r","--region", dest="region", help="AWS region", default="eu-west-1")
+    parser.add_option("-s","--stackname", dest="stackname", help="Cloudformation stack that contains the deployed task")
+    parser.add_option("-m","--mode", dest="mode", help="Run in stats-gathering or index fix mode. Specify either 'stats' or 'indexfix'", default="stats")
+    parser.add_option("--collection", dest="collection", action="append", help="limit to this ArchiveHunter collection. Specify more than once to run a task for each collection.")
+    parser.add_option("--collections-file", dest="collections_file", help="run a task for each collection listed in this file, one per line")
+    parser.add_option("--max-concurrent", dest="max_concurrent", type="int", default=4, help="maximum number of tasks to run at once")
+    parser.add_option("--poll-interval", dest="poll_interval", type="int", default=10, help="seconds between task status checks")
+    parser.add_option("--no-logs", dest="no_logs", action="store_true", default=False, help="don't tail the tasks' CloudWatch logs")
+    parser.add_option("--force-build", dest="force_build", action="store_true", default=False, help="build and push the image even if the sources have not changed")
+    if instrumentation:
+        instrumentation.add_arguments(parser)
+    (options, args) = parser.parse_args()
+    if instrumentation and instrumentation.from_args(options):
+        # every client below comes from the default session, so this times describe_tasks and the rest
+        boto3.setup_default_session()
+        instrumentation.instrument_boto3(boto3.DEFAULT_SESSION)
+
+    with open(options.configfile,"r") as f:
+        config = yaml.safe_load(f.read())
+
+    sbt_dir = find_sbt_dir(os.path.dirname(os.path.realpath(__file__)))
+    logger.info("Got SBT directory {0}".format(sbt_dir))
+
+    if not "docker" in config:
+        raise RuntimeError("You must have a docker: section in the yaml config file")
+
+    cache = BuildCache(os.path.join(sbt_dir, "ProxyStatsGathering", "target", "rundev-build-cache.json"))
+    image = build_if_changed(config["docker"].get("host"), config["docker"].get("user"), sbt_dir, cache, options.force_build)
+    logger.info("Using image {0}".format(image))
+
+    cfinfo = get_cloudformation_info(options.stackname, options.region)
+    logger.debug(str(cfinfo))
+    if not "TaskDefinitionArn" in cfinfo:
+        raise RuntimeError("No TaskDefinitionArn output in {0}".format(options.stackname))
+    logger.info("Got task ARN {0}".format(cfinfo["TaskDefinitionArn"]))
+
+    ecs_client = boto3.client('ecs', region_name=options.region)
+    collections = read_collections(options)
+
+    def launch(collection_name):
+        return run_task(ecs_client, config["ecs"].get("cluster"), cfinfo["TaskDefinitionArn"], cfinfo["AppContainerName"], config["ecs"].get("subnets"),
+                        config["ecs"].get("security_groups"), config["ecs"].get("external_ip"), collection_name, options.mode)
+
+    tailer = None
+    if not options.no_logs:
+        if "LogGroupName" in cfinfo:
+            # the task definition uses the awslogs driver with stream prefix "ecs", which names streams prefix/container/task-id
+            tailer = LogTailer(boto3.client('logs', region_name=options.region), cfinfo["LogGroupName"], "ecs/{0}".format(cfinfo["AppContainerName"]))
+        else:
+            logger.warning("No LogGroupName output in {0}, not showing task logs".format(options.stackname))
+
+    tasks = run_fanout(ecs_client, collections if len(collections)>0 else [None], launch, options.max_concurrent, options.poll_interval, tailer)
+    print(format_summary(tasks))
@@ -0,0 +1,137 @@
+import json
+import os
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import proxy_stats
+from proxy_stats import (PROXY_HEALTH, UnknownStorageClass, classify, count, count_by_collection, entry_columns,
+                         grouped_results, load_columns, proxy_columns, read_ndjson, save_columns, select_collection)
+
+#the same fixtures are run through the stream stages in src/test/scala/StreamComponents/ProxyHealthStagesSpec.scala,
+#so if you change one then change the other
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture_columns():
+    columns = entry_columns(read_ndjson(os.path.join(FIXTURES, "entries.ndjson")))
+    columns.update(proxy_columns(read_ndjson(os.path.join(FIXTURES, "proxies.ndjson"))))
+    return columns
+
+
+def reference_result(entry:dict, proxies:set) -> str:
+    """
+    the stream's stages applied one entry at a time, written as closely to the Scala as possible
+    """
+    filename = entry["path"].rstrip("/").split("/")[-1]
+    if filename.startswith("."):
+        return "DotFile"
+    if entry.get("storageClass") in ("GLACIER", "DEEP_ARCHIVE"):
+        return "GlacierClass"
+
+    mime = entry.get("mimeType")
+    if mime is None or (mime["major"]=="application" and mime["minor"] in ("binary", "octet-stream")) or \
+            (mime["major"]=="binary" and mime["minor"]=="octet-stream"):
+        xtn = entry.get("file_extension")
+        xtn = xtn.lower() if xtn else None
+        if xtn in proxy_stats.VIDEO_EXTENSIONS:
+            wanted = ["VIDEO", "THUMBNAIL"]
+        elif xtn in proxy_stats.AUDIO_EXTENSIONS:
+            wanted = ["AUDIO", "THUMBNAIL"]
+        elif xtn in proxy_stats.THUMB_EXTENSIONS:
+            wanted = ["THUMBNAIL"]
+        else:
+            wanted = []
+    elif mime["major"]=="video" or (mime["major"]=="model" and mime["minor"]=="vnd.mts"):
+        wanted = ["VIDEO", "THUMBNAIL"]
+    elif mime["major"]=="audio":
+        wanted = ["AUDIO", "THUMBNAIL"]
+    elif mime["major"]=="image":
+        wanted = ["THUMBNAIL"]
+    else:
+        wanted = []
+
+    if len(wanted)==0:
+        return "NotNeeded"
+    have = [t for t in wanted if (entry["id"], t) in proxies]
+    if len(have)==0:
+        return "Unproxied"
+    return "Proxied" if len(have)==len(wanted) else "Partial"
+
+
+def test_matches_the_streams_grouped_results():
+    columns = fixture_columns()
+    expected = list(read_ndjson(os.path.join(FIXTURES, "grouped_results.ndjson")))
+    assert list(grouped_results(columns, classify(columns))) == expected
+    assert count(classify(columns)) == {"Proxied": 6, "Partial": 3, "Unproxied": 7, "NotNeeded": 6, "DotFile": 3, "GlacierClass": 2}
+
+
+def test_matches_the_reference_on_random_entries():
+    rng = random.Random(1)
+    mimes = [None, ("video", "mp4"), ("video", "quicktime"), ("audio", "wav"), ("image", "jpeg"), ("model", "vnd.mts"),
+             ("model", "iges"), ("application", "octet-stream"), ("application", "binary"), ("binary", "octet-stream"),
+             ("application", "pdf"), ("text", "plain")]
+    extensions = [None, "mp4", "MOV", "mxf", "wav", "AIFF", "jpg", "CR2", "tif", "pdf", "bin", "txt"]
+    classes = ["STANDARD", "STANDARD_IA", "GLACIER", "REDUCED_REDUNDANCY", None]
+    entries = []
+    proxies = []
+    for i in range(20000):
+        extension = rng.choice(extensions)
+        mime = rng.choice(mimes)
+        entries.append({
+            "id": "entry{0}".format(i),
+            "bucket": rng.choice(["bucket-a", "bucket-b", "bucket-c"]),
+            "path": "{0}/{1}file{2}{3}".format(rng.choice(["media", "archive/old"]), rng.choice(["", "", "", "."]), i,
+                                                "." + extension if extension else ""),
+            "file_extension": extension,
+            "mimeType": {"major": mime[0], "minor": mime[1]} if mime else None,
+            "storageClass": rng.choice(classes),
+            "proxied": rng.random()<0.5,
+        })
+        for proxy_type in proxy_stats.PROXY_TYPES:
+            if rng.random()<0.6:
+                proxies.append({"fileId": "entry{0}".format(i), "proxyType": proxy_type})
+
+    columns = entry_columns(entries)
+    columns.update(proxy_columns(proxies))
+    results = classify(columns)
+    proxy_set = {(p["fileId"], p["proxyType"]) for p in proxies}
+    expected = [reference_result(e, proxy_set) for e in entries]
+    assert [PROXY_HEALTH[r] for r in results] == expected
+
+    by_collection = count_by_collection(columns["bucket"], results)
+    for bucket in ["bucket-a", "bucket-b", "bucket-c"]:
+        expected_counts = {name: 0 for name in PROXY_HEALTH}
+        for entry, result in zip(entries, expected):
+            if entry["bucket"]==bucket:
+                expected_counts[result] += 1
+        assert by_collection[bucket] == expected_counts
+
+
+def test_saved_columns_give_the_same_results(tmpdir):
+    columns = fixture_columns()
+    path = str(tmpdir.join("snapshot.npz"))
+    save_columns(path, columns)
+    loaded = load_columns(path)
+    assert list(classify(loaded)) == list(classify(columns))
+
+    one_collection = select_collection(loaded, "other-bucket")
+    assert list(grouped_results(one_collection, classify(one_collection))) == [
+        {"fileId": "other-bucket-video", "esRecordSays": False, "result": "Unproxied"}]
+    assert len(entry_columns(read_ndjson(os.path.join(FIXTURES, "entries.ndjson")), "other-bucket")["id"]) == 1
+
+
+def test_unknown_storage_class_is_an_error():
+    columns = entry_columns([{"id": "x", "bucket": "b", "path": "a.mp4", "storageClass": "OUTER_SPACE"}])
+    columns.update(proxy_columns([]))
+    with pytest.raises(UnknownStorageClass):
+        classify(columns)
+
+
+def test_file_extension_is_worked_out_like_the_server():
+    assert proxy_stats.file_extension("media/clip.MXF") == "MXF"
+    assert proxy_stats.file_extension("media/v1.mov/README") == "mov/README"
+    assert proxy_stats.file_extension("media/README") is None
+    assert proxy_stats.file_extension("media/.hidden") == "hidden"
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("yaml")
+
+import rundev
+
+
+class StubECSClient(object):
+    """
+    pretends to run tasks: each task reports RUNNING for `runtime` polls and then STOPPED
+    """
+    def __init__(self, runtime=2, fail_collections=()):
+        self.runtime = runtime
+        self.fail_collections = fail_collections
+        self.polls = {}
+        self.collections = {}
+        self.describe_calls = []
+        self.max_running = 0
+        self.started = datetime(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+    def run_task(self, cluster, taskDefinition, networkConfiguration, overrides, launchType):
+        env = {e["name"]: e["value"] for e in overrides["containerOverrides"][0]["environment"]}
+        if env.get("FOR_COLLECTION") in self.fail_collections:
+            return {"tasks": [], "failures": [{"arn": None, "reason": "RESOURCE:MEMORY"}]}
+        arn = "arn:aws:ecs:eu-west-1:000000000000:task/cluster/{0}".format(len(self.polls))
+        self.polls[arn] = 0
+        self.collections[arn] = env.get("FOR_COLLECTION")
+        running = len([a for a, p in self.polls.items() if p < self.runtime])
+        self.max_running = max(self.max_running, running)
+        return {"failures": [], "tasks": [{"taskArn": arn, "clusterArn": cluster, "containers": [{"containerArn": arn + "/container"}]}]}
+
+    def describe_tasks(self, cluster, tasks):
+        assert len(tasks) <= 100
+        self.describe_calls.append(list(tasks))
+        result = []
+        for arn in tasks:
+            self.polls[arn] += 1
+            info = {"taskArn": arn, "lastStatus": "RUNNING", "desiredStatus": "RUNNING", "startedAt": self.started, "containers": [{}]}
+            if self.polls[arn] >= self.runtime:
+                info.update({"lastStatus": "STOPPED", "desiredStatus": "STOPPED", "stoppedAt": self.started + timedelta(minutes=self.polls[arn]),
+                             "stoppedReason": "Essential container in task exited", "containers": [{"exitCode": 0}]})
+            result.append(info)
+        return {"tasks": result, "failures": []}
+
+
+def launcher(client):
+    return lambda collection: rundev.run_task(client, "cluster", "taskdef", "container", ["subnet"], ["sg"], False, collection, "stats")
+
+
+def test_run_fanout_limits_concurrency(monkeypatch):
+    monkeypatch.setattr(rundev, "sleep", lambda s: None)
+    client = StubECSClient(runtime=3)
+    collections = ["collection-{0}".format(i) for i in range(10)]
+
+    tasks = rundev.run_fanout(client, collections, launcher(client), max_concurrent=3)
+
+    assert [t.collection for t in tasks] == collections
+    assert sorted(client.collections.values()) == sorted(collections)
+    assert client.max_running <= 3
+    assert all(t.last_status == "STOPPED" and t.exit_code == 0 for t in tasks)
+    assert tasks[0].duration == timedelta(minutes=3)
+
+
+def test_describe_tasks_is_batched(monkeypatch):
+    monkeypatch.setattr(rundev, "sleep", lambda s: None)
+    client = StubECSClient(runtime=1)
+    tasks = rundev.run_fanout(client, ["c{0}".format(i) for i in range(250)], launcher(client), max_concurrent=250)
+
+    assert len(tasks) == 250
+    assert [len(call) for call in client.describe_calls] == [100, 100, 50]
+
+
+def test_launch_failures_are_reported(monkeypatch):
+    monkeypatch.setattr(rundev, "sleep", lambda s: None)
+    client = StubECSClient(runtime=1, fail_collections=["broken"])
+    tasks = rundev.run_fanout(client, ["ok", "broken"], launcher(client), max_concurrent=2)
+
+    assert [t.collection for t in tasks] == ["ok", "broken"]
+    assert tasks[1].last_status is None
+    assert "Failed to start up container" in tasks[1].stopped_reason
+    summary = rundev.format_summary(tasks)
+    assert "broken" in summary and "0:01:00" in summary
+
+
+class StubLogsClient(object):
+    """
+    serves log events for streams that grow over time, paging `page_size` events at a time
+    """
+    class exceptions(object):
+        class ResourceNotFoundException(Exception):
+            pass
+
+    def __init__(self, page_size=3):
+        self.streams = {}
+        self.page_size = page_size
+        self.calls = []
+
+    def write(self, stream, *messages):
+        events = self.streams.setdefault(stream, [])
+        for m in messages:
+            events.append({"timestamp": 1700000000000 + len(events)*1000, "message": m})
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, nextToken=None):
+        self.calls.append((logStreamName, nextToken))
+        if logStreamName not in self.streams:
+            raise self.exceptions.ResourceNotFoundException()
+        position = int(nextToken.split("/")[1]) if nextToken else 0
+        events = self.streams[logStreamName][position:position+self.page_size]
+        return {"events": events, "nextForwardToken": "f/{0}".format(position + len(events))}
+
+
+def test_log_viewer_pages_forward_without_duplicates():
+    client = StubLogsClient(page_size=3)
+    viewer = rundev.LogViewer(client, "group", "ecs/app/task1", "coll")
+    assert viewer.get_loglines() == []
+    idle_interval = viewer.interval
+
+    client.write("ecs/app/task1", "one", "two", "three", "four")
+    lines = viewer.get_loglines()
+    assert [l.split(": ", 1)[1] for l in lines] == ["one", "two", "three", "four"]
+    assert lines[0].startswith("[coll] ")
+    assert viewer.interval < idle_interval
+
+    assert viewer.get_loglines() == []
+    client.write("ecs/app/task1", "five")
+    assert [l.split(": ", 1)[1] for l in viewer.get_loglines()] == ["five"]
+    assert all(token is None or int(token.split("/")[1]) <= 5 for _, token in client.calls)
+
+
+def test_fanout_tails_logs(monkeypatch):
+    monkeypatch.setattr(rundev, "sleep", lambda s: None)
+    clock = [0.0]
+    monkeypatch.setattr(rundev, "monotonic", lambda: clock[0])
+    real_wait = rundev.LogTailer.wait
+
+    ecs = StubECSClient(runtime=2)
+    logs = StubLogsClient()
+    output = []
+    tailer = rundev.LogTailer(logs, "group", "ecs/app", output.append)
+
+    def wait(self, duration):
+        for arn in list(self.viewers):
+            logs.write("ecs/app/" + arn.split("/")[-1], "tick {0}".format(clock[0]))
+        clock[0] += duration
+        real_wait(self, 0)
+    monkeypatch.setattr(rundev.LogTailer, "wait", wait)
+
+    rundev.run_fanout(ecs, ["a", "b", "c"], launcher(ecs), max_concurrent=2, tailer=tailer)
+    assert len([l for l in output if l.startswith("[a]")]) == 2
+    assert len([l for l in output if l.startswith("[c]")]) == 2
+    assert tailer.viewers == {}
+
+
+@pytest.fixture
+def sbt_tree(tmp_path):
+    (tmp_path / "ProxyStatsGathering" / "src" / "main" / "scala").mkdir(parents=True)
+    (tmp_path / "common" / "src" / "main" / "scala").mkdir(parents=True)
+    (tmp_path / "project").mkdir()
+    (tmp_path / "build.sbt").write_text("lazy val root = project")
+    (tmp_path / "ProxyStatsGathering" / "src" / "main" / "scala" / "Main.scala").write_text("object Main")
+    (tmp_path / "common" / "src" / "main" / "scala" / "Common.scala").write_text("object Common")
+    return tmp_path
+
+
+def test_build_if_changed_skips_unchanged_sources(sbt_tree):
+    builds = []
+    cache = rundev.BuildCache(str(sbt_tree / "ProxyStatsGathering" / "target" / "cache.json"))
+    build = lambda host, user, sbtdir: builds.append(sbtdir)
+
+    assert rundev.build_if_changed("registry", "me", str(sbt_tree), cache, build=build) == "registry/me/proxy-stats-gathering:DEV"
+    assert len(builds) == 1
+    rundev.build_if_changed("registry", "me", str(sbt_tree), cache, build=build)
+    assert len(builds) == 1
+
+    (sbt_tree / "common" / "src" / "main" / "scala" / "Common.scala").write_text("object Common { val x = 1 }")
+    rundev.build_if_changed("registry", "me", str(sbt_tree), cache, build=build)
+    assert len(builds) == 2
+
+    rundev.build_if_changed("other-registry", "me", str(sbt_tree), cache, build=build)
+    assert len(builds) == 3
+
+    rundev.build_if_changed("other-registry", "me", str(sbt_tree), cache, force=True, build=build)
+    assert len(builds) == 4
+
+
+def test_failed_build_is_not_cached(sbt_tree):
+    cache = rundev.BuildCache(str(sbt_tree / "cache.json"))
+
+    def failing_build(host, user, sbtdir):
+        raise RuntimeError("sbt dockerPublish failed")
+
+    with pytest.raises(RuntimeError):
+        rundev.build_if_changed("registry", "me", str(sbt_tree), cache, build=failing_build)
+    assert cache.load() is None
+
+
+def test_fingerprint_ignores_unrelated_files(sbt_tree):
+    before = rundev.source_fingerprint(str(sbt_tree))
+    (sbt_tree / "README.md").write_text("docs")
+    (sbt_tree / "ProxyStatsGathering" / "target").mkdir()
+    (sbt_tree / "ProxyStatsGathering" / "target" / "out.jar").write_text("binary")
+    assert rundev.source_fingerprint(str(sbt_tree)) == before
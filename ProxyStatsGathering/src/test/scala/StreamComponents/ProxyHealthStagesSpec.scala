@@ -0,0 +1,140 @@
+package StreamComponents
+
+import java.io.File
+import java.time.ZonedDateTime
+
+import akka.actor.ActorSystem
+import akka.stream.{ClosedShape, Materializer}
+import akka.stream.scaladsl.{Flow, GraphDSL, Merge, Partition, RunnableGraph, Sink, Source}
+import com.theguardian.multimedia.archivehunter.common.{ArchiveEntry, MimeType, ProxyType, StorageClass}
+import com.theguardian.multimedia.archivehunter.common.cmn_models.{ProxyHealth, ProxyVerifyResult}
+import io.circe.HCursor
+import io.circe.parser.parse
+import models.GroupedResult
+import org.specs2.mutable.Specification
+
+import scala.concurrent.duration._
+import scala.concurrent.Await
+
+/**
+  * runs the fixtures of the python analyzer through the stream stages.  The same fixtures are checked against
+  * ProxyStatsGathering/scripts/proxy_stats.py in scripts/tests/test_proxy_stats.py, so if you change one then change the other.
+  *
+  * IsGlacierBranch and VerifyProxy talk to S3 and DynamoDB, so they are stood in for by a Partition on the storage class
+  * in the fixture and a lookup in proxies.ndjson.  Everything else is wired up as in MainContent.buildGraphModel.
+  */
+class ProxyHealthStagesSpec extends Specification {
+  sequential
+
+  val fixturesDir = Seq(new File("ProxyStatsGathering/scripts/tests/fixtures"), new File("scripts/tests/fixtures"))
+    .find(_.isDirectory)
+    .getOrElse(throw new RuntimeException("Could not find the ProxyStatsGathering fixtures"))
+
+  def readNdjson(name:String):Seq[HCursor] = {
+    val src = scala.io.Source.fromFile(new File(fixturesDir, name), "UTF-8")
+    try {
+      src.getLines().filter(_.trim.nonEmpty).map(line=>parse(line) match {
+        case Right(json)=>json.hcursor
+        case Left(err)=>throw new RuntimeException(s"Could not parse $name: $err")
+      }).toList
+    } finally {
+      src.close()
+    }
+  }
+
+  /**
+    * builds an ArchiveEntry the way the index would return it, along with the storage class that S3 would report
+    */
+  def toEntry(c:HCursor):(ArchiveEntry, Option[String]) = {
+    val path = c.get[String]("path").toTry.get
+    val mimeType = c.downField("mimeType").success.flatMap(m=>
+      (m.get[String]("major"), m.get[String]("minor")) match {
+        case (Right(major), Right(minor))=>Some(MimeType(major, minor))
+        case _=>None
+      }).orNull
+    //an explicit file_extension, even a null one, is used as it is.  Otherwise it comes from the path, as at ingest
+    val fileExtension = c.downField("file_extension").success match {
+      case Some(xtn)=>xtn.as[Option[String]].toTry.get
+      case None=>ArchiveEntry.getFileExtension(path)
+    }
+    val entry = ArchiveEntry(c.get[String]("id").toTry.get, c.get[String]("bucket").toTry.get, path, None, None, fileExtension,
+      c.get[Long]("size").toTry.get, ZonedDateTime.parse(c.get[String]("last_modified").toTry.get), "", mimeType,
+      c.get[Boolean]("proxied").toTry.get, StorageClass.STANDARD, Seq(), false, None)
+    (entry, c.get[Option[String]]("storageClass").toTry.get)
+  }
+
+  "the proxy health stages" should {
+    "give the results in grouped_results.ndjson for the fixture entries" in {
+      implicit val system:ActorSystem = ActorSystem("ProxyHealthStagesSpec")
+      implicit val mat:Materializer = Materializer.matFromSystem
+
+      try {
+        val entriesWithClass = readNdjson("entries.ndjson").map(toEntry)
+        val glacierIds = entriesWithClass.collect({
+          case (entry, Some(storageClass)) if storageClass=="GLACIER" || storageClass=="DEEP_ARCHIVE"=>entry.id
+        }).toSet
+        val proxies = readNdjson("proxies.ndjson").map(c=>(c.get[String]("fileId").toTry.get, ProxyType.withName(c.get[String]("proxyType").toTry.get))).toSet
+
+        def verifyProxy(proxyType:ProxyType.Value) =
+          Flow[ProxyVerifyResult].map(result=>result.copy(haveProxy = Some(proxies.contains((result.fileId, proxyType)))))
+
+        val graph = RunnableGraph.fromGraph(GraphDSL.create(Sink.seq[GroupedResult]) { implicit builder => sink =>
+          import GraphDSL.Implicits._
+
+          val src = builder.add(Source(entriesWithClass.map(_._1).toList))
+          val mtb = builder.add(new MimeTypeBranch)
+          val mtwpb = builder.add(new MimeTypeWantProxyBranch)
+          val ftwpb = builder.add(new FileTypeWantProxyBranch)
+          val isDotFileBranch = builder.add(new IsDotFileBranch)
+          val isGlacierBranch = builder.add(Partition[ArchiveEntry](2, entry=>if(glacierIds.contains(entry.id)) 0 else 1))
+          val preVideoMerge = builder.add(new Merge[ProxyVerifyResult](2, false))
+          val preAudioMerge = builder.add(new Merge[ProxyVerifyResult](2, false))
+          val preThumbMerge = builder.add(new Merge[ProxyVerifyResult](2, false))
+          val postVerifyMerge = builder.add(new Merge[ProxyVerifyResult](3, false))
+          val proxyResultGroup = builder.add(new ProxyResultGroup)
+          val groupCounter = builder.add(new GroupCounter)
+          val preCounterMerge = builder.add(new Merge[GroupedResult](5, false))
+
+          src ~> isDotFileBranch
+          isDotFileBranch.out(0).map(entry=>GroupedResult(entry.id, entry.proxied, ProxyHealth.DotFile)) ~> preCounterMerge
+          isDotFileBranch.out(1) ~> isGlacierBranch
+
+          isGlacierBranch.out(0).map(entry=>GroupedResult(entry.id, entry.proxied, ProxyHealth.GlacierClass)) ~> preCounterMerge
+          isGlacierBranch.out(1) ~> mtb
+
+          mtb.out(0) ~> mtwpb.in
+          mtb.out(1) ~> ftwpb.in
+
+          mtwpb.out(0) ~> preVideoMerge
+          ftwpb.out(0) ~> preVideoMerge
+          mtwpb.out(1) ~> preAudioMerge
+          ftwpb.out(1) ~> preAudioMerge
+          mtwpb.out(2) ~> preThumbMerge
+          ftwpb.out(2) ~> preThumbMerge
+
+          preVideoMerge ~> verifyProxy(ProxyType.VIDEO) ~> postVerifyMerge.in(0)
+          preAudioMerge ~> verifyProxy(ProxyType.AUDIO) ~> postVerifyMerge.in(1)
+          preThumbMerge ~> verifyProxy(ProxyType.THUMBNAIL) ~> postVerifyMerge.in(2)
+
+          postVerifyMerge ~> proxyResultGroup ~> groupCounter ~> preCounterMerge
+
+          mtwpb.out(3).map(verifyResult=>GroupedResult(verifyResult.fileId, verifyResult.esRecordSays, ProxyHealth.NotNeeded)) ~> preCounterMerge
+          ftwpb.out(3).map(verifyResult=>GroupedResult(verifyResult.fileId, verifyResult.esRecordSays, ProxyHealth.NotNeeded)) ~> preCounterMerge
+
+          preCounterMerge ~> sink
+          ClosedShape
+        })
+
+        val result:Seq[GroupedResult] = Await.result(graph.run(), 10.seconds)
+
+        val expected = readNdjson("grouped_results.ndjson").map(c=>GroupedResult(c.get[String]("fileId").toTry.get,
+          c.get[Boolean]("esRecordSays").toTry.get, ProxyHealth.withName(c.get[String]("result").toTry.get)))
+
+        result.length mustEqual entriesWithClass.length
+        result.sortBy(_.fileId) mustEqual expected.sortBy(_.fileId)
+      } finally {
+        Await.ready(system.terminate(), 10.seconds)
+      }
+    }
+  }
+}
@@ -0,0 +1,30 @@
+package com.theguardian.multimedia.archivehunter
+import com.theguardian.multimedia.archivehunter.common.DocId
+import org.specs2.mutable.Specification
+
+/**
+  * the same golden values are checked against the python implementation in testscripts/tests/test_archive_ids.py,
+  * so if you change one then change the other
+  */
+class DocIdSpec extends Specification with DocId {
+  "makeDocId" should {
+    "base64 encode short paths" in {
+      makeDocId("test-bucket","test/path/to/file.ext") mustEqual "dGVzdC1idWNrZXQ6dGVzdC9wYXRoL3RvL2ZpbGUuZXh0"
+    }
+
+    "keep only the low byte of each character" in {
+      makeDocId("bucket","café/naïve.mov") mustEqual "YnVja2V0OmNhZukvbmHvdmUubW92"
+      makeDocId("bucket","映像/素材.mp4") mustEqual "YnVja2V0OiDPLyBQLm1wNA=="
+      makeDocId("bucket","clip🎬.mov") mustEqual "YnVja2V0OmNsaXA8rC5tb3Y="
+    }
+
+    "chop the middle out of long paths" in {
+      makeDocId("archive-bucket","long/" + ("0123456789" * 38) + ".mxf") mustEqual "YXJjaGl2ZS1idWNrZXQ6bG9uZy8wMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OS5teGY="
+      makeDocId("b","z" * 388) mustEqual "Yjp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enpp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp"
+    }
+
+    "fail for paths that are too long to shorten" in {
+      makeDocId("b","y" * 580) must throwA[StringIndexOutOfBoundsException]
+    }
+  }
+}
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Generates ArchiveHunter document IDs exactly as the server does, see
+common/src/main/scala/com/theguardian/multimedia/archivehunter/common/DocId.scala:
+
+    val initialString = bucket + ":" + key
+    val initialEncoded = encoder.encodeToString(initialString.toCharArray.map(_.toByte))
+    if(initialEncoded.length<=maxIdLength){
+      initialEncoded
+    } else {
+      val chunkLength = initialEncoded.length/3
+      val stringParts = initialEncoded.grouped(chunkLength).toList
+      val midSectionLength = maxIdLength - chunkLength*2
+      stringParts.head + stringParts(1).substring(0, midSectionLength) + stringParts(2)
+    }
+
+Note that the server does not UTF-8 encode the path; `toByte` keeps the low byte of each UTF-16 code unit. The middle
+section is cut out of the *encoded* string, and any remainder past three whole chunks is dropped.
+
+Run this file directly with --benchmark to measure throughput.
+"""
+
+import base64
+import binascii
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Iterable, Union
+
+MAX_ID_LENGTH = 512
+# once the encoded string is this long, chunkLength*2 is greater than MAX_ID_LENGTH and the server's substring() throws,
+# so no ID can be generated
+UNENCODABLE_LENGTH = (MAX_ID_LENGTH//2 + 1)*3
+
+
+def server_bytes(s:str) -> bytes:
+    """
+    Equivalent of the server's `toCharArray.map(_.toByte)`
+    """
+    try:
+        return s.encode("latin-1")      #identical for every char below 256, and much the most common case
+    except UnicodeEncodeError:
+        return s.encode("utf-16-le")[::2]
+
+
+def shorten(encoded:str) -> Union[str,None]:
+    """
+    Applies the server's shortening to an encoded ID that is longer than MAX_ID_LENGTH.
+    Returns None if the server would not be able to generate an ID for it.
+    """
+    encoded_length = len(encoded)
+    if encoded_length<=MAX_ID_LENGTH:
+        return encoded
+    if encoded_length>=UNENCODABLE_LENGTH:
+        return None
+    chunk_length = encoded_length//3
+    mid_section_length = MAX_ID_LENGTH - chunk_length*2
+    return encoded[0:chunk_length] + encoded[chunk_length:chunk_length+mid_section_length] + encoded[chunk_length*2:chunk_length*3]
+
+
+def make_doc_id(bucket:str, key:str) -> str:
+    """
+    Calculates the ID for the given bucket and key.
+    :raises ValueError: if the path is too long for the server to generate an ID for it
+    """
+    result = shorten(base64.b64encode(server_bytes(bucket + ":" + key)).decode("ascii"))
+    if result is None:
+        raise ValueError("{0}:{1} is too long to generate an ID for".format(bucket, key))
+    return result
+
+
+def encode_batch(bucket:str, keys:Iterable[str]) -> list:
+    """
+    Calculates the IDs for a batch of keys in the same bucket.  Keys that are too long to have an ID get None.
+    The bucket prefix is only base64 encoded once: whole three-byte groups of it are encoded up front and only the
+    remaining 0-2 bytes are re-encoded along with each key.
+    """
+    prefix_bytes = server_bytes(bucket + ":")
+    whole_groups = len(prefix_bytes) - len(prefix_bytes)%3
+    encoded_prefix = base64.b64encode(prefix_bytes[:whole_groups]).decode("ascii")
+    leftover = prefix_bytes[whole_groups:]
+
+    b2a_base64 = binascii.b2a_base64
+    results = []
+    append = results.append
+    for key in keys:
+        try:
+            raw = key.encode("latin-1")
+        except UnicodeEncodeError:
+            raw = key.encode("utf-16-le")[::2]
+        encoded = encoded_prefix + b2a_base64(leftover + raw, newline=False).decode("ascii")
+        if len(encoded)<=MAX_ID_LENGTH:
+            append(encoded)
+        else:
+            append(shorten(encoded))
+    return results
+
+
+def iterate_ids(bucket:str, keys:Iterable[str], chunk_size:int=10000):
+    """
+    Generator that yields (key, id) for every key, encoding them in chunks of `chunk_size`
+    """
+    chunk = []
+    for key in keys:
+        chunk.append(key)
+        if len(chunk)>=chunk_size:
+            yield from zip(chunk, encode_batch(bucket, chunk))
+            chunk = []
+    if len(chunk)>0:
+        yield from zip(chunk, encode_batch(bucket, chunk))
+
+
+def benchmark(count:int):
+    keys = ["path/to/some/media/folder/{0:08d}/clip_{0}.mxf".format(i) for i in range(count)]
+    keys.extend("long/" + "deeply-nested-folder/"*20 + "{0}.mov".format(i) for i in range(count//10))
+
+    start = perf_counter()
+    for key in keys:
+        make_doc_id("archivehunter-test-bucket", key)
+    single_time = perf_counter() - start
+
+    start = perf_counter()
+    for i in range(0, len(keys), 10000):
+        encode_batch("archivehunter-test-bucket", keys[i:i+10000])
+    batch_time = perf_counter() - start
+
+    print("{0} keys".format(len(keys)))
+    print("make_doc_id:  {0:.2f}s, {1:,.0f} keys/s".format(single_time, len(keys)/single_time))
+    print("encode_batch: {0:.2f}s, {1:,.0f} keys/s".format(batch_time, len(keys)/batch_time))
+
+
+if __name__=="__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--benchmark", dest="benchmark", type=int, default=1000000, help="number of keys to benchmark with")
+    args = parser.parse_args()
+    benchmark(args.benchmark)
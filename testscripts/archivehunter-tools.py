@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+One entry point for the ArchiveHunter tools, so that cron jobs and shell loops only pay for interpreter startup once.
+
+    archivehunter-tools.py <command> [options for that command]
+
+Nothing heavier than argparse is imported until a command is chosen, and then only the script that implements it is
+loaded.  The commands are the existing scripts run unchanged, so each one takes exactly the options it does on its own
+and `archivehunter-tools.py <command> --help` shows them.
+
+With --batch, each line read from stdin is passed to the command as the value of its batch option (see --help) and the
+command is run once per line in this process, instead of once per process:
+
+    cut -f1 ids.txt | archivehunter-tools.py --batch move -s $SECRET --dest other-bucket
+
+--batch-args does the same but splits each line into extra arguments the way a shell would.  The script is compiled
+once and its dependencies stay imported between lines.  Commands that read stdin themselves (--input - and --bulk -)
+already handle many items in one run and shouldn't be combined with --batch.
+"""
+
+import argparse
+import builtins
+import os
+import shlex
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the scripts finish with the site module's exit(), which closes sys.stdin before raising SystemExit.  That would end a
+# batch after the first run, so in here they get sys.exit under those names instead.
+SCRIPT_BUILTINS = dict(vars(builtins), exit=sys.exit, quit=sys.exit)
+
+
+class Command(object):
+    def __init__(self, description:str, candidates:list, batch_option:str, batch_together:bool=False):
+        """
+        :param description: one line for the command list in --help
+        :param candidates: paths of the script implementing the command, relative to this file, in order of preference.
+        The scripts are named differently in the repo and in the docker image.
+        :param batch_option: option that each line of stdin is the value of with --batch
+        :param batch_together: pass every line in a single run, for scripts that accept the option more than once
+        """
+        self.description = description
+        self.candidates = candidates
+        self.batch_option = batch_option
+        self.batch_together = batch_together
+
+    def script_path(self) -> str:
+        for candidate in self.candidates:
+            path = os.path.normpath(os.path.join(SCRIPT_DIR, candidate))
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError("none of {0} exist next to {1}".format(", ".join(self.candidates), SCRIPT_DIR))
+
+
+COMMANDS = {
+    "search": Command("list or export a collection via the search API", ["hmac-search.py"], "--collection"),
+    "move": Command("request that entries are moved to another collection", ["request-move-file.py"], "--id"),
+    "proxy": Command("query, set or remove the proxies of an entry", ["hmac_client.py", "hmac-client.py"], "--id"),
+    "ids": Command("list a bucket and print the ArchiveHunter ID of every object", ["build-id-list.py"], "--bucket"),
+    "migrate": Command("copy the lightbox table between DynamoDB tables",
+                       ["../utils/datamigration/lightbox_migration.py", "lightbox_migration.py"], "--source"),
+    "rundev": Command("run the proxy stats gathering task on ECS",
+                      ["../ProxyStatsGathering/scripts/rundev.py", "rundev.py"], "--collection", batch_together=True),
+    "stats": Command("work out proxy coverage from exported entries and proxies",
+                     ["../ProxyStatsGathering/scripts/proxy_stats.py", "proxy_stats.py"], "--collection"),
+}
+
+
+def compile_script(path:str):
+    """
+    compiles the script, putting its directory on the path so that it can import its neighbours
+    """
+    if os.path.dirname(path) not in sys.path:
+        sys.path.insert(0, os.path.dirname(path))
+    with open(path) as f:
+        return compile(f.read(), path, "exec")
+
+
+def run_script(code, path:str, args:list) -> int:
+    """
+    runs a compiled script as __main__ with the given arguments
+    :return: the exit status it finished with
+    """
+    saved_argv = sys.argv
+    sys.argv = [path] + args
+    try:
+        exec(code, {"__name__": "__main__", "__file__": path, "__builtins__": SCRIPT_BUILTINS})
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.argv = saved_argv
+    return 0
+
+
+def batch_arguments(lines, command:Command, split:bool):
+    """
+    yields the extra arguments for each run from the (non-blank) lines of batched input
+    """
+    values = (line.strip() for line in lines)
+    values = (v for v in values if v!="")
+    if split:
+        for value in values:
+            yield shlex.split(value)
+    elif command.batch_together:
+        collected = []
+        for value in values:
+            collected += [command.batch_option, value]
+        if len(collected)>0:
+            yield collected
+    else:
+        for value in values:
+            yield [command.batch_option, value]
+
+
+def make_parser() -> argparse.ArgumentParser:
+    epilog = "commands:\n" + "\n".join("  {0:<9} {1}".format(name, c.description) for name, c in COMMANDS.items())
+    epilog += "\n\nbatch options:\n" + "\n".join("  {0:<9} {1}".format(name, c.batch_option) for name, c in COMMANDS.items())
+    parser = argparse.ArgumentParser(description="Runs one of the ArchiveHunter tools",
+                                     epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", dest="batch", action="store_true", default=False, help="run the command once for each line of stdin, passing the line as the command's batch option")
+    parser.add_argument("--batch-args", dest="batch_args", action="store_true", default=False, help="run the command once for each line of stdin, adding the line's words to the arguments")
+    parser.add_argument("command", choices=list(COMMANDS.keys()), metavar="command", help="one of " + ", ".join(COMMANDS.keys()))
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="options for the command")
+    return parser
+
+
+def main(argv=None, stdin=None) -> int:
+    args = make_parser().parse_args(argv)
+    command = COMMANDS[args.command]
+    try:
+        path = command.script_path()
+    except FileNotFoundError as e:
+        print("{0} is not available here: {1}".format(args.command, e), file=sys.stderr)
+        return 2
+
+    if not args.batch and not args.batch_args:
+        return run_script(compile_script(path), path, args.args)
+
+    #all of stdin is read before the first run, so that nothing a script does to stdin can cut the batch short
+    batches = list(batch_arguments(stdin or sys.stdin, command, args.batch_args))
+    code = compile_script(path) if len(batches)>0 else None
+    failed = 0
+    for extra in batches:
+        try:
+            status = run_script(code, path, args.args + extra)
+        except Exception as e:
+            print("{0} failed: {1}".format(" ".join(extra), e), file=sys.stderr)
+            status = 1
+        if status!=0:
+            failed += 1
+    if failed>0:
+        print("{0} of {1} runs failed".format(failed, len(batches)), file=sys.stderr)
+    return 0 if failed==0 else 1
+
+
+if __name__=="__main__":
+    exit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""
+Shared HMAC-authenticated client for the ArchiveHunter API.
+
+The server (see app/auth/HMAC.scala) signs the string
+    {Date}\n{Content-Length}\n{X-Sha384-Checksum}\n{method}\n{request uri}
+where "request uri" is the path plus "?query" if (and only if) there is a query string.
+
+Import this from the scripts in this directory rather than copying the signing code around, e.g.
+
+    from archivehunter_client import ArchiveHunterClient
+    client = ArchiveHunterClient(host, secret)
+    response = client.get("/api/entry/{0}".format(entry_id))
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import re
+import time
+from datetime import datetime
+from email.utils import formatdate
+from typing import Union
+from urllib.parse import quote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+from instrumentation import Metrics, endpoint_name
+from response_cache import CachedResponse, ResponseCache, cache_key, mutated_entry_ids
+
+DEFAULT_HOST = "archivehunter.local.dev-gutools.co.uk"
+
+
+def parse_zoned_datetime(value:str) -> datetime:
+    """
+    Parses a ZonedDateTime as encoded by the server, e.g. 2020-01-02T03:04:05.12Z or 2020-01-02T03:04:05.123456789Z[UTC].
+    The server leaves the trailing zeros off the fraction of a second, but before Python 3.11 fromisoformat only takes
+    exactly 3 or 6 digits, so the fraction is padded or cut to 6.
+    """
+    value = re.sub(r'\[.*\]$', '', value).replace("Z", "+00:00")
+    value = re.sub(r'\.(\d+)', lambda m: "." + (m.group(1) + "000000")[:6], value, count=1)
+    return datetime.fromisoformat(value)
+
+
+def checksum(content:bytes) -> str:
+    """
+    Calculates the SHA-384 checksum of the given content and returns the base64 encoded representation as a string
+    :param content: the content to hash
+    :return: a string representing the checksum
+    """
+    digest = hashlib.sha384(content).digest()
+    return base64.b64encode(digest).decode("UTF-8")
+
+
+EMPTY_CHECKSUM = checksum(b"")
+
+
+class HttpDateCache(object):
+    """
+    Caches the RFC 1123 date string for the second that it is valid, so that we don't re-format it on every request
+    """
+    def __init__(self):
+        self._cached = (None, None)
+
+    def now(self) -> str:
+        current_second = int(time.time())
+        cached_second, cached_value = self._cached
+        if cached_second == current_second:
+            return cached_value
+        value = formatdate(timeval=current_second, localtime=False, usegmt=True)
+        self._cached = (current_second, value)    #assigning a tuple is atomic so this is safe across threads
+        return value
+
+
+def signing_path(uri:str) -> str:
+    """
+    Returns the portion of the given URI that the server includes in the string to sign.  This is the path, plus
+    "?" and the query string if there is one.
+    :param uri: full URI or path to access
+    :return: the path to sign
+    """
+    url_parts = urlparse(uri)
+    if url_parts.query:
+        return url_parts.path + "?" + url_parts.query
+    else:
+        return url_parts.path
+
+
+class HMACSigner(object):
+    """
+    Generates HMAC authorization tokens for a given shared secret.  The keyed hash state is set up once on construction
+    and copied for each signature, rather than re-deriving the key for every request.
+    """
+    def __init__(self, secret:str):
+        self._base_mac = hmac.new(secret.encode("UTF-8"), digestmod=hashlib.sha384)
+        self._dates = HttpDateCache()
+
+    def sign(self, uri:str, method:str, content_length:int, content_checksum:str, httpdate:str) -> str:
+        string_to_sign = "{}\n{}\n{}\n{}\n{}".format(httpdate, content_length, content_checksum, method, signing_path(uri))
+        mac = self._base_mac.copy()
+        mac.update(string_to_sign.encode("UTF-8"))
+        return "HMAC {0}".format(base64.b64encode(mac.digest()).decode("UTF-8"))
+
+    def get_token(self, uri:str, method:str, content:bytes, content_checksum:str) -> (str, str):
+        """
+        Generates an HMAC token
+        :param uri: URI that is going to be accessed
+        :param method: HTTP method for the request
+        :param content: byte string of the request body. Can be empty.
+        :param content_checksum: SHA-384 checksum of the body content, as returned by `checksum`
+        :return: tuple consisting of the body of an "Authorization" header and the HTTP style date/time of the request.
+        """
+        httpdate = self._dates.now()
+        return self.sign(uri, method, len(content), content_checksum, httpdate), httpdate
+
+    def headers(self, uri:str, method:str, content:bytes=b"") -> dict:
+        """
+        Returns the Date, Authorization and X-Sha384-Checksum headers for the given request
+        """
+        content_checksum = EMPTY_CHECKSUM if len(content)==0 else checksum(content)
+        authtoken, httpdate = self.get_token(uri, method, content, content_checksum)
+        return {
+            'Date': httpdate,
+            'Authorization': authtoken,
+            'X-Sha384-Checksum': content_checksum,
+        }
+
+
+def get_token(uri:str, secret:str, method:str, content:bytes, checksum:str) -> (str, str):
+    """
+    Generates an HMAC token.  This is kept for one-off callers; anything making more than one request should use
+    an HMACSigner or ArchiveHunterClient so that the key setup is reused.
+    :param uri:  URI that is going to be accessed
+    :param secret: Shared secret with the server
+    :param method: HTTP method for the request
+    :param content: byte string of the request body. Can be empty.
+    :param checksum: SHA-384 checksum of the body content. If content is empty then this should be the SHA checksum of an empty string
+    :return: tuple consisting of the body of an "Authorization" header and the HTTP style date/time of the request.
+    """
+    return HMACSigner(secret).get_token(uri, method, content, checksum)
+
+
+class ArchiveHunterClient(object):
+    """
+    Makes HMAC-signed requests to an ArchiveHunter server over a persistent, keep-alive connection pool.
+    A single instance can be shared between threads.
+
+    If a ResponseCache is given then get_entry, get_all_proxies and get_playable are served from it, and anything
+    cached about an entry is dropped when a request made through this client changes it.
+
+    Requests are timed into `metrics` if given, or into the instrumentation module's active Metrics if that is enabled
+    when the client is created.
+    """
+    def __init__(self, host:str, secret:str, verify:bool=True, pool_size:int=10, timeout:Union[float,None]=None, scheme:str="https",
+                 cache:Union[ResponseCache,None]=None, metrics:Union[Metrics,None]=None):
+        self.host = host
+        self.scheme = scheme
+        self.timeout = timeout
+        self.verify = verify
+        self.signer = HMACSigner(secret)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.metrics = metrics or instrumentation.active()
+        if self.metrics is not None:
+            self.metrics.add_gauge("connections_opened", self.connections_opened)
+
+    @classmethod
+    def from_options(cls, options, **kwargs):
+        """
+        Builds a client from the --host, --secret and --no-verify options that the scripts in this directory share
+        """
+        return cls(options.host, options.secret, verify=not (options.sslnoverify is True), **kwargs)
+
+    def url(self, path:str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return "{0}://{1}{2}".format(self.scheme, self.host, path)
+
+    def request(self, method:str, path:str, body:Union[bytes,dict,list,None]=None, headers:Union[dict,None]=None, **kwargs) -> requests.Response:
+        """
+        Makes a signed request.
+        :param method: HTTP method
+        :param path: path (including any query string) on the server, or a full URL
+        :param body: request body. dicts and lists are encoded as JSON; bytes are sent as-is.
+        :param headers: any extra headers to send
+        :param kwargs: passed on to requests.Session.request
+        :return: the requests Response object
+        """
+        uri = self.url(path)
+        extra_headers = {}
+        if body is None:
+            content = b""
+        elif isinstance(body, bytes):
+            content = body
+        else:
+            content = json.dumps(body).encode("UTF-8")
+            extra_headers["Content-Type"] = "application/json"
+
+        metrics = self.metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        request_headers = self.signer.headers(uri, method, content)
+        if metrics is not None:
+            endpoint = endpoint_name(method, uri)
+            metrics.observe(endpoint, "sign", time.perf_counter() - started)
+        request_headers.update(extra_headers)
+        if headers:
+            request_headers.update(headers)
+
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        try:
+            response = self.session.request(method, uri, data=content if len(content)>0 else None, headers=request_headers, **kwargs)
+        except IOError as e:
+            if metrics is not None:
+                metrics.record_request(endpoint, type(e).__name__, time.perf_counter() - started, len(content))
+            raise
+        finally:
+            if self.cache is not None and method!="GET":
+                for entry_id in mutated_entry_ids(method, uri, body):
+                    self.cache.invalidate(entry_id)
+
+        if metrics is not None:
+            metrics.observe(endpoint, "headers", response.elapsed.total_seconds())
+            # a streamed body hasn't been read yet, so go by what the server says it will send
+            received = int(response.headers.get("Content-Length", "0") or 0) if kwargs.get("stream") else len(response.content)
+            metrics.record_request(endpoint, response.status_code, time.perf_counter() - started, len(content), received)
+        return response
+
+    def connections_opened(self) -> int:
+        """
+        the number of connections the pool has opened, for instrumentation
+        """
+        pools = self.session.get_adapter("https://").poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def _lookup(self, kind:str, entry_id:str, path:str, *extra):
+        if self.cache is None:
+            return self.get(path)
+
+        def load():
+            response = self.get(path)
+            if response.status_code!=200:
+                return response
+            return CachedResponse(response.status_code, response.json())
+
+        return self.cache.get_or_load(cache_key(kind, entry_id, *extra), entry_id, load)
+
+    def get_entry(self, entry_id:str):
+        """
+        Looks up an entry by ID.  Returns a requests Response, or a CachedResponse if a cache is in use.
+        """
+        return self._lookup("entry", entry_id, "/api/entry/{0}".format(quote(entry_id, safe="")))
+
+    def get_all_proxies(self, entry_id:str):
+        """
+        Looks up all the proxies for an entry.  Returns a requests Response, or a CachedResponse if a cache is in use.
+        """
+        return self._lookup("proxies", entry_id, "/api/proxy/{0}/all".format(quote(entry_id, safe="")))
+
+    def get_playable(self, entry_id:str, proxy_type:Union[str,None]=None):
+        """
+        Looks up the playable proxy for an entry, optionally of a given type.  Returns a requests Response, or a
+        CachedResponse if a cache is in use.
+        """
+        path = "/api/proxy/{0}/playable".format(quote(entry_id, safe=""))
+        if proxy_type:
+            path += "?proxyType={0}".format(quote(proxy_type, safe=""))
+        return self._lookup("playable", entry_id, path, proxy_type)
+
+    def get(self, path:str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path:str, body=None, **kwargs) -> requests.Response:
+        return self.request("POST", path, body=body, **kwargs)
+
+    def put(self, path:str, body=None, **kwargs) -> requests.Response:
+        return self.request("PUT", path, body=body, **kwargs)
+
+    def delete(self, path:str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Building blocks for scripts that make large numbers of API calls: a token-bucket rate limiter, retry with backoff
+on throttling responses, a journal of per-item outcomes so that re-runs can skip completed items, latency statistics,
+line splitting for streamed NDJSON responses and a bounded concurrent runner.
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import monotonic, sleep
+from typing import Callable, Iterable, Iterator, Union
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class TruncatedStreamError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token-bucket rate limiter.  `rate` tokens are added per second, up to a maximum of `burst`.
+    A rate of None or 0 disables limiting.
+    """
+    def __init__(self, rate:Union[float,None], burst:Union[int,None]=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(1, int(rate or 1))
+        self._tokens = float(self.capacity)
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens:int=1):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+                self._last = now
+                if self._tokens>=tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens)/self.rate
+            sleep(wait_time)
+
+
+def backoff_delay(attempt:int, base:float=1.0, cap:float=60.0) -> float:
+    """
+    exponential backoff with full jitter
+    """
+    return random.uniform(0, min(cap, base*(2**attempt)))
+
+
+def request_with_backoff(make_request:Callable, limiter:Union[TokenBucket,None]=None, max_retries:int=5, retry_statuses=RETRY_STATUSES):
+    """
+    Calls `make_request` (which should return a requests Response) until it gets a response that is not a throttling
+    or gateway error, or runs out of retries.  A Retry-After header from the server is honoured.
+    Connection errors are retried in the same way; the last one is re-raised if retries run out.
+    :return: the final Response
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+        try:
+            response = make_request()
+            if response.status_code not in retry_statuses or attempt>=max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After")
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff_delay(attempt)
+            logger.debug("Server returned {0}, retrying in {1:.1f}s".format(response.status_code, delay))
+            reason = str(response.status_code)
+        except IOError as e:
+            if attempt>=max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.debug("Request failed with {0}, retrying in {1:.1f}s".format(e, delay))
+            reason = type(e).__name__
+        metrics = instrumentation.active()
+        if metrics is not None:
+            metrics.count("retries_total", (reason,))
+        attempt += 1
+        sleep(delay)
+
+
+class Journal(object):
+    """
+    Append-only NDJSON record of per-item outcomes.  On opening, any items that previously succeeded are loaded so
+    that they can be skipped.
+    """
+    def __init__(self, path:Union[str,None]):
+        self.path = path
+        self.succeeded = set()
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue    #partially written last line from an interrupted run
+                        if record.get("ok"):
+                            self.succeeded.add(record["id"])
+            self._file = open(path, "a")
+
+    def is_done(self, item_id:str) -> bool:
+        return item_id in self.succeeded
+
+    def record(self, item_id:str, ok:bool, **details):
+        with self._lock:
+            if ok:
+                self.succeeded.add(item_id)
+            if self._file:
+                details.update({"id": item_id, "ok": ok})
+                self._file.write(json.dumps(details) + "\n")
+                self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def percentile(sorted_values:list, fraction:float) -> float:
+    """
+    nearest-rank percentile of an already-sorted list
+    """
+    if len(sorted_values)==0:
+        return 0.0
+    index = min(len(sorted_values)-1, max(0, math.ceil(fraction*len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LatencyStats(object):
+    """
+    Thread-safe collection of request latencies and outcome counts for a bulk run
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.start_time = monotonic()
+
+    def record(self, latency:float, ok:bool):
+        with self._lock:
+            self._latencies.append(latency)
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        elapsed = max(monotonic() - self.start_time, 0.001)
+        return {
+            "requests": len(latencies),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "elapsed": elapsed,
+            "per_second": len(latencies)/elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if len(latencies)>0 else 0.0,
+        }
+
+    def format_summary(self) -> str:
+        s = self.summary()
+        return "{requests} requests ({succeeded} ok, {failed} failed) in {elapsed:.1f}s, {per_second:.1f}/s; " \
+               "latency p50 {p50:.3f}s p95 {p95:.3f}s p99 {p99:.3f}s max {max:.3f}s".format(**s)
+
+
+def read_lines(path:str) -> Iterable[str]:
+    """
+    Generator that yields the non-blank lines of the given file, or stdin if the path is "-"
+    """
+    f = sys.stdin if path=="-" else open(path, "r")
+    try:
+        for line in f:
+            line = line.strip()
+            if line!="":
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_lines(chunks:Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Generator that re-splits a stream of byte chunks into newline-terminated lines.  Only one partial line is held at
+    a time.
+    :raises TruncatedStreamError: if the stream ends part-way through a line, which means the server gave up mid-stream
+    """
+    partial = b""
+    for chunk in chunks:
+        if len(chunk)==0:
+            continue
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            if len(line)>0:
+                yield line
+    if len(partial.strip())>0:
+        raise TruncatedStreamError("Stream ended part-way through a record, the response is incomplete")
+
+
+def run_bulk(items:Iterable, handler:Callable, concurrency:int):
+    """
+    Generator that calls `handler(item)` for each item over a thread pool, with no more than `concurrency` calls in
+    flight, and yields (item, result, exception) in completion order.  Items are pulled from the iterable lazily, so it
+    can be a stream of any length.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        item_iter = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight)<concurrency:
+                try:
+                    item = next(item_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(handler, item)] = item
+
+            if len(in_flight)==0:
+                return
+
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
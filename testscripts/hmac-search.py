@@ -1,103 +1,255 @@
 #!/usr/bin/env python3
 
-import hashlib
-import hmac
 import sys
-import urllib.parse
-from optparse import OptionParser
-from datetime import datetime, timedelta
-import base64
-from email.utils import formatdate
-import requests
-from time import mktime
-from urllib.parse import urlparse
+import os
+import gzip
 import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from time import sleep
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST, parse_zoned_datetime
+from snapshot_store import MAX_RESULT_WINDOW, format_timestamp, search_body
 
+logging.basicConfig(level=logging.WARN, stream=sys.stderr)
+logger = logging.getLogger(__name__)
 
-def checksum(content:bytes) -> str:
-    """
-    Calculates the SHA-384 checksum of the given content and returns the base64 encoded representation as a string
-    :param content: the content to hash
-    :return: a string representing the checksum
-    """
-    digest = hashlib.sha384(content).digest()
-    return base64.b64encode(digest).decode("UTF-8")
+
+class PageFetchError(Exception):
+    pass
 
 
-def get_token(uri:str, secret:str, method:str, content:bytes, checksum:str) -> (str, str):
+def fetch_page(client: ArchiveHunterClient, search: dict, start_at: int, page_size: int, retries: int=3) -> dict:
     """
-    Generates an HMAC token
-    :param uri:  URI that is going to be accessed
-    :param secret: Shared secret with the server
-    :param method: HTTP method for the request
-    :param content: byte string of the request body. Can be empty.
-    :param checksum: SHA-384 checksum of the body content. If content is empty then this should be the SHA checksum of an empty string
-    :return: tuple consisting of the body of an "Authorization" header and the HTTP style date/time of the request.
+    Fetches a single page of results from the browser search endpoint, retrying with backoff if it fails
+    :param client: ArchiveHunterClient to make the request with
+    :param search: SearchRequest body, which gives the collection (bucket) name and any filter and sort order
+    :param start_at: offset of the first result to return
+    :param page_size: number of results to return
+    :param retries: number of times to retry a failed request before giving up
+    :return: the decoded JSON response
     """
-    t = datetime.now()
-    httpdate = formatdate(timeval=mktime(t.timetuple()),localtime=False,usegmt=True)
-    url_parts = urlparse(uri)
-
-    content_length = len(content)
-
-    string_to_sign = "{}\n{}\n{}\n{}\n{}".format(httpdate, content_length, checksum, method, url_parts.path + "?" + url_parts.query)
-    hm = hmac.digest(secret.encode("UTF-8"), msg=string_to_sign.encode("UTF-8"), digest=hashlib.sha384)
-    return "HMAC {0}".format(base64.b64encode(hm).decode("UTF-8")), httpdate
-
-
-def get_next_page(start_at: int, page_size: int) -> bool:
-    method = "POST"
-    uri = "https://{host}/api/search/browser?start={start}&size={size}".format(host=options.host,
-                                                                               start=start_at,
-                                                                               size=page_size)
-
-    content_body = json.dumps({"collection": options.dest}).encode("UTF-8")
-    content_hash = checksum(content_body)
+    uri = "/api/search/browser?start={start}&size={size}".format(start=start_at, size=page_size)
 
-    authtoken, httpdate = get_token(uri, options.secret, method, content_body, content_hash)
-
-    headers = {
-        'Date': httpdate,
-        'Authorization': authtoken,
-        'X-Sha384-Checksum': content_hash,
-        'Content-Type': "application/json"
-    }
+    attempt = 0
+    while True:
+        try:
+            response = client.post(uri, body=search)
+            if response.status_code==200:
+                return response.json()
+            error = "server returned {0}: {1}".format(response.status_code, response.text)
+            if response.status_code<500 and response.status_code!=429:
+                raise PageFetchError("Page at {0} failed, {1}".format(start_at, error))
+        except (IOError, ValueError) as e:  #requests exceptions and JSON decode errors are subclasses of these
+            error = str(e)
+
+        attempt += 1
+        if attempt>retries:
+            raise PageFetchError("Page at {0} failed after {1} attempts, last error was {2}".format(start_at, attempt, error))
+        delay = 2**attempt
+        logger.warning("Page at {0} failed ({1}), retrying in {2}s".format(start_at, error, delay))
+        sleep(delay)
+
+
+def iterate_pages(client: ArchiveHunterClient, collection: str, page_size: int, concurrency: int=1, cursor: dict=None,
+                  retries: int=3, window: int=MAX_RESULT_WINDOW):
+    """
+    Generator that yields (cursor, page content) for every page of the collection, in last_modified order.
+    Elasticsearch won't page past its result window (10,000 hits by default), so the listing is split into windows in
+    the same way as snapshot_store: each window is a last_modified range query starting at the newest modification time
+    in the window before.  Entries modified at that time come back at the start of the next window too, so they are
+    left out of its pages and every entry is yielded once.
+    Within a window, the total count from its first page is used to work out the remaining offsets, and up to
+    `concurrency` pages are fetched at once while still being yielded in order.
+    The cursor yielded with each page says where to carry on from after it, and can be passed back in to resume the
+    listing.  It is None after the last page.
+    :raises PageFetchError: if a page can't be fetched, or more than a window's worth of entries share one modification
+    time so the listing can't get past them
+    """
+    cursor = cursor or {"since": None, "offset": 0, "skip": []}
+    since, offset, skip = cursor["since"], cursor["offset"], set(cursor["skip"])
+    first_window = True
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        while True:
+            search = search_body(collection, None, since)
+            first_page = fetch_page(client, search, offset, min(page_size, window - offset), retries)
+            entry_count = first_page["entryCount"]
+            if first_window:
+                sys.stderr.write("Total hits: {0}\n".format(entry_count))
+                first_window = False
+            window_end = min(entry_count, window)
+
+            def fetch(start):
+                return fetch_page(client, search, start, min(page_size, window_end - start), retries)
+
+            # only keep a bounded number of pages in flight, so that memory use doesn't depend on collection size
+            offsets = iter(range(offset + page_size, window_end, page_size))
+            pending = deque()
+            for start in offsets:
+                pending.append((start, executor.submit(fetch, start)))
+                if len(pending)>=concurrency*2:
+                    break
+
+            # (modification time, id) of the entries that the next window's range query will return again
+            boundary = deque()
+            start, content = offset, first_page
+            while True:
+                if len(content["entries"])==0:
+                    #the collection shrank while we were listing it
+                    for _, f in pending:
+                        f.cancel()
+                    return
+                for e in content["entries"]:
+                    if e.get("last_modified"):
+                        modified = parse_zoned_datetime(e["last_modified"]).timestamp()
+                        while len(boundary)>0 and boundary[0][0]<modified - 0.001:
+                            boundary.popleft()
+                        boundary.append((modified, e["id"]))
+                page = dict(content, entries=[e for e in content["entries"] if e["id"] not in skip])
+
+                if start + page_size<window_end:
+                    next_cursor = {"since": since, "offset": start + page_size, "skip": sorted(skip)}
+                elif entry_count<=window:
+                    next_cursor = None
+                else:
+                    if len(boundary)==0:
+                        raise PageFetchError("Entries at the end of the result window have no last_modified, so the listing can't get past them")
+                    next_since = boundary[-1][0]
+                    if since is not None and next_since<=since:
+                        raise PageFetchError("More than {0} entries were modified at {1}, so the listing can't get past them".format(window, format_timestamp(since)))
+                    next_cursor = {"since": next_since, "offset": 0, "skip": sorted(i for _, i in boundary)}
+                yield next_cursor, page
+
+                if len(pending)==0:
+                    break
+                start, future = pending.popleft()
+                content = future.result()
+                next_start = next(offsets, None)
+                if next_start is not None:
+                    pending.append((next_start, executor.submit(fetch, next_start)))
+
+            if next_cursor is None:
+                return
+            since, offset, skip = next_cursor["since"], 0, set(next_cursor["skip"])
+
+
+class NDJSONExporter(object):
+    """
+    Writes full search entries as newline-delimited JSON, one page at a time, and records a checkpoint after each page
+    so that an interrupted export can be resumed.
+    The checkpoint holds the cursor from iterate_pages (the last_modified window being read, the offset within it and
+    the IDs at its start that were already written) and the output file size at that point.  On resume the output is
+    truncated back to that size, so a page that was written but not checkpointed is not duplicated.  A checkpoint with
+    no cursor means that the export finished.
+    With gzip enabled each page is written as its own gzip member; concatenated members are still a valid gzip file.
+    """
+    def __init__(self, output_path: str, collection: str, checkpoint_path: str=None, use_gzip: bool=False):
+        self.output_path = output_path
+        self.collection = collection
+        self.checkpoint_path = checkpoint_path if checkpoint_path else output_path + ".checkpoint"
+        self.use_gzip = use_gzip
+        self._file = None
+        self.entries_written = 0
+        self.finished = False
+
+    def read_checkpoint(self):
+        """
+        returns the checkpoint data from a previous run or None if there is none
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint["collection"]!=self.collection:
+            raise ValueError("Checkpoint {0} is for collection {1}, not {2}".format(self.checkpoint_path, checkpoint["collection"], self.collection))
+        if "next" not in checkpoint:
+            raise ValueError("Checkpoint {0} holds an offset rather than a cursor, so it can't be resumed; start the export again".format(self.checkpoint_path))
+        return checkpoint
+
+    def open(self, resume: bool=False) -> dict:
+        """
+        opens the output file and returns the cursor that the export should start from, which is None for a new export.
+        If the checkpoint says that the export already finished, `finished` is set and there is nothing more to fetch.
+        """
+        checkpoint = self.read_checkpoint() if resume else None
+        if checkpoint and os.path.exists(self.output_path):
+            self._file = open(self.output_path, "r+b")
+            self._file.truncate(checkpoint["output_bytes"])
+            self._file.seek(checkpoint["output_bytes"])
+            if checkpoint["next"] is None:
+                self.finished = True
+                logger.info("Export of {0} to {1} is already complete".format(self.collection, self.output_path))
+            else:
+                logger.info("Resuming export of {0} from offset {1} of the window at {2}".format(
+                    self.collection, checkpoint["next"]["offset"],
+                    format_timestamp(checkpoint["next"]["since"]) if checkpoint["next"]["since"] is not None else "the start"))
+            return checkpoint["next"]
+        else:
+            self._file = open(self.output_path, "wb")
+            return None
 
-    extra_kwargs = {}
-    if options.sslnoverify:
-        extra_kwargs['verify'] = False
+    def write_page(self, cursor: dict, page: dict):
+        data = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in page["entries"]).encode("UTF-8")
+        self._file.write(gzip.compress(data) if self.use_gzip else data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries_written += len(page["entries"])
+        self.write_checkpoint(cursor)
 
-    response = requests.post(uri, data=content_body, headers=headers, **extra_kwargs)
+    def write_checkpoint(self, cursor: dict):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"collection": self.collection, "next": cursor, "output_bytes": self._file.tell()}, f)
+        os.replace(tmp_path, self.checkpoint_path)
 
-    if response.status_code==200:
-        content = response.json()
-        sys.stderr.write("Total hits: {0}\n".format(content["entryCount"]))
-        if len(content["entries"])==0:
-            return False
-        for e in content["entries"]:
-            if not e["beenDeleted"]:
-                print(e["id"])
-        return True
-    else:
-        print(response.text)
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
 
 
 if __name__=="__main__":
     parser = OptionParser()
-    parser.add_option("--host", dest="host", help="host to access", default="archivehunter.local.dev-gutools.co.uk")
-    parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default="false", help="set this to disable SSL cert checking")
+    parser.add_option("--host", dest="host", help="host to access", default=DEFAULT_HOST)
+    parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
     parser.add_option("-s", "--secret", dest="secret", help="shared secret to use")
     parser.add_option("-c", "--collection", dest="dest", help="Collection (bucket) name to list")
-    parser.add_option("--page-size", dest="page_size", default=100, help="page size")
+    parser.add_option("--page-size", dest="page_size", type="int", default=100, help="page size")
+    parser.add_option("-j", "--concurrency", dest="concurrency", type="int", default=1, help="number of pages to fetch at once. Output is still in order.")
+    parser.add_option("--retries", dest="retries", type="int", default=3, help="number of times to retry a failed page")
+    parser.add_option("--export", dest="export", help="write full entries as NDJSON to this file instead of printing ids")
+    parser.add_option("--gzip", dest="gzip", action="store_true", default=False, help="gzip the export file. Implied if the --export filename ends in .gz")
+    parser.add_option("--checkpoint", dest="checkpoint", help="checkpoint file for the export. Defaults to the export filename with .checkpoint appended")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False, help="continue an export from its checkpoint")
+    instrumentation.add_arguments(parser)
     (options, args) = parser.parse_args()
+    instrumentation.from_args(options)
 
     if options.secret is None:
         print("You must supply the password in --secret")
         exit(1)
 
-    ctr = 0
-    while True:
-        if get_next_page(ctr, int(options.page_size)):
-            ctr += options.page_size
+    client = ArchiveHunterClient.from_options(options, pool_size=max(options.concurrency, 1))
+    try:
+        if options.export:
+            logger.setLevel(logging.INFO)
+            exporter = NDJSONExporter(options.export, options.dest, options.checkpoint, options.gzip or options.export.endswith(".gz"))
+            cursor = exporter.open(resume=options.resume)
+            try:
+                if not exporter.finished:
+                    for cursor, page in iterate_pages(client, options.dest, options.page_size, options.concurrency, cursor=cursor, retries=options.retries):
+                        exporter.write_page(cursor, page)
+            finally:
+                exporter.close()
+            logger.info("Exported {0} entries to {1}".format(exporter.entries_written, options.export))
         else:
-            break
+            for _, page in iterate_pages(client, options.dest, options.page_size, options.concurrency, retries=options.retries):
+                for e in page["entries"]:
+                    if not e["beenDeleted"]:
+                        print(e["id"])
+    except PageFetchError as e:
+        sys.stderr.write("{0}\n".format(e))
+        exit(1)
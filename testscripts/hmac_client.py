@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
-import hashlib
-import hmac
+import csv
+import json
+import logging
+import re
+import sys
 from optparse import OptionParser
-from datetime import datetime, timedelta
-import base64
-from email.utils import formatdate
-import requests
-from time import mktime
-from urllib.parse import urlparse
 from pprint import pprint
-import json
+from time import monotonic
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import LatencyStats, TokenBucket, request_with_backoff, run_bulk
+from response_cache import ResponseCache
+
+logging.basicConfig(level=logging.WARN, stream=sys.stderr)
+logger = logging.getLogger(__name__)
 
 #uncomment this block to get request-level debug output
 # import logging
@@ -30,42 +34,116 @@ import json
 # requests_log.propagate = True
 
 
-def checksum(content:bytes) -> str:
-    """
-    Calculates the SHA-384 checksum of the given content and returns the base64 encoded representation as a string
-    :param content: the content to hash
-    :return: a string representing the checksum
-    """
-    digest = hashlib.sha384(content).digest()
-    return base64.b64encode(digest).decode("UTF-8")
+PROXY_FIELDS = ["entryId", "proxyBucket", "proxyPath", "proxyType", "region"]
+PROXY_TYPES = ["VIDEO", "AUDIO", "THUMBNAIL", "METADATA", "UNKNOWN"]   #ProxyType enumeration on the server
+REGION_RE = re.compile(r'^[a-z]{2}(-[a-z]+)+-\d$')
 
 
-def get_token(uri:str, secret:str, method:str, content:bytes, checksum:str) -> (str, str):
+class InvalidRow(Exception):
+    pass
+
+
+def read_proxy_rows(path: str, format: str=None):
     """
-    Generates an HMAC token
-    :param uri:  URI that is going to be accessed
-    :param secret: Shared secret with the server
-    :param method: HTTP method for the request
-    :param content: byte string of the request body. Can be empty.
-    :param checksum: SHA-384 checksum of the body content. If content is empty then this should be the SHA checksum of an empty string
-    :return: tuple consisting of the body of an "Authorization" header and the HTTP style date/time of the request.
+    Generator that yields a row dict for each row of a CSV file with a header row, or each line of an NDJSON file.
+    An NDJSON line that can't be parsed is yielded as {"_error": ..., "_line": ...} so that it can be reported.
+    The format is taken from the file extension if not given. Use "-" to read from stdin.
     """
-    t = datetime.now()
-    httpdate = formatdate(timeval=mktime(t.timetuple()),localtime=False,usegmt=True)
-    url_parts = urlparse(uri)
-
-    content_length = len(content)
+    if format is None:
+        format = "ndjson" if path.endswith(".ndjson") or path.endswith(".jsonl") else "csv"
+    f = sys.stdin if path=="-" else open(path, "r", newline="")
+    try:
+        if format=="csv":
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip()!="":
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        yield {"_error": "could not parse line: {0}".format(e), "_line": line.rstrip("\n")}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def validate_proxy_row(row: dict) -> dict:
+    """
+    checks a row before it is sent to the server and returns the request body for it
+    :raises InvalidRow: if the row is not valid
+    """
+    if "_error" in row:
+        raise InvalidRow(row["_error"])
+    missing = [f for f in PROXY_FIELDS if not str(row.get(f) or "").strip()]
+    if len(missing)>0:
+        raise InvalidRow("missing {0}".format(", ".join(missing)))
+    body = {f: str(row[f]).strip() for f in PROXY_FIELDS}
+    body["proxyType"] = body["proxyType"].upper()
+    if body["proxyType"] not in PROXY_TYPES:
+        raise InvalidRow("proxyType must be one of {0}".format(", ".join(PROXY_TYPES)))
+    if not REGION_RE.match(body["region"]):
+        raise InvalidRow("{0} does not look like an AWS region".format(body["region"]))
+    if body["proxyPath"].startswith("/"):
+        raise InvalidRow("proxyPath should not start with /")
+    return body
+
+
+def bulk_set_proxies(client: ArchiveHunterClient, rows, rejects, concurrency: int, limiter: TokenBucket=None, retries: int=5) -> LatencyStats:
+    """
+    POSTs /api/proxy for every valid row, with up to `concurrency` requests in flight.  Invalid rows and failed
+    requests are written to `rejects` as NDJSON with the reason.
+    :return: LatencyStats for the run, with an extra `rejected` count
+    """
+    stats = LatencyStats()
+    stats.rejected = 0
+
+    def reject(row, reason, status=None):
+        stats.rejected += 1
+        record = {"row": row, "reason": reason}
+        if status is not None:
+            record["status"] = status
+        rejects.write(json.dumps(record) + "\n")
+
+    def valid_rows():
+        for row in rows:
+            try:
+                yield row, validate_proxy_row(row)
+            except InvalidRow as e:
+                reject(row, str(e))
+
+    def send(item):
+        row, body = item
+        start = monotonic()
+        response = request_with_backoff(lambda: client.post("/api/proxy", body=body), limiter, max_retries=retries)
+        return response, monotonic() - start
+
+    for (row, body), result, error in run_bulk(valid_rows(), send, concurrency):
+        if error:
+            stats.record(0.0, False)
+            reject(row, str(error))
+            continue
+        response, latency = result
+        stats.record(latency, response.status_code==200)
+        if response.status_code!=200:
+            try:
+                detail = response.json()
+                reason = detail.get("detail", detail.get("status", response.text))
+            except ValueError:
+                reason = response.text
+            reject(row, reason, response.status_code)
+        if (stats.succeeded + stats.failed)%1000==0:
+            logger.info(stats.format_summary())
+
+    logger.info("{0} rows rejected".format(stats.rejected))
+    return stats
 
-    string_to_sign = "{}\n{}\n{}\n{}\n{}".format(httpdate, content_length, checksum, method, url_parts.path)
-    print("string_to_sign: " + string_to_sign)
-    hm = hmac.digest(secret.encode("UTF-8"), msg=string_to_sign.encode("UTF-8"), digest=hashlib.sha384)
-    return "HMAC {0}".format(base64.b64encode(hm).decode("UTF-8")), httpdate
 
 #START MAIN
 if __name__ == "__main__":
     parser = OptionParser()
-    parser.add_option("--host", dest="host", help="host to access", default="archivehunter.local.dev-gutools.co.uk")
-    parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default="false", help="set this to disable SSL cert checking")
+    parser.add_option("--host", dest="host", help="host to access", default=DEFAULT_HOST)
+    parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
     parser.add_option("-s", "--secret", dest="secret", help="shared secret to use")
     parser.add_option("--id", dest="entry_id", help="ArchiveHunter ID of media to set proxy for")
     parser.add_option("-b", "--proxy-bucket", dest="proxy_bucket", help="Bucket where proxy is stored")
@@ -75,57 +153,54 @@ if __name__ == "__main__":
     parser.add_option("--rm", dest="remove", help="Remove the given proxy as opposed to adding. You only need to specify --proxy-type and --id for this.", action="store_true")
     parser.add_option("-q", "--query", dest="query", help="Query what proxies are available for the given item", action="store_true")
     parser.add_option("--raw",dest="raw",help="Call the provided url and display the result")
+    parser.add_option("--bulk", dest="bulk", help="set a proxy for every row of this CSV (with a header row) or NDJSON file. Columns are " + ", ".join(PROXY_FIELDS) + ". Use - for stdin")
+    parser.add_option("--bulk-format", dest="bulk_format", help="csv or ndjson. Defaults to ndjson for .ndjson/.jsonl files and csv otherwise")
+    parser.add_option("--rejects", dest="rejects", default="proxy-rejects.ndjson", help="file to write rows that could not be set to, with the reason")
+    parser.add_option("-j", "--concurrency", dest="concurrency", type="int", default=8, help="number of requests in flight at once with --bulk")
+    parser.add_option("--rate", dest="rate", type="float", default=0, help="maximum requests per second with --bulk. 0 for no limit")
+    parser.add_option("--cache-file", dest="cache_file", help="keep the results of --query in this SQLite file and re-use them until they expire")
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="float", default=300, help="seconds to keep cached --query results for")
+    instrumentation.add_arguments(parser)
     (options, args) = parser.parse_args()
+    instrumentation.from_args(options)
 
     if options.secret is None:
         print("You must supply the password in --secret")
         exit(1)
 
-    method = "GET"
-    if options.remove:
-        uri = "https://{host}/api/proxy/{fileid}/{proxytype}".format(host=options.host,fileid=options.entry_id, proxytype=options.proxy_type)
-        method = "DELETE"
-    elif options.query:
-        uri = "https://{host}/api/proxy/{fileid}/all".format(host=options.host, fileid=options.entry_id)
-    elif options.raw:
-        uri = options.raw
-    else:
-        uri = "https://{host}/api/proxy".format(host=options.host)
-
-    print("uri is " + uri)
-    content_body = "".encode("UTF-8")
-    content_hash = checksum(content_body)
-
-    authtoken, httpdate = get_token(uri, options.secret, method, content_body, content_hash)
-    print(authtoken)
-
-    headers = {
-            'Date': httpdate,
-            'Authorization': authtoken,
-            'X-Sha384-Checksum': content_hash,
-    }
+    if options.bulk:
+        logger.setLevel(logging.INFO)
+        client = ArchiveHunterClient.from_options(options, pool_size=options.concurrency)
+        with open(options.rejects, "w") as rejects:
+            stats = bulk_set_proxies(client, read_proxy_rows(options.bulk, options.bulk_format), rejects, options.concurrency, TokenBucket(options.rate))
+        print(stats.format_summary())
+        print("{0} rows rejected, see {1}".format(stats.rejected, options.rejects))
+        exit(0 if stats.rejected==0 else 1)
 
-    print(headers)
-    extra_kwargs = {}
-    if options.sslnoverify:
-        extra_kwargs['verify'] = False
+    cache = ResponseCache(ttl=options.cache_ttl, sqlite_path=options.cache_file) if options.cache_file else None
+    client = ArchiveHunterClient.from_options(options, cache=cache)
 
     if options.remove:
-        response = requests.delete(uri, headers=headers, **extra_kwargs)
+        uri = "/api/proxy/{fileid}/{proxytype}".format(fileid=options.entry_id, proxytype=options.proxy_type)
+        print("uri is " + client.url(uri))
+        response = client.delete(uri)
     elif options.query:
-        response = requests.get(uri, headers=headers, **extra_kwargs)
+        uri = "/api/proxy/{fileid}/all".format(fileid=options.entry_id)
+        print("uri is " + client.url(uri))
+        response = client.get_all_proxies(options.entry_id)
     elif options.raw:
-        response = requests.get(uri, headers=headers, **extra_kwargs)
+        print("uri is " + options.raw)
+        response = client.get(options.raw)
     else:
-        requestbody = json.dumps({
+        uri = "/api/proxy"
+        print("uri is " + client.url(uri))
+        response = client.post(uri, body={
             "entryId": options.entry_id,
             "proxyBucket": options.proxy_bucket,
             "proxyPath": options.proxy_path,
             "proxyType": options.proxy_type,
             "region": options.region
         })
-        headers['Content-Type'] = "application/json"
-        response = requests.post(uri, data=requestbody, headers=headers, **extra_kwargs)
 
     print("Server returned {0}".format(response.status_code))
     pprint(response.headers)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the ArchiveHunter API, for exercising the scripts in this directory without a real server.
+
+Requests are authenticated exactly as app/auth/Security.scala does for server-to-server calls: the HMAC is
+recalculated from the Date, Content-Length, X-Sha384-Checksum, method and request URI and compared with the
+Authorization header, and a 403 is returned if they don't match.  The search endpoints are answered from a generated
+set of entries, and other routes can be added with `add_route`.
+
+    server = StubArchiveHunter("s3cr3t", entry_count=1000)
+    server.start()
+    client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http")
+    ...
+    server.stop()
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import random
+import re
+import sys
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Callable, Union
+from urllib.parse import parse_qs, unquote, urlparse
+
+from archive_ids import make_doc_id
+
+logger = logging.getLogger(__name__)
+
+
+def calculate_hmac(secret:str, httpdate:str, content_length:str, content_checksum:str, method:str, uri:str) -> str:
+    """
+    Port of auth.HMAC.calculateHmac.  This deliberately does not share code with HMACSigner, so that it checks it.
+    """
+    string_to_sign = "{0}\n{1}\n{2}\n{3}\n{4}".format(httpdate, content_length, content_checksum, method, uri)
+    digest = hmac.new(secret.encode("UTF-8"), string_to_sign.encode("UTF-8"), hashlib.sha384).digest()
+    return "HMAC " + base64.b64encode(digest).decode("UTF-8")
+
+
+def make_entries(count:int, bucket:str="stub-bucket") -> list:
+    """
+    Generates `count` ArchiveEntry-shaped records, sorted by path as the browser search returns them
+    """
+    rng = random.Random(count)
+    extensions = [("mxf", "application", "mxf"), ("mp4", "video", "mp4"), ("wav", "audio", "x-wav"), ("jpg", "image", "jpeg")]
+    entries = []
+    for i in range(count):
+        ext, major, minor = extensions[i%len(extensions)]
+        path = "project{0:03d}/media/clip_{1:06d}.{2}".format(i//100, i, ext)
+        entries.append({
+            "id": make_doc_id(bucket, path),
+            "bucket": bucket,
+            "path": path,
+            "maybeVersion": None,
+            "region": "eu-west-1",
+            "file_extension": ext,
+            "size": rng.randint(1024, 10*1024*1024*1024),
+            "last_modified": "2020-01-01T00:00:00Z",
+            "etag": "{0:032x}".format(rng.getrandbits(128)),
+            "mimeType": {"major": major, "minor": minor},
+            "proxied": i%3!=0,
+            "storageClass": "GLACIER" if i%5==0 else "STANDARD",
+            "lightboxEntries": [],
+            "beenDeleted": False,
+            "mediaMetadata": None,
+        })
+    entries.sort(key=lambda e: e["path"])
+    return entries
+
+
+class StubArchiveHunter(object):
+    """
+    Threaded HTTP server that checks HMAC authentication and answers ArchiveHunter API routes.
+    :param secret: shared secret that requests must be signed with
+    :param entry_count: number of entries to generate for the search endpoints
+    :param latency: seconds to wait before answering each request, to simulate a real backend
+    :param error_rate: fraction of authenticated requests to fail with a 503
+    :param port: port to listen on; 0 picks a free one
+    """
+    def __init__(self, secret:str, entry_count:int=1000, latency:float=0.0, error_rate:float=0.0, port:int=0, bind:str="127.0.0.1"):
+        self.secret = secret
+        self.latency = latency
+        self.error_rate = error_rate
+        self.entries = make_entries(entry_count)
+        self.entries_by_id = {e["id"]: e for e in self.entries}
+        self.routes = []
+        self.request_count = 0
+        self.auth_failures = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._thread = None
+
+        self.add_route("POST", r'^/api/search/browser$', self._browser_search)
+        self.add_route("GET", r'^/api/search/basic$', self._basic_search)
+        self.add_route("PUT", r'^/api/search/suggestions$', self._suggestions)
+        self.add_route("GET", r'^/api/entry/([^/]+)$', self._get_entry)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True     #headers and body are written separately
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _handle(self):
+                stub.handle(self)
+
+            do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+        self.httpd = ThreadingHTTPServer((bind, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    @property
+    def host(self) -> str:
+        return "{0}:{1}".format(self.httpd.server_address[0], self.port)
+
+    def add_route(self, method:str, pattern:str, handler:Callable):
+        """
+        Adds a route.  `handler(request, match, query, body)` is called with the BaseHTTPRequestHandler, the regex match
+        on the (unquoted) path, the parsed query string and the request body bytes.  It should return
+        (status, content) or (status, content, headers), where content is bytes, an iterator of byte chunks to stream
+        with chunked encoding, or something to encode as JSON.
+        Routes added later take priority.
+        """
+        self.routes.insert(0, (method, re.compile(pattern), handler))
+
+    def authenticate(self, request:BaseHTTPRequestHandler) -> bool:
+        headers = request.headers
+        auth = headers.get("Authorization")
+        if auth is None or headers.get("Date") is None or headers.get("X-Sha384-Checksum") is None:
+            return False
+        expected = calculate_hmac(self.secret, headers["Date"], headers.get("Content-Length", "0"), headers["X-Sha384-Checksum"],
+                                  request.command, request.path)
+        return hmac.compare_digest(expected, auth)
+
+    def handle(self, request:BaseHTTPRequestHandler):
+        length = int(request.headers.get("Content-Length", "0"))
+        body = request.rfile.read(length) if length>0 else b""
+        with self._lock:
+            self.request_count += 1
+
+        if not self.authenticate(request):
+            with self._lock:
+                self.auth_failures += 1
+            return self._respond(request, 403, {"status": "error", "detail": "hmac"})
+
+        if self.latency>0:
+            sleep(self.latency)
+        if self.error_rate>0:
+            with self._lock:
+                fail = self._random.random()<self.error_rate
+            if fail:
+                return self._respond(request, 503, {"status": "error", "detail": "stub server error"})
+
+        url_parts = urlparse(request.path)
+        path = unquote(url_parts.path)
+        query = parse_qs(url_parts.query)
+        for method, pattern, handler in self.routes:
+            if method==request.command:
+                match = pattern.match(path)
+                if match:
+                    try:
+                        result = handler(request, match, query, body)
+                    except Exception as e:
+                        logger.exception("Stub handler failed")
+                        result = (500, {"status": "error", "detail": str(e)})
+                    return self._respond(request, *result)
+        return self._respond(request, 404, {"status": "not_found", "detail": path})
+
+    def _respond(self, request:BaseHTTPRequestHandler, status:int, content, headers:Union[dict,None]=None):
+        response_headers = {}
+        if hasattr(content, "__next__"):
+            payload = None
+            response_headers["Content-Type"] = "application/x-ndjson"
+            response_headers["Transfer-Encoding"] = "chunked"
+        elif isinstance(content, bytes):
+            payload = content
+            response_headers["Content-Type"] = "application/octet-stream"
+        else:
+            payload = json.dumps(content).encode("UTF-8")
+            response_headers["Content-Type"] = "application/json"
+        if payload is not None:
+            response_headers["Content-Length"] = str(len(payload))
+        if headers:
+            response_headers.update(headers)
+
+        request.send_response(status)
+        for name, value in response_headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        if request.command=="HEAD":
+            return
+        if payload is not None:
+            request.wfile.write(payload)
+        else:
+            # an iterator of byte chunks is sent with chunked encoding, like the server's streamed responses
+            for chunk in content:
+                if len(chunk)>0:
+                    request.wfile.write("{0:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+            request.wfile.write(b"0\r\n\r\n")
+
+    def _search(self, text:Union[str,None], collection:Union[str,None]=None) -> list:
+        return [e for e in self.entries
+                if (collection is None or e["bucket"]==collection) and (not text or text in e["path"])]
+
+    def _browser_search(self, request, match, query, body):
+        try:
+            search_request = json.loads(body.decode("UTF-8")) if len(body)>0 else {}
+        except ValueError as e:
+            return 400, {"status": "bad_request", "detail": str(e)}
+        start = int(query.get("start", ["0"])[0])
+        size = int(query.get("size", ["100"])[0])
+        results = self._search(search_request.get("q"), search_request.get("collection"))
+        return 200, {"status": "ok", "entityClass": "entry", "entries": results[start:start+size], "entryCount": len(results)}
+
+    def _basic_search(self, request, match, query, body):
+        if "q" not in query:
+            return 400, {"status": "error", "detail": "you must specify a query string with ?q={string}"}
+        start = int(query.get("start", ["0"])[0])
+        length = int(query.get("length", ["50"])[0])
+        results = self._search(query["q"][0])
+        return 200, {"status": "ok", "entityClass": "entry", "entries": results[start:start+length], "entryCount": len(results)}
+
+    def _suggestions(self, request, match, query, body):
+        text = body.decode("UTF-8")
+        suggestions = sorted({e["path"].split("/")[0] for e in self.entries if text in e["path"]})[:10]
+        return 200, {"status": "ok", "suggestions": suggestions}
+
+    def _get_entry(self, request, match, query, body):
+        entry = self.entries_by_id.get(match.group(1))
+        if entry is None:
+            return 404, {"status": "not_found", "detail": match.group(1)}
+        return 200, {"status": "ok", "objectClass": "entry", "entry": entry}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Run a local HMAC-authenticated stand-in for the ArchiveHunter API")
+    parser.add_argument("--secret", dest="secret", required=True, help="shared secret that requests must be signed with")
+    parser.add_argument("--port", dest="port", type=int, default=9000, help="port to listen on")
+    parser.add_argument("--bind", dest="bind", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--entries", dest="entries", type=int, default=10000, help="number of entries to generate")
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=0, help="delay before answering each request")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0, help="fraction of requests to fail with a 503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    server = StubArchiveHunter(args.secret, args.entries, args.latency_ms/1000.0, args.error_rate, args.port, args.bind)
+    logger.info("Listening on http://{0}".format(server.host))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
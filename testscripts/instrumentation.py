@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Optional request timing and counters for the scripts in this directory.
+
+It is off unless a script calls `enable()`, usually through the --metrics-* options added by `add_arguments`.  When it
+is off, the hooks are a single `is None` check.  When it is on, it records:
+- a latency histogram for each endpoint, split by phase:
+  - "sign": building the HMAC headers
+  - "headers": sending the request and getting the response headers back, including any new connection and TLS setup
+  - "total": the whole call
+- request, error and retry counters
+- bytes sent and received
+- the number of connections each HTTP client has opened.  A count close to the number of requests means that
+  connections are not being reused, and TLS setup is being paid on every call.
+
+boto3 clients are instrumented through botocore's event hooks.  Each operation, such as "s3 ListObjectsV2" or
+"ecs DescribeTasks", is recorded as an endpoint, along with the retries that botocore made internally.
+
+A summary line is logged every --metrics-interval seconds.  At exit, the full set is written to --metrics-file in the
+Prometheus text format, or as JSON if the file name ends in .json.
+"""
+
+import atexit
+import json
+import logging
+import re
+import threading
+from time import monotonic, perf_counter
+from typing import Callable, Union
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, as for a Prometheus histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_active = None
+# set once from_args has enabled instrumentation, so that scripts run repeatedly in one process share one set of metrics
+_from_args = None
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0]*len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        for i, bound in enumerate(BUCKETS):
+            if value<=bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q:float) -> float:
+        """
+        estimates a quantile as the upper bound of the bucket that contains it
+        """
+        if self.count==0:
+            return 0.0
+        target = q*self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen>=target:
+                return bound
+        return BUCKETS[-1]
+
+
+class Metrics(object):
+    """
+    Thread-safe store of histograms and counters.  Everything is keyed by a tuple of label values, so that the output
+    can be labelled per endpoint.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}        # (endpoint, phase) -> Histogram
+        self.counters = {}          # name -> {labels tuple: count}
+        self.gauges = []            # (name, callable returning a number)
+        self.start_time = monotonic()
+
+    def observe(self, endpoint:str, phase:str, seconds:float):
+        with self._lock:
+            histogram = self.histograms.get((endpoint, phase))
+            if histogram is None:
+                histogram = self.histograms[(endpoint, phase)] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name:str, labels:tuple=(), value:int=1):
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[labels] = counter.get(labels, 0) + value
+
+    def add_gauge(self, name:str, read:Callable[[], float]):
+        with self._lock:
+            self.gauges.append((name, read))
+
+    def record_request(self, endpoint:str, status:Union[int,str], seconds:float, sent:int=0, received:int=0):
+        """
+        records a completed call; a status of 400 or more, or the name of an exception, counts as an error
+        """
+        self.observe(endpoint, "total", seconds)
+        self.count("requests_total", (endpoint, str(status)))
+        if not isinstance(status, int) or status>=400:
+            self.count("errors_total", (endpoint, str(status)))
+        if sent>0:
+            self.count("bytes_sent_total", (endpoint,), sent)
+        if received>0:
+            self.count("bytes_received_total", (endpoint,), received)
+
+    def total(self, name:str) -> int:
+        with self._lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def gauge_values(self) -> dict:
+        with self._lock:
+            gauges = list(self.gauges)
+        values = {}
+        for name, read in gauges:
+            try:
+                values[name] = values.get(name, 0) + read()
+            except Exception as e:
+                logger.debug("Could not read gauge {0}: {1}".format(name, e))
+        return values
+
+    def summary_line(self) -> str:
+        with self._lock:
+            totals = [(endpoint, h) for (endpoint, phase), h in self.histograms.items() if phase=="total"]
+        requests = sum(h.count for _, h in totals)
+        elapsed = max(monotonic() - self.start_time, 0.001)
+        line = "{0} requests in {1:.0f}s ({2:.1f}/s), {3} errors, {4} retries, {5:.1f}MB sent, {6:.1f}MB received".format(
+            requests, elapsed, requests/elapsed, self.total("errors_total"), self.total("retries_total"),
+            self.total("bytes_sent_total")/1e6, self.total("bytes_received_total")/1e6)
+        for name, value in sorted(self.gauge_values().items()):
+            line += ", {0} {1}".format(value, name.replace("_", " "))
+        if len(totals)>0:
+            endpoint, slowest = max(totals, key=lambda t: t[1].total)
+            line += "; most time in {0}: {1} calls, p50<={2}s p95<={3}s".format(endpoint, slowest.count, slowest.quantile(0.5), slowest.quantile(0.95))
+        return line
+
+    def to_json(self) -> dict:
+        with self._lock:
+            histograms = [{"endpoint": e, "phase": p, "count": h.count, "sum": h.total,
+                           "buckets": {format_bound(b): n for b, n in zip(BUCKETS, h.counts)}}
+                          for (e, p), h in sorted(self.histograms.items())]
+            counters = {name: [{"labels": list(labels), "value": v} for labels, v in sorted(values.items())]
+                        for name, values in sorted(self.counters.items())}
+        return {"elapsed": monotonic() - self.start_time, "histograms": histograms, "counters": counters, "gauges": self.gauge_values()}
+
+    def to_prometheus(self, prefix:str="archivehunter_tools") -> str:
+        label_names = {
+            "requests_total": ("endpoint", "status"),
+            "errors_total": ("endpoint", "error"),
+            "retries_total": ("reason",),
+            "bytes_sent_total": ("endpoint",),
+            "bytes_received_total": ("endpoint",),
+        }
+        lines = ["# TYPE {0}_request_duration_seconds histogram".format(prefix)]
+        with self._lock:
+            for (endpoint, phase), h in sorted(self.histograms.items()):
+                labels = 'endpoint="{0}",phase="{1}"'.format(escape_label(endpoint), phase)
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append('{0}_request_duration_seconds_bucket{{{1},le="{2}"}} {3}'.format(prefix, labels, format_bound(bound), cumulative))
+                lines.append("{0}_request_duration_seconds_sum{{{1}}} {2}".format(prefix, labels, h.total))
+                lines.append("{0}_request_duration_seconds_count{{{1}}} {2}".format(prefix, labels, h.count))
+            for name, values in sorted(self.counters.items()):
+                names = label_names.get(name, tuple("label{0}".format(i) for i in range(len(next(iter(values), ())))))
+                lines.append("# TYPE {0}_{1} counter".format(prefix, name))
+                for labels, value in sorted(values.items()):
+                    label_text = ",".join('{0}="{1}"'.format(n, escape_label(v)) for n, v in zip(names, labels))
+                    lines.append("{0}_{1}{{{2}}} {3}".format(prefix, name, label_text, value))
+        for name, value in sorted(self.gauge_values().items()):
+            lines.append("# TYPE {0}_{1} gauge".format(prefix, name))
+            lines.append("{0}_{1} {2}".format(prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path:str):
+        with open(path, "w") as f:
+            if path.endswith(".json"):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+
+def format_bound(bound:float) -> str:
+    return "+Inf" if bound==float("inf") else repr(bound)
+
+
+def escape_label(value:str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# path segments that are IDs or other values rather than part of the route, so that they don't each get a histogram
+PARAMETER_SEGMENT = re.compile(r'.*[0-9%=+].*|.{25,}')
+
+
+def endpoint_name(method:str, url:str) -> str:
+    """
+    A low-cardinality name for a request, e.g. "GET /api/entry/:id".  Requests to other hosts, such as presigned S3
+    links, are named by host only.
+    """
+    parsed = urlparse(url)
+    if parsed.query and any(k in parsed.query for k in ("X-Amz-Signature", "Signature=")):
+        return "{0} {1}".format(method, parsed.netloc)
+    segments = [":id" if PARAMETER_SEGMENT.match(s) else s for s in parsed.path.split("/")]
+    return "{0} {1}".format(method, "/".join(segments))
+
+
+def active() -> Union[Metrics,None]:
+    """
+    the Metrics being recorded to, or None if instrumentation is off
+    """
+    return _active
+
+
+def enable(metrics:Union[Metrics,None]=None) -> Metrics:
+    global _active
+    _active = metrics or Metrics()
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def instrument_boto3(client, metrics:Union[Metrics,None]=None):
+    """
+    Records every call made by a boto3 client (or every client made from a boto3 Session, if given a Session).  Does
+    nothing if instrumentation is off.
+    :return: the client, for chaining
+    """
+    metrics = metrics or _active
+    if metrics is None:
+        return client
+    events = client.meta.events if hasattr(client, "meta") else client.events
+    calls = threading.local()
+
+    def endpoint(event_name):
+        # event names are "<event>.<service>.<operation>"
+        _, service, operation = event_name.split(".", 2)
+        return "{0} {1}".format(service, operation)
+
+    def before_call(context, **kwargs):
+        context["instrumentation_start"] = perf_counter()
+
+    def before_send(request, **kwargs):
+        # streamed uploads are chunk-encoded, with the real size in a header of its own
+        length = request.headers.get("X-Amz-Decoded-Content-Length") or request.headers.get("Content-Length")
+        if length is not None:
+            calls.sent = int(length)
+        else:
+            calls.sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+
+    def after_call(http_response, parsed, context, event_name, **kwargs):
+        started = context.get("instrumentation_start")
+        if started is None:
+            return
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries>0:
+            metrics.count("retries_total", ("{0} {1}".format(endpoint(event_name), http_response.status_code),), retries)
+        received = len(http_response.content) if http_response.content else 0
+        metrics.record_request(endpoint(event_name), http_response.status_code, perf_counter() - started, getattr(calls, "sent", 0), received)
+
+    def after_call_error(exception, context, event_name, **kwargs):
+        started = context.get("instrumentation_start")
+        if started is not None:
+            metrics.record_request(endpoint(event_name), type(exception).__name__, perf_counter() - started)
+
+    events.register("before-call.*.*", before_call)
+    events.register("before-send.*.*", before_send)
+    events.register("after-call.*.*", after_call)
+    events.register("after-call-error.*.*", after_call_error)
+    return client
+
+
+class Reporter(object):
+    """
+    Logs the summary line every `interval` seconds from a daemon thread
+    """
+    def __init__(self, metrics:Metrics, interval:float):
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logger.info("Metrics: " + self.metrics.summary_line())
+
+    def stop(self):
+        self._stop.set()
+
+
+def add_arguments(parser):
+    """
+    adds the --metrics-* options to an ArgumentParser, or an OptionParser for the older scripts
+    """
+    add = parser.add_argument if hasattr(parser, "add_argument") else parser.add_option
+    float_type = float if hasattr(parser, "add_argument") else "float"
+    add("--metrics-file", dest="metrics_file", help="record request timings and write them here at exit, in Prometheus text format or as JSON if the name ends in .json")
+    add("--metrics-interval", dest="metrics_interval", type=float_type, default=0, help="also log a summary of the request timings this often, in seconds")
+
+
+def from_args(args) -> Union[Metrics,None]:
+    """
+    enables instrumentation if the --metrics-* options ask for it, logging the final summary and writing the file at exit
+    """
+    global _from_args
+    if not args.metrics_file and not args.metrics_interval:
+        return None
+    if _from_args is not None:
+        return _from_args
+    metrics = _from_args = enable()
+    logger.setLevel(logging.INFO)
+    reporter = Reporter(metrics, args.metrics_interval).start() if args.metrics_interval else None
+
+    def finish():
+        if reporter:
+            reporter.stop()
+        logger.info("Metrics: " + metrics.summary_line())
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            logger.info("Wrote metrics to {0}".format(args.metrics_file))
+    atexit.register(finish)
+    return metrics
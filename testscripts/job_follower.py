@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Follows the ArchiveHunter job table and re-runs failed proxy jobs.
+
+Each run reads only the jobs that started since the previous one, keeps a compact local SQLite table of them and sends
+PUT /api/job/rerunproxy/:jobId for the failed ones, de-duplicated and rate-limited.  After a transcoder outage, running
+this every few minutes re-queues the failures without anyone paging through the jobs list.
+
+The feed comes from PUT /api/job/search with a jobStatus and a startingTime.  That is a query on the jobStatusIndex,
+whose range key is startedAt, so the results come back in start order and the newest startedAt seen becomes the
+cursor for the next page and the next run.  GET /api/job/all can't be used for this: the server ignores its scanFrom
+parameter and always scans from the beginning of the table.  The search endpoint's limit parameter is spelt `linit`
+in the routes file, so that is what is sent.
+
+A job that is re-run keeps its jobId, startedAt and (until the transcoder reports back) its ST_ERROR status, so:
+ - each run re-reads an --overlap window before the cursor, to pick up jobs that failed a while after starting;
+ - a job is only re-run again once it has failed again, i.e. its completedAt is later than our last re-run of it, and
+   never more than --max-attempts times;
+ - --recheck looks up the jobs re-run by earlier runs whose outcome hasn't been seen yet via GET /api/job/:jobId, since
+   their startedAt will have fallen behind the cursor.
+
+--refresh also asks the server to refresh the transcode status of each failed job before deciding to re-run it.  The
+server currently answers that with 500 not_implemented, in which case refreshing is switched off for the rest of the run.
+"""
+
+import json
+import logging
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from time import time
+from typing import Iterable, Union
+from urllib.parse import quote
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST, parse_zoned_datetime
+from bulk_runner import TokenBucket, request_with_backoff, run_bulk
+from snapshot_store import format_timestamp
+
+logger = logging.getLogger(__name__)
+
+FAILED = "ST_ERROR"
+JOB_STATUSES = ["ST_PENDING", "ST_RUNNING", "ST_SUCCESS", "ST_ERROR", "ST_CANCELLED", "ST_WARNING"]
+# the job types that ProxyGenerators creates with transcode info, so can be re-run
+RERUNNABLE_TYPES = ["proxy", "thumbnail", "analyse"]
+
+
+class JobFeedError(Exception):
+    pass
+
+
+def timestamp(value:Union[str,None]) -> Union[float,None]:
+    return parse_zoned_datetime(value).timestamp() if value else None
+
+
+class JobTable(object):
+    """
+    SQLite table of the jobs seen in the feed, with what we have done about each, plus the feed cursors.  Only the
+    fields needed to decide on a re-run are kept, not the job logs.
+    """
+    COLUMNS = ["job_id", "job_type", "source_id", "status", "started_at", "failed_at", "has_transcode", "seen_at"]
+
+    def __init__(self, path:str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, job_type TEXT, source_id TEXT, "
+                          "status TEXT NOT NULL, started_at REAL, failed_at REAL, has_transcode INTEGER NOT NULL, "
+                          "seen_at REAL NOT NULL, reruns INTEGER NOT NULL DEFAULT 0, last_rerun REAL, last_result TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, job_type)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cursors (feed TEXT PRIMARY KEY, started_at REAL NOT NULL)")
+        self.conn.commit()
+
+    @staticmethod
+    def row(job:dict, seen_at:float) -> tuple:
+        return (job["jobId"], job.get("jobType"), job.get("sourceId"), job["jobStatus"], timestamp(job.get("startedAt")),
+                timestamp(job.get("completedAt") or job.get("lastUpdatedTS")), 1 if job.get("transcodeInfo") else 0, seen_at)
+
+    def upsert(self, jobs:Iterable[dict], seen_at:float) -> int:
+        """
+        records the current state of each job, keeping what we know about our re-runs of it
+        :return: the number of jobs that were new or had changed status
+        """
+        changed = 0
+        for job in jobs:
+            existing = self.conn.execute("SELECT status FROM jobs WHERE job_id=?", (job["jobId"],)).fetchone()
+            if existing is None or existing[0]!=job["jobStatus"]:
+                changed += 1
+            self.conn.execute("INSERT INTO jobs ({0}) VALUES ({1}) ON CONFLICT(job_id) DO UPDATE SET "
+                              "job_type=excluded.job_type, source_id=excluded.source_id, status=excluded.status, "
+                              "started_at=excluded.started_at, failed_at=excluded.failed_at, "
+                              "has_transcode=excluded.has_transcode, seen_at=excluded.seen_at"
+                              .format(",".join(self.COLUMNS), ",".join("?"*len(self.COLUMNS))), self.row(job, seen_at))
+        return changed
+
+    def forget(self, job_id:str):
+        self.conn.execute("DELETE FROM jobs WHERE job_id=?", (job_id,))
+
+    def cursor(self, feed:str) -> Union[float,None]:
+        row = self.conn.execute("SELECT started_at FROM cursors WHERE feed=?", (feed,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, feed:str, started_at:float):
+        self.conn.execute("INSERT OR REPLACE INTO cursors (feed, started_at) VALUES (?, ?)", (feed, started_at))
+        self.conn.commit()
+
+    def rerun_candidates(self, types:Iterable[str], max_attempts:int, limit:int=0) -> list:
+        """
+        failed jobs that can be re-run and that have not already been re-run since they last failed, oldest first
+        """
+        types = list(types)
+        sql = ("SELECT job_id FROM jobs WHERE status=? AND job_type IN ({0}) AND has_transcode=1 AND reruns<? "
+               "AND (last_rerun IS NULL OR failed_at>last_rerun) ORDER BY started_at".format(",".join("?"*len(types))))
+        if limit>0:
+            sql += " LIMIT {0}".format(int(limit))
+        return [r[0] for r in self.conn.execute(sql, [FAILED] + types + [max_attempts])]
+
+    def unresolved_reruns(self, since:float) -> list:
+        """
+        jobs re-run after `since` that we haven't seen the outcome of yet
+        """
+        return [r[0] for r in self.conn.execute("SELECT job_id FROM jobs WHERE status=? AND last_rerun>? AND "
+                                                "(failed_at IS NULL OR failed_at<=last_rerun)", (FAILED, since))]
+
+    def record_rerun(self, job_id:str, at:float, result:str):
+        self.conn.execute("UPDATE jobs SET reruns=reruns+1, last_rerun=?, last_result=? WHERE job_id=?", (at, result, job_id))
+
+    def status_counts(self) -> dict:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def search_jobs(client:ArchiveHunterClient, status:str, since:Union[float,None], limit:int, retries:int=3) -> list:
+    body = {"jobStatus": status}
+    if since is not None:
+        body["startingTime"] = format_timestamp(since)
+    response = request_with_backoff(lambda: client.put("/api/job/search?linit={0}".format(limit), body), max_retries=retries)
+    if response.status_code!=200:
+        raise JobFeedError("Job search failed, server returned {0}: {1}".format(response.status_code, response.text[:512]))
+    return response.json()["entries"]
+
+
+def follow(client:ArchiveHunterClient, table:JobTable, status:str=FAILED, page_size:int=500, overlap:float=3600,
+           retries:int=3) -> (int, int):
+    """
+    Reads the jobs with `status` that started since the stored cursor (less `overlap` seconds) into the table, advancing
+    the cursor after every page.
+    :return: (jobs read, jobs new or changed)
+    """
+    cursor = table.cursor(status)
+    since = cursor - overlap if cursor is not None else None
+    read = changed = 0
+    while True:
+        jobs = search_jobs(client, status, since, page_size, retries)
+        changed += table.upsert(jobs, time())
+        read += len(jobs)
+        started = [t for t in (timestamp(j.get("startedAt")) for j in jobs) if t is not None]
+        newest = max(started) if len(started)>0 else None
+        if newest is not None and (cursor is None or newest>cursor):
+            cursor = newest
+            table.set_cursor(status, cursor)
+        else:
+            table.commit()
+        if len(jobs)<page_size:
+            return read, changed
+        if since is not None and newest<=since:
+            # a whole page started at the same moment, so starting the next page from it would return the same page
+            raise JobFeedError("More than {0} {1} jobs started at {2}, use a bigger --page-size".format(page_size, status, format_timestamp(since)))
+        since = newest
+
+
+def send_to_jobs(client:ArchiveHunterClient, job_ids:Iterable[str], uri_template:str, limiter:TokenBucket,
+                 concurrency:int=4, retries:int=5):
+    """
+    PUTs to `uri_template` for each job, yielding (job_id, response, error) as they complete
+    """
+    def send(job_id):
+        uri = uri_template.format(quote(job_id, safe=""))
+        return request_with_backoff(lambda: client.put(uri), limiter, max_retries=retries)
+    return run_bulk(job_ids, send, concurrency)
+
+
+def refresh_failed(client:ArchiveHunterClient, job_ids:list, limiter:TokenBucket, concurrency:int=4, retries:int=5) -> bool:
+    """
+    asks the server to refresh the transcode status of each job
+    :return: False if the server doesn't implement refreshing, True otherwise
+    """
+    supported = True
+    for job_id, response, error in send_to_jobs(client, job_ids, "/api/job/transcode/{0}/refresh", limiter, concurrency, retries):
+        if error:
+            logger.warning("Could not refresh {0}: {1}".format(job_id, error))
+        elif response.status_code==500 and "not_implemented" in response.text:
+            supported = False
+        elif response.status_code!=200:
+            logger.warning("Could not refresh {0}: server returned {1} {2}".format(job_id, response.status_code, response.text[:512]))
+    if not supported:
+        logger.warning("The server does not implement refreshing transcode status, not refreshing any more")
+    return supported
+
+
+def fetch_job(client:ArchiveHunterClient, job_id:str, retries:int=3) -> Union[dict,None]:
+    response = request_with_backoff(lambda: client.get("/api/job/{0}".format(quote(job_id, safe=""))), max_retries=retries)
+    if response.status_code==404:
+        return None
+    if response.status_code!=200:
+        raise JobFeedError("Could not look up job {0}, server returned {1}: {2}".format(job_id, response.status_code, response.text[:512]))
+    return response.json()["entry"]
+
+
+def recheck(client:ArchiveHunterClient, table:JobTable, since:float, concurrency:int=4, retries:int=3) -> int:
+    """
+    looks up the current state of the jobs re-run after `since` whose outcome we haven't seen.  Jobs that no longer exist
+    are dropped; the server deletes a proxy job when it finds nothing to proxy.
+    :return: the number of jobs looked up
+    """
+    job_ids = table.unresolved_reruns(since)
+    now = time()
+    for job_id, job, error in run_bulk(job_ids, lambda j: fetch_job(client, j, retries), concurrency):
+        if error:
+            logger.warning(str(error))
+        elif job is None:
+            table.forget(job_id)
+        else:
+            table.upsert([job], now)
+    table.commit()
+    return len(job_ids)
+
+
+def rerun_failed(client:ArchiveHunterClient, table:JobTable, limiter:TokenBucket, types:Iterable[str]=RERUNNABLE_TYPES,
+                 max_attempts:int=3, limit:int=0, concurrency:int=4, retries:int=5, refresh:bool=False,
+                 batch_size:int=100, dry_run_out=None) -> dict:
+    """
+    Re-runs the failed jobs in the table that are due one, in batches of `batch_size`, committing the outcome of each
+    batch before starting the next.
+    :param limit: re-run at most this many jobs. 0 for no limit
+    :param dry_run_out: if given, the job IDs that would be re-run are written here and nothing is sent
+    :return: counts of the jobs "requested" and "failed"
+    """
+    counts = {"requested": 0, "failed": 0}
+    candidates = table.rerun_candidates(types, max_attempts, limit)
+    if dry_run_out:
+        for job_id in candidates:
+            dry_run_out.write(job_id + "\n")
+        counts["requested"] = len(candidates)
+        return counts
+
+    for i in range(0, len(candidates), batch_size):
+        batch = candidates[i:i+batch_size]
+        if refresh:
+            refresh = refresh_failed(client, batch, limiter, concurrency, retries)
+            table.commit()
+        for job_id, response, error in send_to_jobs(client, batch, "/api/job/rerunproxy/{0}", limiter, concurrency, retries):
+            if error:
+                counts["failed"] += 1
+                table.record_rerun(job_id, time(), str(error)[:512])
+            elif response.status_code==200:
+                counts["requested"] += 1
+                table.record_rerun(job_id, time(), "ok")
+            else:
+                counts["failed"] += 1
+                logger.debug("{0}: server returned {1} {2}".format(job_id, response.status_code, response.text[:512]))
+                table.record_rerun(job_id, time(), "{0} {1}".format(response.status_code, response.text[:512]))
+        table.commit()
+        logger.info("Re-ran {0} of {1} failed jobs, {2} refused".format(counts["requested"], len(candidates), counts["failed"]))
+    return counts
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Follow the ArchiveHunter job feed and re-run failed proxy jobs")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("--db", dest="db", default="jobs.db", help="SQLite file for the local job table and feed cursor")
+    parser.add_argument("--status", dest="statuses", action="append", choices=JOB_STATUSES, help="job status to follow. Can be given more than once. Defaults to " + FAILED)
+    parser.add_argument("--page-size", dest="page_size", type=int, default=500, help="number of jobs to ask for at once")
+    parser.add_argument("--overlap", dest="overlap", type=float, default=3600, help="seconds before the cursor to read again, for jobs that failed some time after starting")
+    parser.add_argument("--types", dest="types", default=",".join(RERUNNABLE_TYPES), help="comma-separated job types to re-run")
+    parser.add_argument("--max-attempts", dest="max_attempts", type=int, default=3, help="number of times to re-run a job before giving up on it")
+    parser.add_argument("--limit", dest="limit", type=int, default=0, help="re-run at most this many jobs this run. 0 for no limit")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=100, help="number of re-runs to send between saving progress")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=4, help="number of requests in flight at once")
+    parser.add_argument("--rate", dest="rate", type=float, default=2, help="maximum re-run requests per second. 0 for no limit")
+    parser.add_argument("--retries", dest="retries", type=int, default=5, help="number of times to retry a request that was throttled")
+    parser.add_argument("--recheck", dest="recheck_hours", type=float, default=0, help="look up the outcome of jobs re-run in this many past hours before re-running more")
+    parser.add_argument("--refresh", dest="refresh", action="store_true", default=False, help="ask the server to refresh each failed job's transcode status before re-running it")
+    parser.add_argument("--no-rerun", dest="no_rerun", action="store_true", default=False, help="only update the job table")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", default=False, help="print the IDs of the jobs that would be re-run instead of re-running them")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency)
+    table = JobTable(args.db)
+    try:
+        for status in args.statuses or [FAILED]:
+            read, changed = follow(client, table, status, args.page_size, args.overlap, args.retries)
+            logger.info("{0}: read {1} jobs, {2} new or changed".format(status, read, changed))
+        if args.recheck_hours>0:
+            checked = recheck(client, table, time() - args.recheck_hours*3600, args.concurrency, args.retries)
+            logger.info("Looked up {0} re-run jobs".format(checked))
+        counts = {"requested": 0, "failed": 0}
+        if not args.no_rerun:
+            types = [t.strip() for t in args.types.split(",") if t.strip()!=""]
+            counts = rerun_failed(client, table, TokenBucket(args.rate), types, args.max_attempts, args.limit,
+                                  args.concurrency, args.retries, args.refresh, args.batch_size,
+                                  dry_run_out=sys.stdout if args.dry_run else None)
+        counts["jobs"] = table.status_counts()
+    finally:
+        table.close()
+
+    sys.stderr.write(json.dumps(counts) + "\n")
+    if counts["failed"]>0:
+        exit(1)
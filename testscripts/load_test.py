@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"""
+Load test for the search APIs.  Drives a weighted mix of requests against a server, either from a fixed number of
+concurrent workers (closed loop) or at a target rate (open loop), and reports latency percentiles, throughput and
+error rates overall and per endpoint.
+
+Results can be written as JSON and compared against an earlier run with --baseline, which exits non-zero if latency,
+throughput or error rate have got worse by more than --tolerance.
+
+In --rate mode the latency of each request is measured from when it was due to start rather than when a worker
+picked it up, so a server that can't keep up shows as increased latency instead of quietly reducing the load.
+
+To try it out without a server, run hmac_stub_server.py and point --host at it with --http.
+"""
+
+import json
+import logging
+import random
+import sys
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from typing import Union
+from urllib.parse import quote
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = ["browser", "basic", "suggestions", "entry"]
+DEFAULT_MIX = "browser=4,basic=3,suggestions=1,entry=2"
+
+
+def parse_mix(spec:str) -> dict:
+    """
+    Parses a request mix such as "browser=4,entry=1" into a dict of endpoint name -> weight
+    :raises ValueError: if the spec is not valid
+    """
+    mix = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if part=="":
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError("Unknown endpoint {0}, expected one of {1}".format(name, ", ".join(ENDPOINTS)))
+        mix[name] = float(weight) if weight else 1.0
+        if mix[name]<0:
+            raise ValueError("Weight for {0} must not be negative".format(name))
+    if sum(mix.values())<=0:
+        raise ValueError("Request mix must have at least one endpoint with a positive weight")
+    return mix
+
+
+class RequestMix(object):
+    """
+    Generates requests in proportion to the given weights.
+    :param weights: endpoint name -> relative weight
+    :param terms: search terms for the basic, browser and suggestions searches
+    :param entry_ids: IDs to look up with /api/entry
+    :param collection: collection to restrict browser searches to, if any
+    :param page_size: page size for the searches
+    :param max_offset: browser searches start at a random page offset below this, to avoid only hitting the first page
+    """
+    def __init__(self, weights:dict, terms:list, entry_ids:list, collection:Union[str,None]=None, page_size:int=50,
+                 max_offset:int=0, seed:Union[int,None]=None):
+        if weights.get("entry") and len(entry_ids)==0:
+            raise ValueError("The request mix includes entry lookups but there are no entry IDs to look up")
+        if any(weights.get(n) for n in ("basic", "suggestions")) and len(terms)==0:
+            raise ValueError("The request mix includes text searches but there are no search terms")
+        self.names = [n for n in weights if weights[n]>0]
+        self.weights = [weights[n] for n in self.names]
+        self.terms = terms
+        self.entry_ids = entry_ids
+        self.collection = collection
+        self.page_size = page_size
+        self.max_offset = max_offset
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next(self) -> (str, str, str, Union[bytes,dict,None], Union[dict,None]):
+        """
+        :return: tuple of (endpoint name, method, path, body, extra headers)
+        """
+        with self._lock:
+            name = self._random.choices(self.names, self.weights)[0]
+            term = self._random.choice(self.terms) if len(self.terms)>0 else None
+            entry_id = self._random.choice(self.entry_ids) if len(self.entry_ids)>0 else None
+            offset = self._random.randrange(0, self.max_offset, self.page_size) if self.max_offset>0 else 0
+
+        if name=="browser":
+            body = {"hideDotFiles": True}
+            if self.collection:
+                body["collection"] = self.collection
+            if term:
+                body["q"] = term
+            return name, "POST", "/api/search/browser?start={0}&size={1}".format(offset, self.page_size), body, None
+        elif name=="basic":
+            return name, "GET", "/api/search/basic?q={0}&start=0&length={1}".format(quote(term, safe=""), self.page_size), None, None
+        elif name=="suggestions":
+            return name, "PUT", "/api/search/suggestions", term.encode("UTF-8"), {"Content-Type": "text/plain"}
+        else:
+            return name, "GET", "/api/entry/{0}".format(quote(entry_id, safe="")), None, None
+
+
+class LoadResults(object):
+    """
+    Latency and outcome counts for a run, overall and per endpoint
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.overall = LatencyStats()
+        self.endpoints = {}
+        self.outcomes = {}
+
+    def record(self, name:str, latency:float, outcome:Union[int,str]):
+        """
+        :param outcome: HTTP status code, or a short description of the error if there was no response
+        """
+        ok = outcome==200
+        with self._lock:
+            stats = self.endpoints.get(name)
+            if stats is None:
+                stats = LatencyStats()
+                stats.start_time = self.overall.start_time
+                self.endpoints[name] = stats
+                self.outcomes[name] = {}
+            counts = self.outcomes[name]
+            counts[str(outcome)] = counts.get(str(outcome), 0) + 1
+        stats.record(latency, ok)
+        self.overall.record(latency, ok)
+
+    @staticmethod
+    def _summary(stats:LatencyStats) -> dict:
+        summary = stats.summary()
+        summary["error_rate"] = summary["failed"]/summary["requests"] if summary["requests"]>0 else 0.0
+        return summary
+
+    def summary(self) -> dict:
+        endpoints = {}
+        for name in sorted(self.endpoints):
+            endpoints[name] = self._summary(self.endpoints[name])
+            endpoints[name]["outcomes"] = dict(self.outcomes[name])
+        return {"overall": self._summary(self.overall), "endpoints": endpoints}
+
+
+def timed_request(client:ArchiveHunterClient, mix:RequestMix, results:LoadResults, due:Union[float,None]=None):
+    name, method, path, body, headers = mix.next()
+    start = monotonic() if due is None else due
+    try:
+        response = client.request(method, path, body=body, headers=headers)
+        response.content    #make sure the whole body has been read before stopping the clock
+        outcome = response.status_code
+    except IOError as e:
+        outcome = type(e).__name__
+    results.record(name, monotonic() - start, outcome)
+
+
+def run_closed_loop(client:ArchiveHunterClient, mix:RequestMix, concurrency:int, duration:Union[float,None]=None,
+                    max_requests:Union[int,None]=None) -> LoadResults:
+    """
+    Runs `concurrency` workers that each make one request after another, until `duration` seconds have passed or
+    `max_requests` have been made
+    """
+    results = LoadResults()
+    deadline = monotonic() + duration if duration else None
+    remaining = [max_requests]
+    lock = threading.Lock()
+
+    def take() -> bool:
+        if deadline is not None and monotonic()>=deadline:
+            return False
+        if max_requests is None:
+            return True
+        with lock:
+            if remaining[0]<=0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def worker():
+        while take():
+            timed_request(client, mix, results)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def run_open_loop(client:ArchiveHunterClient, mix:RequestMix, rate:float, concurrency:int, duration:Union[float,None]=None,
+                  max_requests:Union[int,None]=None) -> LoadResults:
+    """
+    Starts requests at `rate` per second, using up to `concurrency` connections, until `duration` seconds have passed or
+    `max_requests` have been started.  If the server falls behind, requests queue up (up to a bound) and their wait is
+    counted in their latency.
+    """
+    results = LoadResults()
+    interval = 1.0/rate
+    start = monotonic()
+    deadline = start + duration if duration else None
+    slots = threading.BoundedSemaphore(concurrency*4)
+
+    def run(due):
+        try:
+            timed_request(client, mix, results, due)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        count = 0
+        while max_requests is None or count<max_requests:
+            due = start + count*interval
+            if deadline is not None and due>=deadline:
+                break
+            delay = due - monotonic()
+            if delay>0:
+                sleep(delay)
+            slots.acquire()
+            executor.submit(run, due)
+            count += 1
+    return results
+
+
+def discover_targets(client:ArchiveHunterClient, collection:Union[str,None], count:int=200) -> (list, list):
+    """
+    Picks entry IDs and search terms from the first page of a browser search, for when they aren't given
+    :return: tuple of (entry IDs, search terms)
+    """
+    body = {"collection": collection} if collection else {}
+    response = client.post("/api/search/browser?start=0&size={0}".format(count), body=body)
+    if response.status_code!=200:
+        raise RuntimeError("Could not find entries to test with, server returned {0}: {1}".format(response.status_code, response.text))
+    entries = response.json()["entries"]
+    terms = sorted({e["path"].split("/")[0] for e in entries if "/" in e["path"]})
+    return [e["id"] for e in entries], terms
+
+
+def compare_runs(baseline:dict, current:dict, tolerance:float=0.1) -> list:
+    """
+    Compares two run summaries.
+    :param tolerance: fractional increase in latency or decrease in throughput that is allowed
+    :return: list of descriptions of regressions; empty if there are none
+    """
+    regressions = []
+
+    def check(label, base, cur):
+        for key in ("p50", "p95", "p99"):
+            if base[key]>0 and cur[key]>base[key]*(1+tolerance):
+                regressions.append("{0} {1} latency went from {2:.3f}s to {3:.3f}s".format(label, key, base[key], cur[key]))
+        if cur["error_rate"]>base["error_rate"] + 0.01:
+            regressions.append("{0} error rate went from {1:.1%} to {2:.1%}".format(label, base["error_rate"], cur["error_rate"]))
+
+    check("overall", baseline["overall"], current["overall"])
+    if current["overall"]["per_second"]<baseline["overall"]["per_second"]*(1-tolerance):
+        regressions.append("throughput went from {0:.1f}/s to {1:.1f}/s".format(baseline["overall"]["per_second"],
+                                                                                 current["overall"]["per_second"]))
+    for name, stats in current["endpoints"].items():
+        if name in baseline["endpoints"]:
+            check(name, baseline["endpoints"][name], stats)
+    return regressions
+
+
+def format_report(summary:dict) -> str:
+    lines = ["{0:<12} {1:>8} {2:>7} {3:>9} {4:>8} {5:>8} {6:>8} {7:>8}".format("endpoint", "requests", "errors", "req/s", "p50", "p95", "p99", "max")]
+    rows = [("overall", summary["overall"])] + list(summary["endpoints"].items())
+    for name, s in rows:
+        lines.append("{0:<12} {1:>8} {2:>7.1%} {3:>9.1f} {4:>8.3f} {5:>8.3f} {6:>8.3f} {7:>8.3f}".format(
+            name, s["requests"], s["error_rate"], s["per_second"], s["p50"], s["p95"], s["p99"], s["max"]))
+    return "\n".join(lines)
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Load test the ArchiveHunter search APIs")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--http", dest="http", action="store_true", default=False, help="use plain http, e.g. for hmac_stub_server.py")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("--mix", dest="mix", default=DEFAULT_MIX, help="weighted request mix, from endpoints " + ", ".join(ENDPOINTS))
+    parser.add_argument("-c", "--collection", dest="collection", help="restrict browser searches to this collection")
+    parser.add_argument("--terms", dest="terms", help="file of search terms, one per line. Taken from a sample of entries if not given")
+    parser.add_argument("--entry-ids", dest="entry_ids", help="file of entry IDs, one per line. Taken from a sample of entries if not given")
+    parser.add_argument("--page-size", dest="page_size", type=int, default=50, help="page size for searches")
+    parser.add_argument("--max-offset", dest="max_offset", type=int, default=0, help="spread browser searches over pages below this offset")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=8, help="number of requests in flight at once")
+    parser.add_argument("--rate", dest="rate", type=float, help="start requests at this many per second instead of as fast as the workers allow")
+    parser.add_argument("--duration", dest="duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("-n", "--requests", dest="requests", type=int, help="stop after this many requests")
+    parser.add_argument("--seed", dest="seed", type=int, help="random seed, for a repeatable sequence of requests")
+    parser.add_argument("--output", dest="output", help="write the results to this file as JSON")
+    parser.add_argument("--baseline", dest="baseline", help="compare with the JSON results of an earlier run")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.1, help="fractional slow-down allowed when comparing with --baseline")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        print(str(e))
+        exit(1)
+
+    client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency, scheme="http" if args.http else "https")
+    entry_ids = [line.strip() for line in open(args.entry_ids) if line.strip()!=""] if args.entry_ids else []
+    terms = [line.strip() for line in open(args.terms) if line.strip()!=""] if args.terms else []
+    if len(entry_ids)==0 or len(terms)==0:
+        sampled_ids, sampled_terms = discover_targets(client, args.collection)
+        entry_ids = entry_ids or sampled_ids
+        terms = terms or sampled_terms
+    mix = RequestMix(weights, terms, entry_ids, args.collection, args.page_size, args.max_offset, args.seed)
+
+    started = datetime.now(timezone.utc).isoformat()
+    if args.rate:
+        results = run_open_loop(client, mix, args.rate, args.concurrency, args.duration, args.requests)
+    else:
+        results = run_closed_loop(client, mix, args.concurrency, args.duration, args.requests)
+
+    summary = results.summary()
+    summary["started"] = started
+    summary["config"] = {"host": args.host, "mix": weights, "collection": args.collection, "concurrency": args.concurrency,
+                         "rate": args.rate, "duration": args.duration, "requests": args.requests, "page_size": args.page_size}
+    print(format_report(summary))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_runs(json.load(f), summary, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        exit(1 if len(regressions)>0 else 0)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Requests regeneration of every missing proxy listed in the proxy-health problem items index.
+
+Collections come from /api/proxyhealth/problemitems/collectionlist (or --collection), and their problem items are paged
+from /api/proxyhealth/problemitems concurrently, across and within collections.  For each item, every proxy type that
+is wanted but not present is requested the same way the server's own ProblemItemReproxySink does it:
+POST /api/proxy/generate/:id/thumbnail for thumbnails and POST /api/proxy/generate/:id/:type for video and audio.
+Requests are de-duplicated, rate-limited and optionally journalled so that a re-run only sends what is left.
+
+Note that the collection list is a terms aggregation, so the server only returns the ten collections with the most
+problem items; use --collection to add others.  The index also can't be paged past its result window (10,000 items by
+default), so for bigger collections the sweep stops at that point with a warning.  Run it again after the next
+ProxyStatsGathering run has removed the fixed items from the index.
+"""
+
+import json
+import logging
+import sys
+import threading
+from argparse import ArgumentParser
+from time import monotonic
+from typing import Iterable, Iterator, Union
+from urllib.parse import quote, urlencode
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import Journal, TokenBucket, request_with_backoff, run_bulk
+
+logger = logging.getLogger(__name__)
+
+PROXY_TYPES = ["THUMBNAIL", "VIDEO", "AUDIO"]
+#index.max_result_window of the problem items index; ES refuses any page that ends past this
+RESULT_WINDOW = 10000
+
+
+class ProblemListError(Exception):
+    pass
+
+
+class SweepProgress(object):
+    """
+    Thread-safe per-collection counters for a sweep
+    """
+    FIELDS = ["problem_items", "items_read", "requested", "duplicates", "refused", "failed", "skipped", "pages_failed"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.collections = {}
+
+    def add(self, collection:str, field:str, count:int=1):
+        with self._lock:
+            counts = self.collections.get(collection)
+            if counts is None:
+                counts = self.collections[collection] = {f: 0 for f in self.FIELDS}
+            counts[field] += count
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {f: sum(c[f] for c in self.collections.values()) for f in self.FIELDS}
+
+    def format(self) -> str:
+        with self._lock:
+            lines = ["{0}: {1}/{2} items read, {3} requested, {4} failed".format(
+                        name, c["items_read"], c["problem_items"], c["requested"], c["failed"] + c["refused"])
+                     for name, c in sorted(self.collections.items())]
+        return "\n".join(lines)
+
+
+def list_problem_collections(client:ArchiveHunterClient) -> list:
+    """
+    :return: list of (collection name, problem item count)
+    """
+    response = client.get("/api/proxyhealth/problemitems/collectionlist")
+    if response.status_code!=200:
+        raise ProblemListError("Could not list collections, server returned {0}: {1}".format(response.status_code, response.text))
+    return [(e["key"], e["count"]) for e in response.json()["entries"]]
+
+
+def fetch_problem_page(client:ArchiveHunterClient, collection:str, start:int, size:int, limiter:Union[TokenBucket,None]=None,
+                       retries:int=3) -> dict:
+    uri = "/api/proxyhealth/problemitems?{0}".format(urlencode({"collection": collection, "start": start, "size": size}))
+    response = request_with_backoff(lambda: client.get(uri), limiter, max_retries=retries, retry_statuses=(429, 502, 503, 504))
+    if response.status_code!=200:
+        raise ProblemListError("Page at {0} of {1} failed, server returned {2}: {3}".format(start, collection, response.status_code, response.text[:512]))
+    return response.json()
+
+
+def iterate_problem_items(client:ArchiveHunterClient, collections:Iterable[str], progress:SweepProgress, page_size:int=100,
+                          concurrency:int=4, retries:int=3) -> Iterator[dict]:
+    """
+    Generator that yields every problem item in the given collections.  The first page of each collection gives its
+    total, and the remaining pages of all the collections are then fetched with up to `concurrency` in flight.
+    Items come back in page completion order, not index order.  A page that can't be fetched is logged and counted in
+    the progress, rather than stopping the sweep.  Pages past the index's result window can't be fetched at all, so
+    they aren't requested; a collection that is cut short gets one warning and its items_read stays below problem_items.
+    """
+    page_size = min(page_size, RESULT_WINDOW)
+
+    def first_page(collection):
+        return fetch_problem_page(client, collection, 0, page_size, retries=retries)
+
+    remaining_pages = []
+    for collection, page, error in run_bulk(collections, first_page, concurrency):
+        if error:
+            logger.error("Could not read problem items for {0}: {1}".format(collection, error))
+            progress.add(collection, "pages_failed")
+            continue
+        progress.add(collection, "problem_items", page["entryCount"])
+        progress.add(collection, "items_read", len(page["entries"]))
+        yield from page["entries"]
+        if page["entryCount"]>RESULT_WINDOW:
+            logger.warning("{0} has {1} problem items but only the first {2} can be read; run the sweep again once "
+                           "the fixed items have been removed from the index".format(collection, page["entryCount"], RESULT_WINDOW))
+        end = min(page["entryCount"], RESULT_WINDOW)
+        remaining_pages.extend((collection, start, min(page_size, end - start)) for start in range(page_size, end, page_size))
+
+    def next_page(task):
+        collection, start, size = task
+        return fetch_problem_page(client, collection, start, size, retries=retries)
+
+    for (collection, start, _), page, error in run_bulk(remaining_pages, next_page, concurrency):
+        if error:
+            logger.warning("Could not read problem items for {0} from {1}: {2}".format(collection, start, error))
+            progress.add(collection, "pages_failed")
+            continue
+        progress.add(collection, "items_read", len(page["entries"]))
+        yield from page["entries"]
+
+
+def missing_proxies(item:dict, types:Iterable[str]=PROXY_TYPES) -> list:
+    """
+    the proxy types that are wanted for a problem item but not present, by the same rule as ProblemItemReproxySink
+    """
+    return [r["proxyType"] for r in item.get("verifyResults", [])
+            if r["proxyType"] in types and r.get("wantProxy") and not r.get("haveProxy")]
+
+
+def generate_uri(file_id:str, proxy_type:str) -> str:
+    quoted_id = quote(file_id, safe="")
+    if proxy_type=="THUMBNAIL":
+        return "/api/proxy/generate/{0}/thumbnail".format(quoted_id)
+    return "/api/proxy/generate/{0}/{1}".format(quoted_id, proxy_type.lower())
+
+
+def regeneration_requests(items:Iterable[dict], progress:SweepProgress, journal:Journal, types:Iterable[str]=PROXY_TYPES) -> Iterator[tuple]:
+    """
+    Generator that yields (collection, file ID, proxy type) for each proxy to regenerate, once each, skipping any that
+    the journal says have already been requested
+    """
+    seen = set()
+    for item in items:
+        collection = item["collection"]
+        for proxy_type in missing_proxies(item, types):
+            key = "{0} {1}".format(item["fileId"], proxy_type)
+            if key in seen:
+                progress.add(collection, "duplicates")
+            elif journal.is_done(key):
+                seen.add(key)
+                progress.add(collection, "skipped")
+            else:
+                seen.add(key)
+                yield collection, item["fileId"], proxy_type
+
+
+def sweep(client:ArchiveHunterClient, collections:Iterable[str], journal:Journal, limiter:TokenBucket, concurrency:int=8,
+          page_concurrency:int=4, page_size:int=100, types:Iterable[str]=PROXY_TYPES, retries:int=5,
+          progress_interval:float=30, dry_run_out=None) -> SweepProgress:
+    """
+    Pages through the problem items of every collection and requests the missing proxies.
+    :param dry_run_out: if given, the requests that would be made are written here as NDJSON and none are sent
+    :return: the SweepProgress
+    """
+    progress = SweepProgress()
+    requests = regeneration_requests(iterate_problem_items(client, collections, progress, page_size, page_concurrency),
+                                     progress, journal, types)
+
+    if dry_run_out:
+        for collection, file_id, proxy_type in requests:
+            dry_run_out.write(json.dumps({"collection": collection, "fileId": file_id, "proxyType": proxy_type, "uri": generate_uri(file_id, proxy_type)}) + "\n")
+            progress.add(collection, "requested")
+        return progress
+
+    def send(request):
+        _, file_id, proxy_type = request
+        return request_with_backoff(lambda: client.post(generate_uri(file_id, proxy_type)), limiter, max_retries=retries)
+
+    last_report = monotonic()
+    for (collection, file_id, proxy_type), response, error in run_bulk(requests, send, concurrency):
+        key = "{0} {1}".format(file_id, proxy_type)
+        if error:
+            progress.add(collection, "failed")
+            journal.record(key, False, error=str(error))
+        elif response.status_code==200:
+            progress.add(collection, "requested")
+            journal.record(key, True, status=200)
+        else:
+            # a 400 means the server won't proxy this media type, so there's no point retrying it
+            progress.add(collection, "refused" if response.status_code==400 else "failed")
+            journal.record(key, False, status=response.status_code, detail=response.text[:512])
+            logger.debug("{0} {1}: server returned {2} {3}".format(file_id, proxy_type, response.status_code, response.text[:512]))
+
+        if monotonic() - last_report>=progress_interval:
+            logger.info("Progress:\n" + progress.format())
+            last_report = monotonic()
+    return progress
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Request regeneration of the missing proxies listed in the proxy-health problem items")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("-c", "--collection", dest="collections", action="append", help="sweep this collection. Can be given more than once. Defaults to the server's collection list")
+    parser.add_argument("--types", dest="types", default=",".join(PROXY_TYPES), help="comma-separated proxy types to regenerate")
+    parser.add_argument("--page-size", dest="page_size", type=int, default=100, help="number of problem items per page")
+    parser.add_argument("--page-concurrency", dest="page_concurrency", type=int, default=4, help="number of pages to fetch at once")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=8, help="number of generation requests in flight at once")
+    parser.add_argument("--rate", dest="rate", type=float, default=5, help="maximum generation requests per second. 0 for no limit")
+    parser.add_argument("--journal", dest="journal", help="record the outcome of each request here, and skip ones that already succeeded")
+    parser.add_argument("--retries", dest="retries", type=int, default=5, help="number of times to retry a request that was throttled")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", default=False, help="write the requests that would be made to stdout as NDJSON instead of sending them")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    types = [t.strip().upper() for t in args.types.split(",") if t.strip()!=""]
+    unknown = [t for t in types if t not in PROXY_TYPES]
+    if len(unknown)>0:
+        print("Unknown proxy types {0}, expected some of {1}".format(", ".join(unknown), ", ".join(PROXY_TYPES)))
+        exit(1)
+
+    client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency + args.page_concurrency)
+    collections = args.collections
+    if not collections:
+        collection_counts = list_problem_collections(client)
+        for name, count in collection_counts:
+            logger.info("{0}: {1} problem items".format(name, count))
+        collections = [name for name, _ in collection_counts]
+
+    journal = Journal(args.journal)
+    try:
+        progress = sweep(client, collections, journal, TokenBucket(args.rate), args.concurrency, args.page_concurrency,
+                         args.page_size, types, args.retries, dry_run_out=sys.stdout if args.dry_run else None)
+    finally:
+        journal.close()
+
+    logger.info("Finished:\n" + progress.format())
+    totals = progress.totals()
+    sys.stderr.write(json.dumps(totals) + "\n")
+    if totals["failed"]>0 or totals["pages_failed"]>0:
+        exit(1)
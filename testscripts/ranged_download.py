@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+"""
+Downloads restored lightbox files using several concurrent HTTP Range requests per file.
+
+Links come from GET /api/download/:fileId for single files.  For a whole bulk, the same sequence as the desktop app is
+used:
+- /api/lightbox/bulk/appDownload/:bulkId returns a one-time code
+- /api/bulkv2/:code exchanges it for a retrieval token
+- /api/bulkv2/:token/summarystream lists the files
+- /api/bulk/:token/get/:fileId gives each file's link
+
+Each file is preallocated at its full size, and every part is streamed straight to its offset in the file.  Completed
+parts are recorded in a sidecar file ("<file>.parts"), so an interrupted download picks up where it left off.  At the
+end, the size is checked, and the MD5 as well when the ETag is a plain single-part MD5.  Multipart ETags are checked by
+trying the part sizes that the upload is likely to have used; a file that can't be checked that way is logged as
+unverified.  The sidecar is only removed once the checks pass; it is written before the file is preallocated, so a
+full-size file with no sidecar is always complete.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from typing import Callable, Iterator, Union
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import backoff_delay, iter_lines, run_bulk
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 64*1024*1024
+CHUNK_SIZE = 1024*1024
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+UNSATISFIED_RANGE_RE = re.compile(r'^bytes \*/(\d+)$')
+MD5_ETAG_RE = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+MULTIPART_ETAG_RE = re.compile(r'^"?([0-9a-fA-F]{32})-(\d+)"?$')
+MIB = 1024*1024
+# part sizes used by the AWS CLI and SDKs, the console and common upload tools
+MULTIPART_PART_SIZES = [n*MIB for n in (5, 8, 10, 15, 16, 25, 32, 50, 64, 100, 128, 256, 512, 1024)]
+
+
+class DownloadError(Exception):
+    pass
+
+
+class LinkExpired(DownloadError):
+    pass
+
+
+class PartMap(object):
+    """
+    Sidecar record of which parts of a download are complete.  It is only valid for the same size, ETag and part size;
+    if any of them differ then the download starts again.
+    """
+    def __init__(self, path:str, size:int, etag:Union[str,None], part_size:int):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.done = set()
+        self._lock = threading.Lock()
+
+    @property
+    def part_count(self) -> int:
+        return max(1, (self.size + self.part_size - 1)//self.part_size)
+
+    def part_range(self, index:int) -> (int, int):
+        """
+        :return: (first byte, last byte) of the part, inclusive as in a Range header
+        """
+        start = index*self.part_size
+        return start, min(self.size, start + self.part_size) - 1
+
+    def load(self) -> bool:
+        """
+        loads the completed parts from the sidecar, if it matches this download
+        :return: True if an earlier download is being resumed
+        """
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if saved.get("size")!=self.size or saved.get("etag")!=self.etag or saved.get("part_size")!=self.part_size:
+            logger.info("{0} is for a different version of the file, starting again".format(self.path))
+            return False
+        self.done = set(saved.get("done", []))
+        return True
+
+    def _write(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"size": self.size, "etag": self.etag, "part_size": self.part_size, "done": sorted(self.done)}, f)
+        os.replace(temp_path, self.path)
+
+    def save(self):
+        with self._lock:
+            self._write()
+
+    def mark_done(self, index:int):
+        with self._lock:
+            self.done.add(index)
+            self._write()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RefreshableLink(object):
+    """
+    Holds the current link for a file, shared between the threads fetching its parts.  Presigned links expire, so when
+    one is refused a new one is fetched from `provider`, once for all the threads that were using it.
+    """
+    def __init__(self, provider:Callable[[], str]):
+        self.provider = provider
+        self.url = provider()
+        self._lock = threading.Lock()
+
+    def refresh(self, stale_url:str) -> str:
+        with self._lock:
+            if self.url==stale_url:
+                logger.info("Link was refused, fetching a new one")
+                self.url = self.provider()
+            return self.url
+
+
+def probe(session:requests.Session, url:str, timeout:float=60) -> (int, Union[str,None], bool):
+    """
+    Finds the size and ETag of the object at the URL with a one-byte ranged GET; presigned links are only valid for
+    GET, so HEAD can't be used.
+    :return: tuple of (size, etag, whether ranges are supported)
+    """
+    response = session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+    try:
+        if response.status_code==403:
+            raise LinkExpired("Link was refused, it may have expired: {0}".format(response.text[:512]))
+        if response.status_code==206:
+            match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+            if match is None or match.group(3)=="*":
+                raise DownloadError("Server returned an unusable Content-Range: {0}".format(response.headers.get("Content-Range")))
+            return int(match.group(3)), response.headers.get("ETag"), True
+        if response.status_code==416:
+            # S3 refuses any range of an empty object, and says so with a Content-Range of bytes */0
+            match = UNSATISFIED_RANGE_RE.match(response.headers.get("Content-Range", ""))
+            if match is not None and match.group(1)=="0":
+                return 0, response.headers.get("ETag"), True
+        if response.status_code==200:
+            return int(response.headers.get("Content-Length", "-1")), response.headers.get("ETag"), False
+        raise DownloadError("Server returned {0}: {1}".format(response.status_code, response.text[:512]))
+    finally:
+        response.close()
+
+
+def preallocate(path:str, size:int):
+    """
+    makes sure that the file exists and is `size` bytes long, without overwriting anything already in it
+    """
+    with open(path, "ab") as f:
+        if os.path.getsize(path)!=size:
+            f.truncate(size)
+            if hasattr(os, "posix_fallocate") and size>0:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass    #not supported on this filesystem; the file is sparse instead
+
+
+def fetch_part(session:requests.Session, link:RefreshableLink, path:str, start:int, end:int, retries:int=5,
+               timeout:float=60):
+    """
+    Streams bytes `start`-`end` of the object into the file at the same offsets.  If the connection drops then the
+    request is retried from where it got to.  If the link is refused, a new one is fetched before retrying.
+    """
+    position = start
+    attempt = 0
+    with open(path, "r+b") as f:
+        while position<=end:
+            url = link.url
+            try:
+                response = session.get(url, headers={"Range": "bytes={0}-{1}".format(position, end)}, stream=True, timeout=timeout)
+                with response:
+                    if response.status_code==403:
+                        raise LinkExpired("Link was refused for bytes {0}-{1}".format(position, end))
+                    if response.status_code!=206:
+                        raise DownloadError("Expected a partial response for bytes {0}-{1}, got {2}".format(position, end, response.status_code))
+                    match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+                    if match is None or int(match.group(1))!=position:
+                        raise DownloadError("Server returned the wrong range: {0}".format(response.headers.get("Content-Range")))
+                    f.seek(position)
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if position + len(chunk)>end + 1:
+                            raise DownloadError("Server sent more than the requested range")
+                        f.write(chunk)
+                        position += len(chunk)
+                if position<=end:
+                    raise IOError("Connection closed at byte {0} of part {1}-{2}".format(position, start, end))
+            except (IOError, DownloadError) as e:
+                attempt += 1
+                if attempt>retries:
+                    raise
+                if isinstance(e, LinkExpired):
+                    link.refresh(url)
+                delay = backoff_delay(attempt)
+                logger.warning("Part {0}-{1} failed at byte {2} ({3}), retrying in {4:.1f}s".format(start, end, position, e, delay))
+                sleep(delay)
+
+
+def multipart_part_sizes(size:int, part_count:int) -> list:
+    """
+    the part sizes that an upload of `size` bytes in `part_count` parts is likely to have used: those of the usual sizes
+    that give that many parts, and the size split evenly into whole MiB, which is what tools that adapt their part size
+    to stay under the 10,000 part limit do
+    """
+    candidates = [p for p in MULTIPART_PART_SIZES if -(-size//p)==part_count]
+    even = -(-size//part_count)
+    even = -(-even//MIB)*MIB
+    if even not in candidates and -(-size//even)==part_count:
+        candidates.append(even)
+    return candidates
+
+
+def multipart_part_size(path:str, digest:str, part_count:int, part_sizes:list) -> Union[int,None]:
+    """
+    Works out the multipart ETag of the file for each of the given part sizes, in a single read of the file.  A multipart
+    ETag is the MD5 of the concatenated binary MD5s of the parts, followed by "-" and the number of parts.
+    :param part_sizes: candidate part sizes, all whole MiB
+    :return: the part size that gives `digest`, or None if none of them do
+    """
+    parts = {p: [hashlib.md5(), []] for p in part_sizes}
+    offset = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(MIB), b""):
+            offset += len(block)
+            for part_size, state in parts.items():
+                state[0].update(block)
+                if offset%part_size==0:
+                    state[1].append(state[0].digest())
+                    state[0] = hashlib.md5()
+    for part_size, (part_digest, digests) in parts.items():
+        if offset%part_size!=0:
+            digests.append(part_digest.digest())
+        if len(digests)==part_count and hashlib.md5(b"".join(digests)).hexdigest()==digest:
+            return part_size
+    return None
+
+
+def verify(path:str, size:int, etag:Union[str,None]):
+    """
+    Checks the size of the file, and its checksum if the ETag has one.  For a multipart ETag the checksum depends on the
+    part size the object was uploaded with, which isn't recorded, so the likely ones are tried.  If none of them match,
+    or the ETag has no checksum, the file is logged as unverified rather than failed.
+    :raises DownloadError: if the file is the wrong size, or does not match a single-part MD5 ETag
+    """
+    actual_size = os.path.getsize(path)
+    if size>=0 and actual_size!=size:
+        raise DownloadError("{0} is {1} bytes, expected {2}".format(path, actual_size, size))
+    match = MD5_ETAG_RE.match(etag or "")
+    if match:
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(8*1024*1024), b""):
+                digest.update(block)
+        if digest.hexdigest()!=match.group(1).lower():
+            raise DownloadError("{0} has MD5 {1}, expected {2}".format(path, digest.hexdigest(), match.group(1).lower()))
+        return
+
+    match = MULTIPART_ETAG_RE.match(etag or "")
+    if match:
+        part_count = int(match.group(2))
+        part_sizes = multipart_part_sizes(actual_size, part_count)
+        part_size = multipart_part_size(path, match.group(1).lower(), part_count, part_sizes) if len(part_sizes)>0 else None
+        if part_size is not None:
+            logger.info("{0} matches its multipart ETag with {1} MiB parts".format(path, part_size//MIB))
+        else:
+            logger.warning("{0} is UNVERIFIED: its multipart ETag {1} doesn't match {2} parts of any of the usual sizes ({3} MiB), "
+                           "so only its size was checked".format(path, etag, part_count, ", ".join(str(p//MIB) for p in part_sizes) or "none fit"))
+    else:
+        logger.warning("{0} is UNVERIFIED: its ETag {1} has no checksum, so only its size was checked".format(path, etag))
+
+
+def download(url_provider:Callable[[], str], path:str, part_size:int=DEFAULT_PART_SIZE, concurrency:int=4,
+             session:Union[requests.Session,None]=None, retries:int=5, progress:Callable[[int, int], None]=None) -> int:
+    """
+    Downloads one file with concurrent ranged requests, resuming from the sidecar part map if there is one.
+    :param url_provider: returns the link to download from; called again if the link is refused part-way through
+    :param progress: called with (parts done, part count) as parts complete
+    :return: the size of the file
+    """
+    session = session or requests.Session()
+    link = RefreshableLink(url_provider)
+    size, etag, ranges_supported = probe(session, link.url)
+    part_map = PartMap(path + ".parts", size, etag, part_size)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if size==0:
+        #nothing to fetch
+        open(path, "wb").close()
+    elif not ranges_supported or size<0:
+        logger.info("Server does not support ranges for {0}, downloading in one stream".format(path))
+        with session.get(link.url, stream=True, timeout=60) as response:
+            if response.status_code!=200:
+                raise DownloadError("Server returned {0}: {1}".format(response.status_code, response.text[:512]))
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+    else:
+        resumed = part_map.load() and os.path.exists(path)
+        if not resumed:
+            part_map.done = set()
+            #the sidecar has to exist before the full-size file does, or an interrupted first attempt would look complete
+            part_map.save()
+        preallocate(path, size)
+        remaining = [i for i in range(part_map.part_count) if i not in part_map.done]
+        if resumed:
+            logger.info("Resuming {0}, {1} of {2} parts already done".format(path, part_map.part_count - len(remaining), part_map.part_count))
+
+        def fetch(index):
+            start, end = part_map.part_range(index)
+            fetch_part(session, link, path, start, end, retries)
+            part_map.mark_done(index)
+            if progress:
+                progress(len(part_map.done), part_map.part_count)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(fetch, i) for i in remaining]:
+                future.result()
+
+    try:
+        verify(path, size, etag)
+    except DownloadError:
+        #start from scratch next time rather than trusting the parts.  The sidecar is kept, with nothing done, so that
+        #the bad file isn't taken for a finished one
+        part_map.done = set()
+        part_map.save()
+        raise
+    part_map.remove()
+    return size
+
+
+def file_link(client:ArchiveHunterClient, file_id:str) -> str:
+    response = client.get("/api/download/{0}".format(quote(file_id, safe="")))
+    if response.status_code!=200:
+        raise DownloadError("Could not get a link for {0}, server returned {1}: {2}".format(file_id, response.status_code, response.text[:512]))
+    return response.json()["entry"]
+
+
+def bulk_retrieval_token(client:ArchiveHunterClient, bulk_id:str) -> str:
+    """
+    exchanges a bulk ID for a long-lived retrieval token, as the desktop download app does
+    """
+    response = client.get("/api/lightbox/bulk/appDownload/{0}".format(quote(bulk_id, safe="")))
+    if response.status_code!=200:
+        raise DownloadError("Could not start bulk download, server returned {0}: {1}".format(response.status_code, response.text[:512]))
+    code = response.json()["objectId"].split(":")[-1]
+    response = client.get("/api/bulkv2/{0}".format(quote(code, safe="")))
+    if response.status_code!=200:
+        raise DownloadError("Could not exchange the download code, server returned {0}: {1}".format(response.status_code, response.text[:512]))
+    return response.json()["retrievalToken"]
+
+
+def bulk_entries(client:ArchiveHunterClient, token:str) -> Iterator[dict]:
+    """
+    Generator that yields {entryId, path, fileSize} for each file in the bulk
+    """
+    response = client.get("/api/bulkv2/{0}/summarystream".format(quote(token, safe="")), stream=True)
+    with response:
+        if response.status_code!=200:
+            raise DownloadError("Could not list the bulk, server returned {0}: {1}".format(response.status_code, response.text[:512]))
+        for line in iter_lines(response.iter_content(chunk_size=64*1024)):
+            yield json.loads(line)
+
+
+def bulk_file_link(client:ArchiveHunterClient, token:str, file_id:str) -> str:
+    response = client.get("/api/bulk/{0}/get/{1}".format(quote(token, safe=""), quote(file_id, safe="")))
+    if response.status_code!=200:
+        raise DownloadError("Could not get a link for {0}, server returned {1}: {2}".format(file_id, response.status_code, response.text[:512]))
+    link = response.json().get("downloadLink")
+    if not link:
+        raise DownloadError("{0} is not available yet ({1})".format(file_id, response.json().get("restoreStatus")))
+    return link
+
+
+def local_path(dest_dir:str, path:str) -> str:
+    """
+    where to save a file from the bucket, keeping its folder structure but not letting it escape `dest_dir`
+    """
+    parts = [p for p in path.split("/") if p not in ("", ".", "..")]
+    return os.path.join(dest_dir, *parts)
+
+
+def download_bulk(client:ArchiveHunterClient, bulk_id:str, dest_dir:str, file_concurrency:int=2, **download_args) -> (int, int):
+    """
+    Downloads every file in the bulk into `dest_dir`.  Files that are already complete (the right size, with no
+    sidecar) are skipped.
+    :return: tuple of (files downloaded or already present, files failed)
+    """
+    token = bulk_retrieval_token(client, bulk_id)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=file_concurrency*download_args.get("concurrency", 4))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def fetch(entry):
+        path = local_path(dest_dir, entry["path"])
+        if os.path.exists(path) and not os.path.exists(path + ".parts") and os.path.getsize(path)==entry["fileSize"]:
+            return "present"
+        download(lambda: bulk_file_link(client, token, entry["entryId"]), path, session=session, **download_args)
+        return "downloaded"
+
+    succeeded = 0
+    failed = 0
+    for entry, result, error in run_bulk(bulk_entries(client, token), fetch, file_concurrency):
+        if error:
+            failed += 1
+            logger.error("{0}: {1}".format(entry["path"], error))
+        else:
+            succeeded += 1
+            logger.info("{0}: {1}".format(entry["path"], result))
+    return succeeded, failed
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Download restored lightbox files with parallel ranged requests")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("--cookie", dest="cookie", help="PLAY_SESSION cookie value of the user whose lightbox this is")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--id", dest="file_id", help="download this file")
+    target.add_argument("-b", "--bulk", dest="bulk_id", help="download every file in this lightbox bulk")
+    parser.add_argument("-o", "--output", dest="output", default=".", help="file to save --id to, or directory to save --bulk into")
+    parser.add_argument("--part-size-mb", dest="part_size_mb", type=int, default=DEFAULT_PART_SIZE//(1024*1024), help="size of each ranged request")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=4, help="number of parts of each file to fetch at once")
+    parser.add_argument("--file-concurrency", dest="file_concurrency", type=int, default=2, help="number of files of a bulk to fetch at once")
+    parser.add_argument("--retries", dest="retries", type=int, default=5, help="number of times to retry each part")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    client = ArchiveHunterClient.from_options(args, pool_size=args.file_concurrency)
+    if args.cookie:
+        client.session.cookies.set("PLAY_SESSION", args.cookie, domain=args.host.split(":")[0])
+    download_args = {"part_size": args.part_size_mb*1024*1024, "concurrency": args.concurrency, "retries": args.retries}
+
+    try:
+        if args.file_id:
+            path = os.path.join(args.output, args.file_id) if os.path.isdir(args.output) else args.output
+            size = download(lambda: file_link(client, args.file_id), path, **download_args)
+            logger.info("Downloaded {0} bytes to {1}".format(size, path))
+        else:
+            succeeded, failed = download_bulk(client, args.bulk_id, args.output, args.file_concurrency, **download_args)
+            logger.info("{0} files downloaded, {1} failed".format(succeeded, failed))
+            if failed>0:
+                exit(1)
+    except DownloadError as e:
+        logger.error(str(e))
+        exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Compares a list of IDs built from S3 (build-id-list.py) with a list of IDs from the index (hmac-search.py) and reports
+objects that are missing from the index and index entries whose object has gone.
+
+Both inputs are put through an external merge sort, so memory use is bounded by --memory-mb no matter how large they
+are, and then merge-joined.  Inputs can be plain ID-per-line files or NDJSON exports from hmac-search.py --export
+(entries flagged beenDeleted are skipped), optionally gzipped.  Use "-" to read one of them from stdin.
+"""
+
+import gzip
+import heapq
+import json
+import logging
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# rough per-line overhead of a python str in a list, used to estimate memory use of a sort run
+LINE_OVERHEAD = 64
+
+
+def read_ids(path:str) -> Iterator[str]:
+    """
+    Generator that yields the IDs from an ID-per-line or NDJSON file
+    """
+    if path=="-":
+        f = sys.stdin
+    elif path.endswith(".gz"):
+        f = gzip.open(path, "rt", encoding="UTF-8")
+    else:
+        f = open(path, "r", encoding="UTF-8")
+
+    try:
+        for line in f:
+            line = line.rstrip("\n")
+            if line=="":
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                if not entry.get("beenDeleted", False):
+                    yield entry["id"]
+            else:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _write_run(run:list, tmpdir:str) -> str:
+    run.sort()
+    fd, path = tempfile.mkstemp(prefix="reconcile-run-", dir=tmpdir)
+    with os.fdopen(fd, "w", encoding="UTF-8") as f:
+        for item in run:
+            f.write(item)
+            f.write("\n")
+    return path
+
+
+def _read_run(path:str) -> Iterator[str]:
+    with open(path, "r", encoding="UTF-8") as f:
+        for line in f:
+            yield line[:-1]
+
+
+def external_sort(items:Iterable[str], memory_limit:int, tmpdir:str=None) -> Iterator[str]:
+    """
+    Generator that yields the given items sorted with duplicates removed.  Items are sorted in memory in runs of up to
+    roughly `memory_limit` bytes; if there is more than one run they are spilled to temporary files and merged.
+    """
+    run = []
+    run_bytes = 0
+    run_files = []
+    try:
+        for item in items:
+            run.append(item)
+            run_bytes += len(item) + LINE_OVERHEAD
+            if run_bytes>=memory_limit:
+                run_files.append(_write_run(run, tmpdir))
+                run = []
+                run_bytes = 0
+
+        if len(run_files)==0:
+            run.sort()
+            merged = iter(run)
+        else:
+            if len(run)>0:
+                run_files.append(_write_run(run, tmpdir))
+                run = []
+            logger.info("Merging {0} sorted runs".format(len(run_files)))
+            merged = heapq.merge(*[_read_run(path) for path in run_files])
+
+        previous = None
+        for item in merged:
+            if item!=previous:
+                yield item
+                previous = item
+    finally:
+        for path in run_files:
+            os.unlink(path)
+
+
+def diff_sorted(left:Iterator[str], right:Iterator[str]):
+    """
+    Merge-joins two sorted, de-duplicated streams.  Yields ("left", item) for items only in `left`, ("right", item) for
+    items only in `right` and ("both", item) for items in both.
+    """
+    sentinel = object()
+    l = next(left, sentinel)
+    r = next(right, sentinel)
+    while l is not sentinel or r is not sentinel:
+        if r is sentinel or (l is not sentinel and l<r):
+            yield "left", l
+            l = next(left, sentinel)
+        elif l is sentinel or r<l:
+            yield "right", r
+            r = next(right, sentinel)
+        else:
+            yield "both", l
+            l = next(left, sentinel)
+            r = next(right, sentinel)
+
+
+def reconcile(s3_ids:Iterable[str], index_ids:Iterable[str], memory_limit:int, missing_out=None, orphans_out=None, tmpdir:str=None) -> dict:
+    """
+    Compares the two ID streams and writes the differences to the given file-like objects, if any.
+    The memory limit is split between the two sorts, since both can be holding an in-memory run while they are merged.
+    :return: dictionary of counts
+    """
+    counts = {"s3": 0, "index": 0, "matched": 0, "missing_from_index": 0, "missing_from_s3": 0}
+    sorted_s3 = external_sort(s3_ids, memory_limit//2, tmpdir)
+    sorted_index = external_sort(index_ids, memory_limit//2, tmpdir)
+
+    for side, item in diff_sorted(sorted_s3, sorted_index):
+        if side=="both":
+            counts["matched"] += 1
+        elif side=="left":
+            counts["missing_from_index"] += 1
+            if missing_out:
+                missing_out.write(item + "\n")
+        else:
+            counts["missing_from_s3"] += 1
+            if orphans_out:
+                orphans_out.write(item + "\n")
+
+    counts["s3"] = counts["matched"] + counts["missing_from_index"]
+    counts["index"] = counts["matched"] + counts["missing_from_s3"]
+    return counts
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Compare IDs from build-id-list.py with IDs from hmac-search.py")
+    parser.add_argument("--s3", dest="s3", required=True, help="file of IDs built from the S3 listing, or - for stdin")
+    parser.add_argument("--index", dest="index", required=True, help="file of IDs or NDJSON export from the index, or - for stdin")
+    parser.add_argument("--missing-out", dest="missing_out", help="write IDs that are in S3 but not the index to this file")
+    parser.add_argument("--orphans-out", dest="orphans_out", help="write IDs that are in the index but not in S3 to this file")
+    parser.add_argument("--memory-mb", dest="memory_mb", type=int, default=512, help="approximate memory ceiling for sorting, in megabytes")
+    parser.add_argument("--tmpdir", dest="tmpdir", help="directory for sort spill files. Defaults to the system temp directory")
+    args = parser.parse_args()
+
+    if args.s3=="-" and args.index=="-":
+        print("Only one of --s3 and --index can be read from stdin")
+        exit(1)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    missing_out = open(args.missing_out, "w") if args.missing_out else None
+    orphans_out = open(args.orphans_out, "w") if args.orphans_out else None
+    try:
+        counts = reconcile(read_ids(args.s3), read_ids(args.index), args.memory_mb*1024*1024, missing_out, orphans_out, args.tmpdir)
+    finally:
+        if missing_out:
+            missing_out.close()
+        if orphans_out:
+            orphans_out.close()
+
+    print(json.dumps(counts))
@@ -1,17 +1,17 @@
 #!/usr/bin/env python3
 
-import hashlib
-import hmac
+import sys
+import logging
 import urllib.parse
 from optparse import OptionParser
-from datetime import datetime, timedelta
-import base64
-from email.utils import formatdate
-import requests
-from time import mktime
-from urllib.parse import urlparse
 from pprint import pprint
-import json
+from time import monotonic
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import TokenBucket, Journal, read_lines, request_with_backoff, run_bulk
+
+logging.basicConfig(level=logging.WARN, stream=sys.stderr)
+logger = logging.getLogger(__name__)
 
 #uncomment this block to get request-level debug output
 # import logging
@@ -31,78 +31,96 @@ import json
 # requests_log.propagate = True
 
 
-def checksum(content:bytes) -> str:
-    """
-    Calculates the SHA-384 checksum of the given content and returns the base64 encoded representation as a string
-    :param content: the content to hash
-    :return: a string representing the checksum
-    """
-    digest = hashlib.sha384(content).digest()
-    return base64.b64encode(digest).decode("UTF-8")
+def move_uri(entry_id: str, dest: str) -> str:
+    return "/api/move/{fileid}?to={collection}".format(fileid=urllib.parse.quote(entry_id).replace("/", "%2F"),
+                                                        collection=urllib.parse.quote(dest))
+
 
+def move_one(client: ArchiveHunterClient, entry_id: str, dest: str):
+    uri = move_uri(entry_id, dest)
+    print("uri is " + client.url(uri))
+    response = client.put(uri)
 
-def get_token(uri:str, secret:str, method:str, content:bytes, checksum:str) -> (str, str):
+    print("Server returned {0}".format(response.status_code))
+    pprint(response.headers)
+    if response.status_code==200:
+        pprint(response.json())
+    else:
+        print(response.text)
+
+
+def move_bulk(client: ArchiveHunterClient, ids, dest: str, journal: Journal, limiter: TokenBucket, concurrency: int, retries: int) -> (int, int, int):
     """
-    Generates an HMAC token
-    :param uri:  URI that is going to be accessed
-    :param secret: Shared secret with the server
-    :param method: HTTP method for the request
-    :param content: byte string of the request body. Can be empty.
-    :param checksum: SHA-384 checksum of the body content. If content is empty then this should be the SHA checksum of an empty string
-    :return: tuple consisting of the body of an "Authorization" header and the HTTP style date/time of the request.
+    Requests moves for every ID in `ids`, skipping any that the journal says have already succeeded
+    :return: tuple of (succeeded, failed, skipped) counts
     """
-    t = datetime.now()
-    httpdate = formatdate(timeval=mktime(t.timetuple()),localtime=False,usegmt=True)
-    url_parts = urlparse(uri)
-
-    content_length = len(content)
+    skipped = 0
+
+    def pending_ids():
+        nonlocal skipped
+        for entry_id in ids:
+            if journal.is_done(entry_id):
+                skipped += 1
+            else:
+                yield entry_id
+
+    def request_move(entry_id):
+        return request_with_backoff(lambda: client.put(move_uri(entry_id, dest)), limiter, max_retries=retries)
+
+    succeeded = 0
+    failed = 0
+    start_time = monotonic()
+    for entry_id, response, error in run_bulk(pending_ids(), request_move, concurrency):
+        if error:
+            failed += 1
+            journal.record(entry_id, False, error=str(error))
+            logger.error("{0}: {1}".format(entry_id, error))
+        elif response.status_code==200:
+            succeeded += 1
+            journal.record(entry_id, True, status=response.status_code)
+        else:
+            failed += 1
+            journal.record(entry_id, False, status=response.status_code, detail=response.text[:512])
+            logger.error("{0}: server returned {1} {2}".format(entry_id, response.status_code, response.text[:512]))
+
+        done = succeeded + failed
+        if done%100==0:
+            logger.info("{0} requested, {1} failed, {2:.1f}/s".format(done, failed, done/(monotonic()-start_time)))
+    return succeeded, failed, skipped
 
-    string_to_sign = "{}\n{}\n{}\n{}\n{}".format(httpdate, content_length, checksum, method, url_parts.path + "?" + url_parts.query)
-    print("string_to_sign: " + string_to_sign)
-    hm = hmac.digest(secret.encode("UTF-8"), msg=string_to_sign.encode("UTF-8"), digest=hashlib.sha384)
-    return "HMAC {0}".format(base64.b64encode(hm).decode("UTF-8")), httpdate
 
 # START MAIN
-parser = OptionParser()
-parser.add_option("--host", dest="host", help="host to access", default="archivehunter.local.dev-gutools.co.uk")
-parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default="false", help="set this to disable SSL cert checking")
-parser.add_option("-s", "--secret", dest="secret", help="shared secret to use")
-parser.add_option("--id", dest="entry_id", help="ArchiveHunter ID of media to set proxy for")
-parser.add_option("--dest", dest="dest", help="Collection (bucket) name to move the content to")
-(options, args) = parser.parse_args()
-
-if options.secret is None:
-    print("You must supply the password in --secret")
-    exit(1)
-
-method = "PUT"
-uri = "https://{host}/api/move/{fileid}?to={collection}".format(host=options.host,
-                                                                fileid=urllib.parse.quote(options.entry_id).replace("/", "%2F"),
-                                                                collection=urllib.parse.quote(options.dest))
-
-print("uri is " + uri)
-content_body = "".encode("UTF-8")
-content_hash = checksum(content_body)
-
-authtoken, httpdate = get_token(uri, options.secret, method, content_body, content_hash)
-print(authtoken)
-
-headers = {
-        'Date': httpdate,
-        'Authorization': authtoken,
-        'X-Sha384-Checksum': content_hash,
-}
-
-print(headers)
-extra_kwargs = {}
-if options.sslnoverify:
-    extra_kwargs['verify'] = False
-
-response = requests.put(uri, headers=headers, **extra_kwargs)
-
-print("Server returned {0}".format(response.status_code))
-pprint(response.headers)
-if response.status_code==200:
-    pprint(response.json())
-else:
-    print(response.text)
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", help="host to access", default=DEFAULT_HOST)
+    parser.add_option("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_option("-s", "--secret", dest="secret", help="shared secret to use")
+    parser.add_option("--id", dest="entry_id", help="ArchiveHunter ID of media to move")
+    parser.add_option("--dest", dest="dest", help="Collection (bucket) name to move the content to")
+    parser.add_option("-i", "--input", dest="input", help="move every ID in this file, one per line. Use - for stdin")
+    parser.add_option("-j", "--concurrency", dest="concurrency", type="int", default=4, help="number of move requests in flight at once with --input")
+    parser.add_option("--rate", dest="rate", type="float", default=0, help="maximum move requests per second with --input. 0 for no limit")
+    parser.add_option("--journal", dest="journal", help="record the outcome for each ID here, and skip IDs that already succeeded")
+    parser.add_option("--retries", dest="retries", type="int", default=5, help="number of times to retry a request that was throttled")
+    instrumentation.add_arguments(parser)
+    (options, args) = parser.parse_args()
+    instrumentation.from_args(options)
+
+    if options.secret is None:
+        print("You must supply the password in --secret")
+        exit(1)
+
+    if options.input:
+        logger.setLevel(logging.INFO)
+        client = ArchiveHunterClient.from_options(options, pool_size=options.concurrency)
+        journal = Journal(options.journal)
+        try:
+            succeeded, failed, skipped = move_bulk(client, read_lines(options.input), options.dest, journal,
+                                                   TokenBucket(options.rate), options.concurrency, options.retries)
+        finally:
+            journal.close()
+        logger.info("Finished: {0} moves requested, {1} failed, {2} skipped as already done".format(succeeded, failed, skipped))
+        if failed>0:
+            exit(1)
+    else:
+        move_one(ArchiveHunterClient.from_options(options), options.entry_id, options.dest)
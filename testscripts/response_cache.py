@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in client-side cache for ArchiveHunter lookups, used by ArchiveHunterClient when it is given one.
+
+Entries live in a size-bounded in-memory LRU with a TTL, optionally backed by a SQLite file so that they survive
+between runs.  Concurrent lookups of the same key are collapsed into one request, and everything cached for an
+entry ID can be dropped when the entry is changed.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+from typing import Callable, Union
+from urllib.parse import unquote, urlparse, parse_qs
+
+# requests that change an entry or its proxies, see conf/routes.  The first group is the entry ID.
+MUTATING_ROUTES = [
+    ("PUT", re.compile(r'^/api/move/([^/]+)$')),
+    ("DELETE", re.compile(r'^/api/proxy/([^/]+)/[^/]+$')),
+    ("POST", re.compile(r'^/api/proxy/generate/([^/]+)/[^/]+$')),
+    ("POST", re.compile(r'^/api/proxy/analyse/([^/]+)$')),
+    ("PUT", re.compile(r'^/api/lightbox/[^/]+/([^/]+)$')),
+    ("DELETE", re.compile(r'^/api/lightbox/[^/]+/([^/]+)$')),
+    ("DELETE", re.compile(r'^/api/deleted/[^/]+/([^/]+)$')),
+]
+
+
+class CachedResponse(object):
+    """
+    Stands in for a requests Response for a cached lookup
+    """
+    def __init__(self, status_code:int, content, from_cache:bool=False):
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+        self.headers = {}
+
+    def json(self):
+        return self.content
+
+    @property
+    def text(self):
+        return json.dumps(self.content)
+
+
+def cache_key(kind:str, entry_id:str, *extra) -> str:
+    return "\0".join((kind, entry_id) + tuple(str(e) for e in extra if e is not None))
+
+
+def mutated_entry_ids(method:str, uri:str, body=None) -> list:
+    """
+    Works out which entry IDs a request will change, so that anything cached about them can be dropped.
+    :param method: HTTP method
+    :param uri: path or full URL of the request
+    :param body: the request body, if it was given as a dict
+    :return: list of entry IDs, empty if the request does not change any entries
+    """
+    if method=="GET":
+        return []
+    url_parts = urlparse(uri)
+    path = url_parts.path
+    if method=="POST" and path=="/api/proxy":
+        return [body["entryId"]] if isinstance(body, dict) and body.get("entryId") else []
+    if method=="PUT" and path.startswith("/api/proxy/") and path.endswith("/associate"):
+        return parse_qs(url_parts.query).get("fileId", [])
+    for route_method, route in MUTATING_ROUTES:
+        if method==route_method:
+            match = route.match(path)
+            if match:
+                return [unquote(match.group(1))]
+    return []
+
+
+class SQLiteBacking(object):
+    """
+    On-disk store for cached responses.  A separate connection is used for each thread.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, entry_id TEXT NOT NULL, expires REAL NOT NULL, status INTEGER NOT NULL, body TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_entry_id ON responses (entry_id)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key:str, now:float) -> Union[tuple,None]:
+        """
+        :return: (expiry time, response) for the key, or None if there is nothing unexpired stored for it
+        """
+        row = self._conn().execute("SELECT expires, status, body FROM responses WHERE key=? AND expires>?", (key, now)).fetchone()
+        if row is None:
+            return None
+        return row[0], CachedResponse(row[1], json.loads(row[2]), from_cache=True)
+
+    def put(self, key:str, entry_id:str, expires:float, response:CachedResponse):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO responses (key, entry_id, expires, status, body) VALUES (?,?,?,?,?)",
+                     (key, entry_id, expires, response.status_code, json.dumps(response.content)))
+        conn.commit()
+
+    def invalidate(self, entry_id:str):
+        conn = self._conn()
+        conn.execute("DELETE FROM responses WHERE entry_id=?", (entry_id,))
+        conn.commit()
+
+    def purge_expired(self, now:float):
+        conn = self._conn()
+        conn.execute("DELETE FROM responses WHERE expires<=?", (now,))
+        conn.commit()
+
+
+class ResponseCache(object):
+    """
+    TTL + LRU cache of lookup responses, keyed by request and grouped by the entry ID they are about.
+    Only successful (200) responses are cached.
+    """
+    def __init__(self, ttl:float=300, max_entries:int=10000, sqlite_path:Union[str,None]=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backing = SQLiteBacking(sqlite_path) if sqlite_path else None
+        if self.backing:
+            self.backing.purge_expired(time())
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()       # key -> (expires, entry_id, CachedResponse)
+        self._keys_for_id = {}              # entry_id -> set of keys
+        self._in_flight = {}                # key -> (Future, entry_id)
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key:str, entry_id:str, expires:float, response:CachedResponse):
+        self._entries[key] = (expires, entry_id, response)
+        self._entries.move_to_end(key)
+        self._keys_for_id.setdefault(entry_id, set()).add(key)
+        while len(self._entries)>self.max_entries:
+            old_key, (_, old_id, _) = self._entries.popitem(last=False)
+            self._forget_key(old_key, old_id)
+
+    def _forget_key(self, key:str, entry_id:str):
+        keys = self._keys_for_id.get(entry_id)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys)==0:
+                del self._keys_for_id[entry_id]
+
+    def _lookup(self, key:str, now:float) -> Union[CachedResponse,None]:
+        cached = self._entries.get(key)
+        if cached is not None:
+            expires, entry_id, response = cached
+            if expires>now:
+                self._entries.move_to_end(key)
+                return response
+            del self._entries[key]
+            self._forget_key(key, entry_id)
+        return None
+
+    def get_or_load(self, key:str, entry_id:str, loader:Callable[[], CachedResponse]) -> CachedResponse:
+        """
+        Returns the cached response for `key`, or calls `loader` to get it.  If another thread is already loading the
+        same key then this waits for its result instead of making a second request.
+        """
+        now = time()
+        with self._lock:
+            response = self._lookup(key, now)
+            if response is not None:
+                self.hits += 1
+                return response
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = (future, entry_id)
+            else:
+                future = in_flight[0]
+
+        if not owner:
+            with self._lock:
+                self.hits += 1
+            return future.result()
+
+        try:
+            stored = self.backing.get(key, now) if self.backing else None
+            if stored is not None:
+                # it keeps the expiry it was first stored with, so that restarts and evictions don't extend its life
+                expires, response = stored
+                with self._lock:
+                    self.hits += 1
+                    self._store(key, entry_id, expires, response)
+            else:
+                with self._lock:
+                    self.misses += 1
+                response = loader()
+                if response.status_code==200:
+                    expires = time() + self.ttl
+                    with self._lock:
+                        # don't cache it if the entry was invalidated while we were loading
+                        still_wanted = self._is_owner(key, future)
+                        if still_wanted:
+                            self._store(key, entry_id, expires, response)
+                    if still_wanted and self.backing:
+                        self.backing.put(key, entry_id, expires, response)
+            future.set_result(response)
+            return response
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._is_owner(key, future):
+                    del self._in_flight[key]
+
+    def _is_owner(self, key:str, future:Future) -> bool:
+        in_flight = self._in_flight.get(key)
+        return in_flight is not None and in_flight[0] is future
+
+    def invalidate(self, entry_id:str):
+        """
+        drops everything cached about the given entry
+        """
+        with self._lock:
+            for key in self._keys_for_id.pop(entry_id, set()):
+                self._entries.pop(key, None)
+            for key in [k for k, (_, in_flight_id) in self._in_flight.items() if in_flight_id==entry_id]:
+                del self._in_flight[key]
+        if self.backing:
+            self.backing.invalidate(entry_id)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Watches lightbox bulk restores from Glacier and reports when each file becomes downloadable.
+
+Any number of bulks are watched at once from a single asyncio loop.  Each bulk's summary, from
+/api/archive/bulkStatus/:user/:bulkId, is polled on a schedule that follows the expected latency of the restore tier:
+there are a few widely-spaced polls before the earliest time the restore could be done, frequent ones during the window
+in which it is expected to finish, and a gradual back-off after that.  The per-file status endpoint,
+/api/archive/status/:fileId, is only called when the summary shows that more files have become available.  It is then
+called for the files that are not yet known to be downloadable, with a bounded number in flight.
+
+Events are written to stdout as NDJSON: bulk_status, file_available, file_lost and bulk_complete.
+
+The lightbox endpoints look up the user from the session, even for HMAC-signed requests.  Use --cookie to pass the
+PLAY_SESSION cookie of a logged-in user.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
+from typing import Callable, Union
+from urllib.parse import quote, urlencode
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST, parse_zoned_datetime
+
+logger = logging.getLogger(__name__)
+
+# (earliest, latest) expected completion in seconds, from the S3 documentation for each retrieval tier.
+# The server doesn't set a tier when it requests a restore, so S3 uses "standard".
+RESTORE_TIERS = {
+    "expedited": (60, 5*60),
+    "standard": (3*3600, 5*3600),
+    "bulk": (5*3600, 12*3600),
+    "deep-archive-standard": (9*3600, 12*3600),
+    "deep-archive-bulk": (24*3600, 48*3600),
+}
+
+DOWNLOADABLE_STATUSES = ("RS_SUCCESS", "RS_UNNEEDED", "RS_ALREADY")
+
+
+class RestoreStatusError(Exception):
+    pass
+
+
+class PollSchedule(object):
+    """
+    Works out how long to wait before the next poll of a restore, given how long it has been running.
+    :param tier: one of the keys of RESTORE_TIERS
+    :param min_interval: shortest wait between polls, in seconds
+    :param max_interval: longest wait between polls, in seconds
+    """
+    def __init__(self, tier:str="standard", min_interval:float=30, max_interval:float=3600):
+        self.window_start, self.window_end = RESTORE_TIERS[tier]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # poll about 20 times across the expected completion window
+        self.window_interval = max(min_interval, (self.window_end - self.window_start)/20.0)
+
+    def next_interval(self, elapsed:float) -> float:
+        if elapsed<self.window_start:
+            # halve the remaining time until the window opens, so we arrive at it in a few polls
+            interval = max((self.window_start - elapsed)/2.0, self.window_interval)
+        elif elapsed<=self.window_end:
+            interval = self.window_interval
+        else:
+            # overdue: back off gradually in case it is just slow
+            interval = self.window_interval + (elapsed - self.window_end)/4.0
+        return min(self.max_interval, max(self.min_interval, interval))
+
+
+class BulkState(object):
+    def __init__(self, bulk_id:str, started_at:float):
+        self.bulk_id = bulk_id
+        self.started_at = started_at
+        self.members = None             # file IDs in the bulk, looked up the first time they are needed
+        self.pending = None             # file IDs not yet downloadable or lost
+        self.downloadable_seen = 0
+        self.polls = 0
+
+
+class RestoreWatcher(object):
+    """
+    Watches bulk restores, calling `on_event(dict)` for everything it sees.
+    The client is a normal (blocking) ArchiveHunterClient; its calls are run on a thread pool.
+    :param concurrency: maximum number of requests in flight at once, across all bulks
+    """
+    def __init__(self, client:ArchiveHunterClient, user:str="my", schedule:Union[PollSchedule,None]=None,
+                 on_event:Callable=None, concurrency:int=8, page_size:int=500,
+                 clock:Callable[[], float]=time, sleep:Callable=asyncio.sleep):
+        self.client = client
+        self.user = user
+        self.schedule = schedule or PollSchedule()
+        self.on_event = on_event or (lambda event: None)
+        self.page_size = page_size
+        self.clock = clock
+        self.sleep = sleep
+        self.requests = 0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = None
+        self._concurrency = concurrency
+
+    async def _get(self, path:str) -> dict:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        async with self._semaphore:
+            self.requests += 1
+            response = await asyncio.get_running_loop().run_in_executor(self._executor, self.client.get, path)
+        if response.status_code==404:
+            return None
+        if response.status_code!=200:
+            raise RestoreStatusError("{0} returned {1}: {2}".format(path, response.status_code, response.text[:512]))
+        return response.json()
+
+    def emit(self, event:str, bulk_id:str, **details):
+        details.update({"event": event, "bulkId": bulk_id, "time": self.clock()})
+        self.on_event(details)
+
+    async def bulk_status(self, bulk_id:str) -> dict:
+        result = await self._get("/api/archive/bulkStatus/{0}/{1}".format(quote(self.user, safe=""), quote(bulk_id, safe="")))
+        if result is None:
+            raise RestoreStatusError("Bulk {0} was not found".format(bulk_id))
+        return result["entry"]
+
+    async def bulk_members(self, bulk_id:str) -> list:
+        members = []
+        while True:
+            params = urlencode({"start": len(members), "size": self.page_size, "bulkId": bulk_id, "user": self.user})
+            page = await self._get("/api/search/myLightBox?" + params)
+            members.extend(e["id"] for e in page["entries"])
+            if len(page["entries"])==0 or len(members)>=page["entryCount"]:
+                return members
+
+    async def file_status(self, file_id:str) -> Union[dict,None]:
+        return await self._get("/api/archive/status/{0}?{1}".format(quote(file_id, safe=""), urlencode({"user": self.user})))
+
+    async def check_files(self, state:BulkState):
+        if state.members is None:
+            state.members = await self.bulk_members(state.bulk_id)
+            state.pending = set(state.members)
+
+        file_ids = sorted(state.pending)
+        results = await asyncio.gather(*[self.file_status(f) for f in file_ids], return_exceptions=True)
+        for file_id, result in zip(file_ids, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not check {0}: {1}".format(file_id, result))
+            elif result is None:
+                state.pending.discard(file_id)
+                self.emit("file_lost", state.bulk_id, fileId=file_id)
+            elif result["restoreStatus"] in DOWNLOADABLE_STATUSES:
+                state.pending.discard(file_id)
+                self.emit("file_available", state.bulk_id, fileId=file_id, restoreStatus=result["restoreStatus"], expiry=result.get("expiry"))
+
+    async def watch_bulk(self, bulk_id:str, started_at:Union[float,None]=None) -> BulkState:
+        """
+        Polls the bulk until nothing in it is still restoring.
+        :param started_at: epoch time the restore was requested; defaults to now
+        """
+        state = BulkState(bulk_id, started_at if started_at is not None else self.clock())
+        while True:
+            stats = await self.bulk_status(bulk_id)
+            state.polls += 1
+            self.emit("bulk_status", bulk_id, **stats)
+
+            finished = stats["inProgress"]==0
+            downloadable = stats["available"] + stats["unneeded"]
+            # the final check picks up anything whose status changed without the counts changing
+            if downloadable>state.downloadable_seen or (finished and (state.pending is None or len(state.pending)>0)):
+                await self.check_files(state)
+                state.downloadable_seen = downloadable
+
+            if finished:
+                self.emit("bulk_complete", bulk_id, polls=state.polls, waiting=len(state.pending or []), **stats)
+                return state
+
+            await self.sleep(self.schedule.next_interval(self.clock() - state.started_at))
+
+    async def watch(self, bulks:dict) -> list:
+        """
+        Watches several bulks at once
+        :param bulks: bulk ID -> epoch time the restore was requested, or None for now
+        :return: list of BulkState, or the exception for any bulk that could not be watched
+        """
+        try:
+            return await asyncio.gather(*[self.watch_bulk(b, t) for b, t in bulks.items()], return_exceptions=True)
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+def bulk_start_times(client:ArchiveHunterClient, user:str, bulk_ids:list) -> dict:
+    """
+    Looks up when each bulk was created, which is when its restores were requested
+    """
+    response = client.get("/api/lightbox/{0}/bulks".format(quote(user, safe="")))
+    if response.status_code!=200:
+        raise RestoreStatusError("Could not list bulks, server returned {0}: {1}".format(response.status_code, response.text[:512]))
+    added = {b["id"]: parse_zoned_datetime(b["addedAt"]).timestamp() for b in response.json()["entries"] if b.get("addedAt")}
+    return {b: added.get(b) for b in bulk_ids}
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Watch lightbox bulk restores and report files as they become downloadable")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("--cookie", dest="cookie", help="PLAY_SESSION cookie value of the user whose lightbox is being watched")
+    parser.add_argument("--user", dest="user", default="my", help="lightbox owner, for admins watching someone else's bulks")
+    parser.add_argument("-b", "--bulk", dest="bulks", action="append", required=True, help="bulk ID to watch. Can be given more than once")
+    parser.add_argument("--tier", dest="tier", default="standard", choices=sorted(RESTORE_TIERS.keys()), help="Glacier retrieval tier the restores were requested with")
+    parser.add_argument("--min-interval", dest="min_interval", type=float, default=30, help="shortest time between polls of a bulk, in seconds")
+    parser.add_argument("--max-interval", dest="max_interval", type=float, default=3600, help="longest time between polls of a bulk, in seconds")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=8, help="maximum number of status requests in flight")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency)
+    if args.cookie:
+        client.session.cookies.set("PLAY_SESSION", args.cookie, domain=args.host.split(":")[0])
+
+    try:
+        bulks = bulk_start_times(client, args.user, args.bulks)
+    except RestoreStatusError as e:
+        logger.warning("{0}; timing polls from now instead".format(e))
+        bulks = {b: None for b in args.bulks}
+
+    def print_event(event):
+        print(json.dumps(event), flush=True)
+
+    watcher = RestoreWatcher(client, args.user, PollSchedule(args.tier, args.min_interval, args.max_interval), print_event, args.concurrency)
+    results = asyncio.run(watcher.watch(bulks))
+    failed = [(b, r) for b, r in zip(bulks.keys(), results) if isinstance(r, Exception)]
+    for bulk_id, error in failed:
+        logger.error("Could not watch {0}: {1}".format(bulk_id, error))
+    logger.info("Finished at {0} after {1} status requests".format(datetime.now(timezone.utc).isoformat(), watcher.requests))
+    exit(1 if len(failed)>0 else 0)
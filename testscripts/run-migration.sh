@@ -27,11 +27,15 @@ else
   echo DATADIR is $DATADIR
 fi
 
-if [ "${DELAY}" == "" ]; then
-  echo No DELAY specified, using 2s
-  export DELAY="2s"
+if [ "${RATE}" == "" ]; then
+  echo No RATE specified, using 0.5 moves per second
+  export RATE="0.5"
 else
-  echo DELAY is $DELAY
+  echo RATE is $RATE moves per second
+fi
+
+if [ "${CONCURRENCY}" == "" ]; then
+  export CONCURRENCY=1
 fi
 
 echo ------------------------------------------------------
@@ -48,17 +52,12 @@ fi
 FILECOUNT=$(wc -l "$DATADIR/${BUCKET}.txt")
 echo ${BUCKET} has ${FILECOUNT} items to migrate
 
-IFS='
-'
-
-for entry in `cat "$DATADIR/${BUCKET}.txt"`; do
-  python3 /usr/local/bin/request-move-file.py --host="${HOST}" --secret="${SECRET}" --dest="${DEST}" --id="${entry}"
-  if [ "$?" != "0" ]; then
-    echo request-move-file failed with error $?
-    exit 1
-  fi
-  sleep "${DELAY}"
-done
+python3 /usr/local/bin/request-move-file.py --host="${HOST}" --secret="${SECRET}" --dest="${DEST}" --input="$DATADIR/${BUCKET}.txt" \
+  --journal="$DATADIR/${BUCKET}.journal" --rate="${RATE}" --concurrency="${CONCURRENCY}"
+if [ "$?" != "0" ]; then
+  echo request-move-file failed with error $?, see $DATADIR/${BUCKET}.journal. Re-run to retry the failed items.
+  exit 1
+fi
 
 echo ------------------------------------------------------
 echo Migration run completed at $(date "+%Y-%m-%d %H:%M:%S")
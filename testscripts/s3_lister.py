@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Iterative and prefix-sharded listing of S3 buckets.
+
+`iterate_keys` pages through a bucket (or one prefix of it) with list_objects_v2 in a single stream.
+`list_sharded` first uses delimiter listings to split the keyspace into prefixes, lists those shards concurrently and
+then yields the keys in the same (lexicographic) order that a single serial listing would have produced.
+"""
+
+import json
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+
+def iterate_pages(client, bucket:str, prefix:Union[str,None]=None, delimiter:Union[str,None]=None, page_size:int=1000):
+    """
+    Generator that yields each list_objects_v2 response page in turn
+    """
+    s3_args = {
+        "Bucket": bucket,
+        "MaxKeys": page_size,
+    }
+    if prefix:
+        s3_args["Prefix"] = prefix
+    if delimiter:
+        s3_args["Delimiter"] = delimiter
+
+    while True:
+        response = client.list_objects_v2(**s3_args)
+        yield response
+        if not response.get("IsTruncated") or "NextContinuationToken" not in response:
+            break
+        s3_args["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def iterate_keys(client, bucket:str, prefix:Union[str,None]=None, page_size:int=1000):
+    """
+    Generator that yields every key in the bucket (under the prefix, if given) in S3 listing order.
+    Pages with no "Contents" (e.g. an empty bucket or prefix) are handled.
+    """
+    for response in iterate_pages(client, bucket, prefix, page_size=page_size):
+        for entry in response.get("Contents", []):
+            yield entry["Key"]
+
+
+def discover_shards(client, bucket:str, prefix:Union[str,None], delimiter:str="/", depth:int=1) -> list:
+    """
+    Splits the keyspace under `prefix` into shards by listing with a delimiter.
+    :return: sorted list of (name, is_prefix) tuples. `is_prefix` shards must be listed in full, the others are single
+    keys that live directly at a discovered level.
+    """
+    shards = []
+    for response in iterate_pages(client, bucket, prefix, delimiter=delimiter):
+        for entry in response.get("Contents", []):
+            shards.append((entry["Key"], False))
+        for common_prefix in response.get("CommonPrefixes", []):
+            if depth>1:
+                shards.extend(discover_shards(client, bucket, common_prefix["Prefix"], delimiter, depth-1))
+            else:
+                shards.append((common_prefix["Prefix"], True))
+    # a key that is not under a prefix sorts entirely before or after all of the keys under it, so sorting the shard
+    # names gives the same order as a flat listing
+    return sorted(shards)
+
+
+def _list_shard_to_spool(client, bucket:str, prefix:str, page_size:int, spool_size:int):
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size, mode="w+")
+    count = 0
+    for key in iterate_keys(client, bucket, prefix, page_size):
+        spool.write(json.dumps(key))    #keys can legitimately contain newlines, so they are JSON-quoted in the spool
+        spool.write("\n")
+        count += 1
+    spool.seek(0)
+    logger.debug("Shard {0} has {1} keys".format(prefix, count))
+    return spool
+
+
+def list_sharded(client, bucket:str, prefix:Union[str,None]=None, concurrency:int=8, delimiter:str="/", depth:int=1,
+                 page_size:int=1000, spool_size:int=64*1024*1024):
+    """
+    Generator that yields every key under the prefix, listing delimiter-discovered shards concurrently.
+    Output order is deterministic and identical to `iterate_keys`. Each shard is buffered in a spooled temporary file,
+    which stays in memory up to `spool_size` bytes and goes to disk after that, and only `concurrency`*2 shards are
+    scheduled ahead of the one being output.
+    """
+    shards = discover_shards(client, bucket, prefix, delimiter, depth)
+    logger.info("Listing {0} in {1} shards".format(bucket, len(shards)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = []
+        shard_iter = iter(shards)
+
+        def schedule_next():
+            for name, is_prefix in shard_iter:
+                if is_prefix:
+                    pending.append(executor.submit(_list_shard_to_spool, client, bucket, name, page_size, spool_size))
+                else:
+                    pending.append(name)
+                return
+
+        for _ in range(concurrency*2):
+            schedule_next()
+
+        while len(pending)>0:
+            item = pending.pop(0)
+            schedule_next()
+            if isinstance(item, str):
+                yield item
+            else:
+                with item.result() as spool:
+                    for line in spool:
+                        yield json.loads(line)
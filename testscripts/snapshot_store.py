@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""
+Keeps a local SQLite snapshot of a collection's entries so that questions about it can be answered offline, without
+loading the production Elasticsearch cluster.  Examples are "which files under this path are over 10GB" or "what is
+still in Glacier".
+
+Entries are read from POST /api/search/browser, sorted by last_modified.  Elasticsearch won't page past its result
+window (10,000 hits by default), so the listing is split into windows.  Each window starts at the last modification
+time seen in the one before, using a last_modified range query.  The pages within a window are fetched concurrently.
+Entries are upserted by ID, so the overlap at each window boundary does no harm.
+
+--load reads a whole collection, or one path within it, and then removes any snapshot entries in that scope that the
+server no longer has.  --refresh only reads entries modified since the newest one in the snapshot.  It picks up new
+and replaced files, but not deletions or changes to flags such as proxied; use --load for those.
+
+With neither option, the snapshot is queried.  The filters are indexed: path prefix, size, MIME type, storage class
+and deletion.  --sql runs a read-only statement against the `entries` table for anything else.
+"""
+
+import json
+import logging
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from time import time
+from typing import Iterable, Iterator, Union
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST, parse_zoned_datetime
+from bulk_runner import request_with_backoff, run_bulk
+
+logger = logging.getLogger(__name__)
+
+# index.max_result_window, the Elasticsearch default
+MAX_RESULT_WINDOW = 10000
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotStore(object):
+    """
+    SQLite store of collection entries.  Every column used by the query filters is indexed; the full entry is kept as
+    JSON alongside.
+    """
+    COLUMNS = ["id", "collection", "path", "size", "mime_major", "mime_minor", "storage_class", "last_modified",
+               "proxied", "been_deleted", "etag", "generation", "entry"]
+
+    def __init__(self, path:str, read_only:bool=False):
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect("file:{0}?mode=ro".format(path), uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (id TEXT PRIMARY KEY, collection TEXT NOT NULL, path TEXT NOT NULL, "
+                          "size INTEGER, mime_major TEXT, mime_minor TEXT, storage_class TEXT, last_modified REAL, "
+                          "proxied INTEGER, been_deleted INTEGER, etag TEXT, generation INTEGER NOT NULL, entry TEXT NOT NULL)")
+        for name, columns in [("collection_path", "collection, path"), ("collection_size", "collection, size"),
+                              ("collection_mime", "collection, mime_major, mime_minor"),
+                              ("collection_storage", "collection, storage_class"),
+                              ("collection_modified", "collection, last_modified")]:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_{0} ON entries ({1})".format(name, columns))
+        self.conn.commit()
+
+    @staticmethod
+    def row(entry:dict, generation:int) -> tuple:
+        mime = entry.get("mimeType") or {}
+        return (entry["id"], entry["bucket"], entry["path"], entry.get("size"), mime.get("major"), mime.get("minor"),
+                entry.get("storageClass"), parse_zoned_datetime(entry["last_modified"]).timestamp() if entry.get("last_modified") else None,
+                1 if entry.get("proxied") else 0, 1 if entry.get("beenDeleted") else 0, entry.get("etag"), generation,
+                json.dumps(entry, separators=(",", ":")))
+
+    def upsert(self, entries:Iterable[dict], generation:int) -> int:
+        rows = [self.row(e, generation) for e in entries]
+        self.conn.executemany("INSERT OR REPLACE INTO entries ({0}) VALUES ({1})".format(",".join(self.COLUMNS), ",".join("?"*len(self.COLUMNS))), rows)
+        return len(rows)
+
+    def newest(self, collection:str) -> Union[float,None]:
+        return self.conn.execute("SELECT MAX(last_modified) FROM entries WHERE collection=?", (collection,)).fetchone()[0]
+
+    def remove_stale(self, collection:str, path:Union[str,None], generation:int) -> int:
+        """
+        removes the entries under `path` (or the whole collection) that were not seen by load `generation`
+        """
+        sql, params = path_filter(path)
+        cursor = self.conn.execute("DELETE FROM entries WHERE collection=? AND generation!=?" + sql, [collection, generation] + params)
+        return cursor.rowcount
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def path_filter(path:Union[str,None]) -> (str, list):
+    """
+    SQL clause matching everything under `path`, written as a range so that the (collection, path) index is used
+    """
+    if not path:
+        return "", []
+    prefix = path.rstrip("/") + "/"
+    return " AND path>=? AND path<?", [prefix, prefix[:-1] + chr(ord("/") + 1)]
+
+
+def search_body(collection:str, path:Union[str,None], since:Union[float,None]) -> dict:
+    body = {"collection": collection, "sortBy": "last_modified", "sortOrder": "asc"}
+    if path:
+        # the path field is indexed with a path hierarchy tokenizer, whose tokens have no trailing slash
+        body["path"] = path.rstrip("/")
+    if since is not None:
+        # a millisecond early, so that float rounding can't drop entries modified at exactly `since`
+        body["q"] = 'last_modified:["{0}" TO *]'.format(format_timestamp(since - 0.001))
+    return body
+
+
+def format_timestamp(timestamp:float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def fetch_page(client:ArchiveHunterClient, body:dict, start:int, size:int, retries:int=3) -> dict:
+    uri = "/api/search/browser?start={0}&size={1}".format(start, size)
+    response = request_with_backoff(lambda: client.post(uri, body), max_retries=retries)
+    if response.status_code!=200:
+        raise SnapshotError("Page at {0} failed, server returned {1}: {2}".format(start, response.status_code, response.text[:512]))
+    return response.json()
+
+
+def iterate_windows(client:ArchiveHunterClient, collection:str, path:Union[str,None]=None, since:Union[float,None]=None,
+                    page_size:int=500, concurrency:int=4, window:int=MAX_RESULT_WINDOW, retries:int=3) -> Iterator[list]:
+    """
+    Generator that yields pages of entries modified at or after `since`, oldest first by window.  Pages within a window
+    arrive in completion order.
+    """
+    while True:
+        body = search_body(collection, path, since)
+        first = fetch_page(client, body, 0, page_size, retries)
+        yield first["entries"]
+        window_end = min(first["entryCount"], window)
+        newest = [last_modified(first["entries"])]
+
+        def fetch(start):
+            return fetch_page(client, body, start, min(page_size, window_end - start), retries)
+
+        for start, page, error in run_bulk(range(page_size, window_end, page_size), fetch, concurrency):
+            if error:
+                raise SnapshotError("Could not read {0} from {1}: {2}".format(collection, start, error))
+            newest.append(last_modified(page["entries"]))
+            yield page["entries"]
+
+        if first["entryCount"]<=window:
+            return
+        next_since = max(t for t in newest if t is not None)
+        if since is not None and next_since<=since:
+            raise SnapshotError("More than {0} entries were modified at {1}, so the listing can't get past them".format(window, format_timestamp(since)))
+        since = next_since
+
+
+def last_modified(entries:list) -> Union[float,None]:
+    times = [parse_zoned_datetime(e["last_modified"]).timestamp() for e in entries if e.get("last_modified")]
+    return max(times) if len(times)>0 else None
+
+
+def load(client:ArchiveHunterClient, store:SnapshotStore, collection:str, path:Union[str,None]=None, refresh:bool=False,
+         page_size:int=500, concurrency:int=4, window:int=MAX_RESULT_WINDOW) -> dict:
+    """
+    Loads a collection (or the part of it under `path`) into the store.
+    :param refresh: if True, only read entries modified since the newest one in the store, and don't remove anything
+    :return: dict of counts: loaded and removed
+    """
+    generation = int(time()*1000)
+    since = store.newest(collection) if refresh else None
+    if refresh and since is None:
+        logger.info("Nothing in the snapshot for {0} yet, loading all of it".format(collection))
+    loaded = 0
+    for entries in iterate_windows(client, collection, path, since, page_size, concurrency, window):
+        loaded += store.upsert(entries, generation)
+        store.commit()
+    removed = 0
+    if not refresh:
+        removed = store.remove_stale(collection, path, generation)
+    store.commit()
+    return {"loaded": loaded, "removed": removed}
+
+
+def where_clause(collection:Union[str,None]=None, path:Union[str,None]=None, min_size:Union[int,None]=None,
+                 max_size:Union[int,None]=None, mime:Union[str,None]=None, storage_class:Union[str,None]=None,
+                 deleted:Union[bool,None]=None) -> (str, list):
+    """
+    builds the WHERE clause for the query filters; see `query`
+    """
+    sql = " WHERE 1=1"
+    params = []
+    if collection:
+        sql += " AND collection=?"
+        params.append(collection)
+    path_sql, path_params = path_filter(path)
+    sql += path_sql
+    params += path_params
+    if min_size is not None:
+        sql += " AND size>=?"
+        params.append(min_size)
+    if max_size is not None:
+        sql += " AND size<=?"
+        params.append(max_size)
+    if mime:
+        major, _, minor = mime.partition("/")
+        sql += " AND mime_major=?"
+        params.append(major)
+        if minor:
+            sql += " AND mime_minor=?"
+            params.append(minor)
+    if storage_class:
+        sql += " AND storage_class=?"
+        params.append(storage_class)
+    if deleted is not None:
+        sql += " AND been_deleted=?"
+        params.append(1 if deleted else 0)
+    return sql, params
+
+
+def query(store:SnapshotStore, limit:Union[int,None]=None, **filters) -> Iterator[dict]:
+    """
+    Generator that yields the stored entries matching all of the given filters, in path order
+    :param filters: any of collection, path, min_size, max_size, mime (major type such as "video", or major/minor such as
+    "video/mp4"), storage_class and deleted
+    """
+    sql, params = where_clause(**filters)
+    sql = "SELECT entry FROM entries" + sql + " ORDER BY collection, path"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    for row in store.conn.execute(sql, params):
+        yield json.loads(row[0])
+
+
+def count(store:SnapshotStore, **filters) -> (int, int):
+    """
+    :return: tuple of (number of entries, total size) matching the filters, as for `query`
+    """
+    sql, params = where_clause(**filters)
+    row = store.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries" + sql, params).fetchone()
+    return row[0], row[1]
+
+
+def parse_size(value:str) -> int:
+    """
+    parses a size such as 500, 20M or 10G (binary units)
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1])*units[value[-1]])
+    return int(value)
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Keep a local snapshot of collection entries and query it offline")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", help="shared secret to use. Only needed for --load and --refresh")
+    parser.add_argument("-d", "--db", dest="db", required=True, help="SQLite file holding the snapshot")
+    parser.add_argument("-c", "--collection", dest="collection", help="collection to load, refresh or query")
+    parser.add_argument("-p", "--path", dest="path", help="only load or query entries under this path")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--load", dest="load", action="store_true", default=False, help="load the collection (or --path) in full, removing entries that have gone")
+    mode.add_argument("--refresh", dest="refresh", action="store_true", default=False, help="load only entries modified since the newest one in the snapshot")
+    mode.add_argument("--sql", dest="sql", help="run this read-only SQL against the entries table and print the rows as JSON")
+    parser.add_argument("--page-size", dest="page_size", type=int, default=500, help="entries per search page")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=4, help="number of pages to fetch at once")
+    parser.add_argument("--min-size", dest="min_size", help="only entries at least this big, e.g. 10G")
+    parser.add_argument("--max-size", dest="max_size", help="only entries at most this big")
+    parser.add_argument("--mime", dest="mime", help="only entries of this MIME type, e.g. video or video/mp4")
+    parser.add_argument("--storage-class", dest="storage_class", help="only entries in this storage class, e.g. GLACIER")
+    parser.add_argument("--deleted", dest="deleted", action="store_true", default=None, help="only entries that have been deleted")
+    parser.add_argument("--not-deleted", dest="deleted", action="store_false", help="only entries that have not been deleted")
+    parser.add_argument("--limit", dest="limit", type=int, help="return at most this many entries")
+    parser.add_argument("--format", dest="format", default="path", choices=["path", "id", "json"], help="what to print for each entry")
+    parser.add_argument("--count", dest="count", action="store_true", default=False, help="only print the number of matching entries and their total size")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.load or args.refresh:
+        if not args.secret or not args.collection:
+            parser.error("--secret and --collection are required to load")
+        store = SnapshotStore(args.db)
+        client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency)
+        try:
+            counts = load(client, store, args.collection, args.path, args.refresh, args.page_size, args.concurrency)
+        except SnapshotError as e:
+            logger.error(str(e))
+            exit(1)
+        finally:
+            store.close()
+        logger.info("{0} entries loaded, {1} removed".format(counts["loaded"], counts["removed"]))
+    else:
+        store = SnapshotStore(args.db, read_only=True)
+        try:
+            if args.sql:
+                for row in store.conn.execute(args.sql):
+                    print(json.dumps(row))
+            else:
+                filters = {
+                    "collection": args.collection,
+                    "path": args.path,
+                    "min_size": parse_size(args.min_size) if args.min_size else None,
+                    "max_size": parse_size(args.max_size) if args.max_size else None,
+                    "mime": args.mime,
+                    "storage_class": args.storage_class,
+                    "deleted": args.deleted,
+                }
+                if args.count:
+                    matched, total_size = count(store, **filters)
+                    print(json.dumps({"count": matched, "totalSize": total_size}))
+                else:
+                    for entry in query(store, args.limit, **filters):
+                        print(json.dumps(entry) if args.format=="json" else entry[args.format])
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            exit(1)
+        finally:
+            store.close()
@@ -0,0 +1,19 @@
+import importlib.util
+import os
+import sys
+
+SCRIPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# the scripts under test live in the directory above this one and are not installed as a package
+sys.path.insert(0, SCRIPT_DIR)
+
+
+def load_script(filename:str):
+    """
+    imports one of the hyphenated command-line scripts as a module, without running its main block
+    """
+    name = filename.replace("-", "_").replace(".py", "")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,37 @@
+import pytest
+
+from archive_ids import make_doc_id, encode_batch, iterate_ids, MAX_ID_LENGTH
+
+# these are also checked against the server implementation in
+# common/src/test/scala/com/theguardian/multimedia/archivehunter/DocIdSpec.scala, so if you change one then change the other
+GOLDEN = [
+    ("test-bucket", "test/path/to/file.ext", "dGVzdC1idWNrZXQ6dGVzdC9wYXRoL3RvL2ZpbGUuZXh0"),
+    ("bucket", "café/naïve.mov", "YnVja2V0OmNhZukvbmHvdmUubW92"),
+    ("bucket", "映像/素材.mp4", "YnVja2V0OiDPLyBQLm1wNA=="),
+    ("bucket", "clip🎬.mov", "YnVja2V0OmNsaXA8rC5tb3Y="),
+    ("archive-bucket", "long/" + "0123456789"*38 + ".mxf", "YXJjaGl2ZS1idWNrZXQ6bG9uZy8wMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OTAxMjM0NTY3ODkwMTIzNDU2Nzg5MDEyMzQ1Njc4OS5teGY="),
+    ("b", "z"*388, "Yjp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enpp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp6enp"),
+]
+
+
+@pytest.mark.parametrize("bucket,key,expected", GOLDEN)
+def test_make_doc_id_golden(bucket, key, expected):
+    assert make_doc_id(bucket, key) == expected
+
+
+@pytest.mark.parametrize("bucket", ["b", "bu", "buc", "test-bucket", "bucket"])
+def test_encode_batch_matches_make_doc_id(bucket):
+    keys = [key for b, key, _ in GOLDEN] + ["", "a", "ab", "x"*300, "y"*380, "y"*560]
+    assert encode_batch(bucket, keys) == [make_doc_id(bucket, key) for key in keys]
+    assert all(len(doc_id)<=MAX_ID_LENGTH for doc_id in encode_batch(bucket, keys))
+
+
+def test_too_long_paths():
+    with pytest.raises(ValueError):
+        make_doc_id("b", "y"*580)
+    assert encode_batch("b", ["y"*580, "short"]) == [None, make_doc_id("b", "short")]
+
+
+def test_iterate_ids_chunks():
+    keys = ["path/{0}".format(i) for i in range(25)]
+    assert list(iterate_ids("bucket", iter(keys), chunk_size=10)) == [(key, make_doc_id("bucket", key)) for key in keys]
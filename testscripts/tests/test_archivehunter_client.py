@@ -0,0 +1,81 @@
+import base64
+import hashlib
+import hmac
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from archivehunter_client import (ArchiveHunterClient, HMACSigner, HttpDateCache, checksum, parse_zoned_datetime, signing_path,
+                                  EMPTY_CHECKSUM)
+
+
+def reference_hmac(secret, httpdate, content_length, content_checksum, method, request_uri):
+    """
+    straight port of auth.HMAC.calculateHmac on the server side
+    """
+    string_to_sign = "{}\n{}\n{}\n{}\n{}".format(httpdate, content_length, content_checksum, method, request_uri)
+    digest = hmac.new(secret.encode("UTF-8"), string_to_sign.encode("UTF-8"), hashlib.sha384).digest()
+    return "HMAC " + base64.b64encode(digest).decode("UTF-8")
+
+
+def test_signing_path_includes_query_only_when_present():
+    assert signing_path("https://host/api/proxy/abcd/all") == "/api/proxy/abcd/all"
+    assert signing_path("https://host/api/move/abcd?to=bucket") == "/api/move/abcd?to=bucket"
+    assert signing_path("/api/search/browser?start=0&size=100") == "/api/search/browser?start=0&size=100"
+
+
+def test_signature_matches_server_calculation():
+    signer = HMACSigner("s3cr3t")
+    body = b'{"collection": "my-bucket"}'
+    uri = "https://host/api/search/browser?start=100&size=100"
+    token, httpdate = signer.get_token(uri, "POST", body, checksum(body))
+
+    assert token == reference_hmac("s3cr3t", httpdate, len(body), checksum(body), "POST", "/api/search/browser?start=100&size=100")
+
+
+def test_signer_is_reusable():
+    signer = HMACSigner("s3cr3t")
+    first = signer.sign("/api/entry/a", "GET", 0, EMPTY_CHECKSUM, "Mon, 01 Jan 2024 00:00:00 GMT")
+    second = signer.sign("/api/entry/b", "GET", 0, EMPTY_CHECKSUM, "Mon, 01 Jan 2024 00:00:00 GMT")
+    again = signer.sign("/api/entry/a", "GET", 0, EMPTY_CHECKSUM, "Mon, 01 Jan 2024 00:00:00 GMT")
+    assert first != second
+    assert first == again
+
+
+def test_date_cache(monkeypatch):
+    import archivehunter_client
+    now = [1700000000.2]
+    monkeypatch.setattr(archivehunter_client.time, "time", lambda: now[0])
+    cache = HttpDateCache()
+    first = cache.now()
+    assert first == "Tue, 14 Nov 2023 22:13:20 GMT"
+    now[0] = 1700000000.9
+    assert cache.now() is first
+    now[0] = 1700000001.0
+    assert cache.now() == "Tue, 14 Nov 2023 22:13:21 GMT"
+
+
+def test_client_url():
+    client = ArchiveHunterClient("example.com", "secret")
+    assert client.url("/api/entry/abc") == "https://example.com/api/entry/abc"
+    assert client.url("http://other/api/entry/abc") == "http://other/api/entry/abc"
+
+
+@pytest.mark.parametrize("value,microseconds", [
+    ("2020-01-02T03:04:05Z", 0),
+    ("2020-01-02T03:04:05.1Z", 100000),
+    ("2020-01-02T03:04:05.12Z", 120000),
+    ("2020-01-02T03:04:05.123Z", 123000),
+    ("2020-01-02T03:04:05.1234Z", 123400),
+    ("2020-01-02T03:04:05.123456Z", 123456),
+    ("2020-01-02T03:04:05.123456789Z", 123456),
+    ("2020-01-02T03:04:05.123456789Z[UTC]", 123456),
+])
+def test_parse_zoned_datetime(value, microseconds):
+    # the server's ISO_OFFSET_DATE_TIME drops trailing zeros, so the fraction can have any number of digits
+    assert parse_zoned_datetime(value) == datetime(2020, 1, 2, 3, 4, 5, microseconds, tzinfo=timezone.utc)
+
+
+def test_parse_zoned_datetime_with_offset():
+    assert parse_zoned_datetime("2020-01-02T03:04:05.1234+01:00") == datetime(2020, 1, 2, 3, 4, 5, 123400, tzinfo=timezone(timedelta(hours=1)))
+    assert parse_zoned_datetime("2020-01-02T03:04:05Z").timestamp() == 1577934245
@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+
+import pytest
+
+import bulk_runner
+from conftest import load_script
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, text=""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+
+
+def test_token_bucket_limits_rate():
+    bucket = bulk_runner.TokenBucket(200, burst=1)
+    start = time.monotonic()
+    for _ in range(41):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_token_bucket_disabled():
+    bucket = bulk_runner.TokenBucket(0)
+    start = time.monotonic()
+    for _ in range(10000):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_request_with_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(bulk_runner, "sleep", delays.append)
+    responses = iter([FakeResponse(429, {"Retry-After": "3"}), FakeResponse(503), FakeResponse(200)])
+    assert bulk_runner.request_with_backoff(lambda: next(responses)).status_code == 200
+    assert delays[0] == 3.0
+    assert len(delays) == 2
+
+
+def test_request_with_backoff_gives_up(monkeypatch):
+    monkeypatch.setattr(bulk_runner, "sleep", lambda s: None)
+    assert bulk_runner.request_with_backoff(lambda: FakeResponse(503), max_retries=2).status_code == 503
+
+
+def test_journal_skips_succeeded(tmp_path):
+    path = str(tmp_path / "journal.ndjson")
+    journal = bulk_runner.Journal(path)
+    journal.record("a", True, status=200)
+    journal.record("b", False, status=500)
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"id": "c", "ok": tr')     #interrupted write
+
+    journal = bulk_runner.Journal(path)
+    assert journal.is_done("a")
+    assert not journal.is_done("b")
+    assert not journal.is_done("c")
+    journal.close()
+
+
+def test_run_bulk_bounds_concurrency():
+    lock = threading.Lock()
+    state = {"current": 0, "max": 0}
+
+    def handler(item):
+        with lock:
+            state["current"] += 1
+            state["max"] = max(state["max"], state["current"])
+        time.sleep(0.002)
+        with lock:
+            state["current"] -= 1
+        if item == 13:
+            raise ValueError("unlucky")
+        return item*2
+
+    results = {item: (result, error) for item, result, error in bulk_runner.run_bulk(iter(range(100)), handler, 5)}
+    assert len(results) == 100
+    assert state["max"] <= 5
+    assert results[7] == (14, None)
+    assert isinstance(results[13][1], ValueError)
+
+
+def test_move_bulk_uses_journal(tmp_path, monkeypatch):
+    move_file = load_script("request-move-file.py")
+    monkeypatch.setattr(bulk_runner, "sleep", lambda s: None)
+
+    class FakeClient(object):
+        def __init__(self):
+            self.uris = []
+            self.lock = threading.Lock()
+
+        def put(self, uri):
+            with self.lock:
+                self.uris.append(uri)
+                if "fail" in uri:
+                    return FakeResponse(500, text="broken")
+                if "throttled" in uri and self.uris.count(uri)==1:
+                    return FakeResponse(429)
+            return FakeResponse(200)
+
+    path = str(tmp_path / "journal.ndjson")
+    client = FakeClient()
+    ids = ["one", "two/with/slash", "throttled", "fail"]
+    journal = bulk_runner.Journal(path)
+    assert move_file.move_bulk(client, ids, "dest-bucket", journal, bulk_runner.TokenBucket(0), 2, 3) == (3, 1, 0)
+    journal.close()
+    assert "/api/move/two%2Fwith%2Fslash?to=dest-bucket" in client.uris
+
+    client = FakeClient()
+    journal = bulk_runner.Journal(path)
+    assert move_file.move_bulk(client, ids, "dest-bucket", journal, bulk_runner.TokenBucket(0), 2, 3) == (0, 1, 3)
+    journal.close()
+    assert client.uris == ["/api/move/fail?to=dest-bucket"]
+
+
+def test_iter_lines_resplits_chunks():
+    chunks = [b'{"id": "a"}\n{"i', b'd": "b"}', b"", b"\n", b'{"id": "c"}\n']
+    assert [json.loads(l)["id"] for l in bulk_runner.iter_lines(chunks)] == ["a", "b", "c"]
+
+
+def test_iter_lines_detects_truncated_stream():
+    with pytest.raises(bulk_runner.TruncatedStreamError):
+        list(bulk_runner.iter_lines([b'{"id": "a"}\n{"id": "b', b'"}']))
@@ -0,0 +1,86 @@
+import io
+import os
+import subprocess
+import sys
+
+from conftest import SCRIPT_DIR, load_script
+
+ENTRY_POINT = os.path.join(SCRIPT_DIR, "archivehunter-tools.py")
+HEAVY_MODULES = {"requests", "urllib3", "boto3", "botocore", "yaml", "numpy", "sqlite3", "concurrent"}
+
+
+def imported_modules(args, stdin=b""):
+    """
+    runs the entry point under -X importtime
+    :return: the top-level names of every module it imported
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", ENTRY_POINT] + args, input=stdin,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    names = set()
+    for line in result.stderr.decode().splitlines():
+        if line.startswith("import time:") and "|" in line:
+            names.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return names
+
+
+def test_help_imports_nothing_heavy():
+    names = imported_modules(["--help"])
+    assert "argparse" in names
+    assert names & HEAVY_MODULES == set()
+
+
+def test_empty_batch_imports_nothing_heavy():
+    names = imported_modules(["--batch", "move", "-s", "s3cr3t", "--dest", "other-bucket"])
+    assert names & HEAVY_MODULES == set()
+
+
+def test_command_gets_the_scripts_own_options():
+    result = subprocess.run([sys.executable, ENTRY_POINT, "move", "--help"], stdout=subprocess.PIPE, check=True)
+    assert b"--dest" in result.stdout
+
+
+def test_batch_runs_once_per_line(tmp_path, monkeypatch):
+    tools = load_script("archivehunter-tools.py")
+    log = tmp_path / "runs.log"
+    script = tmp_path / "fake.py"
+    script.write_text("import sys\n"
+                      "with open({0!r}, 'a') as f:\n"
+                      "    f.write(' '.join(sys.argv[1:]) + '\\n')\n"
+                      "if 'bad' in sys.argv:\n"
+                      "    exit(3)\n".format(str(log)))
+    monkeypatch.setitem(tools.COMMANDS, "move", tools.Command("fake", [str(script)], "--id"))
+    monkeypatch.setitem(tools.COMMANDS, "rundev", tools.Command("fake", [str(script)], "--collection", batch_together=True))
+
+    assert tools.main(["--batch", "move", "--dest", "x"], io.StringIO("one\n\n two \nbad\n")) == 1
+    assert log.read_text().splitlines() == ["--dest x --id one", "--dest x --id two", "--dest x --id bad"]
+
+    log.unlink()
+    assert tools.main(["--batch-args", "move", "-s", "s"], io.StringIO("--id 'a b' -q\n--id c\n")) == 0
+    assert log.read_text().splitlines() == ["-s s --id a b -q", "-s s --id c"]
+
+    log.unlink()
+    assert tools.main(["--batch", "rundev"], io.StringIO("first\nsecond\n")) == 0
+    assert log.read_text().splitlines() == ["--collection first --collection second"]
+
+    log.unlink()
+    assert tools.main(["--batch", "move"], io.StringIO("")) == 0
+    assert not log.exists()
+
+
+def test_batch_from_real_stdin_survives_a_failed_run(tmp_path):
+    log = tmp_path / "runs.log"
+    script = tmp_path / "fake.py"
+    script.write_text("import sys\n"
+                      "with open({0!r}, 'a') as f:\n"
+                      "    f.write(' '.join(sys.argv[1:]) + '\\n')\n"
+                      "exit(3 if 'bad' in sys.argv else 0)\n".format(str(log)))
+    # the command table is replaced in the child process, which then reads its real stdin
+    runner = ("import sys; sys.path.insert(0, {0!r}); from conftest import load_script\n"
+              "tools = load_script('archivehunter-tools.py')\n"
+              "tools.COMMANDS['move'] = tools.Command('fake', [{1!r}], '--id')\n"
+              "sys.exit(tools.main(['--batch', 'move']))\n").format(os.path.dirname(__file__), str(script))
+    result = subprocess.run([sys.executable, "-c", runner], input=b"bad\none\ntwo\n", stderr=subprocess.PIPE)
+
+    assert result.returncode == 1
+    assert b"1 of 3 runs failed" in result.stderr
+    assert log.read_text().splitlines() == ["--id bad", "--id one", "--id two"]
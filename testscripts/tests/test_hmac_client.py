@@ -0,0 +1,70 @@
+import io
+import json
+import threading
+
+import pytest
+
+import hmac_client
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.headers = {}
+        self._content = content
+        self.text = json.dumps(content)
+
+    def json(self):
+        return self._content
+
+
+class FakeProxyClient(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bodies = []
+
+    def post(self, uri, body=None):
+        assert uri == "/api/proxy"
+        with self.lock:
+            self.bodies.append(body)
+        if body["entryId"] == "exists":
+            return FakeResponse(409, {"status": "proxy_exists", "objectClass": "proxy_id", "objectId": "xyz"})
+        return FakeResponse(200, {"status": "ok", "objectClass": "proxy", "objectId": body["entryId"] + "-proxy"})
+
+
+CSV = """entryId,proxyBucket,proxyPath,proxyType,region
+id1,proxies,path/to/id1.mp4,video,eu-west-1
+id2,proxies,path/to/id2.mp3,AUDIO,eu-west-1
+,proxies,path/to/none.mp4,VIDEO,eu-west-1
+id3,proxies,path/to/id3.mp4,HOLOGRAM,eu-west-1
+id4,proxies,path/to/id4.mp4,VIDEO,europe
+exists,proxies,path/to/exists.jpg,THUMBNAIL,eu-west-1
+"""
+
+
+def test_bulk_set_proxies_from_csv(tmp_path):
+    path = tmp_path / "proxies.csv"
+    path.write_text(CSV)
+    client = FakeProxyClient()
+    rejects = io.StringIO()
+
+    stats = hmac_client.bulk_set_proxies(client, hmac_client.read_proxy_rows(str(path)), rejects, concurrency=3)
+
+    assert sorted(b["entryId"] for b in client.bodies) == ["exists", "id1", "id2"]
+    assert [b for b in client.bodies if b["entryId"] == "id1"][0] == {
+        "entryId": "id1", "proxyBucket": "proxies", "proxyPath": "path/to/id1.mp4", "proxyType": "VIDEO", "region": "eu-west-1"}
+    rejected = [json.loads(line) for line in rejects.getvalue().splitlines()]
+    reasons = sorted(r["reason"] for r in rejected)
+    assert len(rejected) == 4 and stats.rejected == 4
+    assert "missing entryId" in reasons
+    assert "proxy_exists" in reasons
+    assert stats.succeeded == 2 and stats.failed == 1
+
+
+def test_read_proxy_rows_ndjson(tmp_path):
+    path = tmp_path / "proxies.ndjson"
+    path.write_text('{"entryId": "a", "proxyBucket": "b", "proxyPath": "c", "proxyType": "VIDEO", "region": "us-east-1"}\n\nnot json\n')
+    rows = list(hmac_client.read_proxy_rows(str(path)))
+    assert hmac_client.validate_proxy_row(rows[0])["entryId"] == "a"
+    with pytest.raises(hmac_client.InvalidRow):
+        hmac_client.validate_proxy_row(rows[1])
@@ -0,0 +1,204 @@
+import json
+import random
+import re
+import threading
+import time
+
+import pytest
+
+from archivehunter_client import parse_zoned_datetime
+from conftest import load_script
+
+hmac_search = load_script("hmac-search.py")
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self._content = content
+        self.text = json.dumps(content)
+
+    def json(self):
+        return self._content
+
+
+def modified_at(i):
+    # three entries share each modification time, so window boundaries fall in the middle of them
+    return "2020-01-{0:02d}T{1:02d}:{2:02d}:{3:02d}.{4}Z".format(1 + i//(3*86400), (i//10800)%24, (i//180)%60, (i//3)%60, "5"*(1 + i%3))
+
+
+class FakeBrowserClient(object):
+    """
+    stands in for ArchiveHunterClient, serving pages out of a list of entries with random latency.  Like the browser
+    search it sorts on last_modified and understands a last_modified range query, and like Elasticsearch it refuses to
+    page past `window`.
+    """
+    def __init__(self, total, fail_offsets=(), always_fail=False, window=10000, latency=1/200):
+        self.entries = [{"id": "id-{0}".format(i), "beenDeleted": i % 7 == 0, "last_modified": modified_at(i)} for i in range(total)]
+        self.times = [parse_zoned_datetime(e["last_modified"]).timestamp() for e in self.entries]
+        self.fail_offsets = set(fail_offsets)
+        self.always_fail = always_fail
+        self.window = window
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def post(self, uri, body=None):
+        params = dict(p.split("=") for p in uri.split("?")[1].split("&"))
+        start, size = int(params["start"]), int(params["size"])
+        assert body["sortBy"] == "last_modified"
+        with self.lock:
+            self.calls.append(start)
+            if self.always_fail or start in self.fail_offsets:
+                self.fail_offsets.discard(start)
+                return FakeResponse(503, {"status": "error"})
+        if start + size>self.window:
+            return FakeResponse(500, {"status": "search_error", "detail": "Result window is too large"})
+        results = self.entries
+        if body.get("q"):
+            since = parse_zoned_datetime(re.match(r'^last_modified:\["(.*)" TO \*\]$', body["q"]).group(1)).timestamp()
+            results = [e for e, t in zip(self.entries, self.times) if t>=since]
+        time.sleep(random.random()*self.latency)
+        return FakeResponse(200, {"status": "ok", "entryCount": len(results), "entries": results[start:start + size]})
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_iterate_pages_in_order(concurrency):
+    client = FakeBrowserClient(1005)
+    cursors = []
+    ids = []
+    for cursor, page in hmac_search.iterate_pages(client, "bucket", 50, concurrency=concurrency):
+        cursors.append(cursor)
+        ids.extend(e["id"] for e in page["entries"])
+
+    assert [c["offset"] for c in cursors[:-1]] == list(range(50, 1005, 50))
+    assert cursors[-1] is None
+    assert ids == [e["id"] for e in client.entries]
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_iterate_pages_past_the_result_window(monkeypatch, concurrency):
+    monkeypatch.setattr(hmac_search, "sleep", lambda s: None)
+    client = FakeBrowserClient(10250, latency=0)
+    ids = [e["id"] for _, page in hmac_search.iterate_pages(client, "bucket", 500, concurrency=concurrency) for e in page["entries"]]
+
+    # every entry once, in order, without asking for anything past the window
+    assert ids == [e["id"] for e in client.entries]
+    assert client.calls.count(0) == 2
+
+
+def test_iterate_pages_stops_when_one_time_fills_the_window():
+    client = FakeBrowserClient(300, window=100)
+    for e in client.entries:
+        e["last_modified"] = "2020-01-01T00:00:00Z"
+    client.times = [parse_zoned_datetime("2020-01-01T00:00:00Z").timestamp()]*len(client.entries)
+    with pytest.raises(hmac_search.PageFetchError) as raised:
+        list(hmac_search.iterate_pages(client, "bucket", 50, window=100))
+    assert "can't get past them" in str(raised.value)
+
+
+def test_iterate_pages_retries_failed_page(monkeypatch):
+    monkeypatch.setattr(hmac_search, "sleep", lambda s: None)
+    client = FakeBrowserClient(300, fail_offsets=[100])
+    ids = [e["id"] for _, page in hmac_search.iterate_pages(client, "bucket", 50, concurrency=3) for e in page["entries"]]
+
+    assert ids == [e["id"] for e in client.entries]
+    assert client.calls.count(100) == 2
+
+
+def test_iterate_pages_gives_up(monkeypatch):
+    monkeypatch.setattr(hmac_search, "sleep", lambda s: None)
+    client = FakeBrowserClient(300, always_fail=True)
+    with pytest.raises(hmac_search.PageFetchError):
+        list(hmac_search.iterate_pages(client, "bucket", 50, retries=2))
+    assert client.calls == [0, 0, 0]
+
+
+@pytest.mark.parametrize("use_gzip", [False, True])
+def test_export_resumes_from_checkpoint(tmp_path, use_gzip):
+    import gzip
+    client = FakeBrowserClient(230)
+    output = str(tmp_path / ("export.ndjson.gz" if use_gzip else "export.ndjson"))
+
+    exporter = hmac_search.NDJSONExporter(output, "bucket", use_gzip=use_gzip)
+    cursor = exporter.open(resume=True)
+    assert cursor is None
+    pages = hmac_search.iterate_pages(client, "bucket", 50, cursor=cursor)
+    for _ in range(2):
+        exporter.write_page(*next(pages))
+    #simulate dying after a page was written but before it was checkpointed
+    checkpoint = exporter.read_checkpoint()
+    next(pages)
+    exporter._file.write(b"partial garbage")
+    exporter.close()
+
+    exporter = hmac_search.NDJSONExporter(output, "bucket", use_gzip=use_gzip)
+    cursor = exporter.open(resume=True)
+    assert cursor == checkpoint["next"]
+    assert cursor["offset"] == 100
+    for cursor, page in hmac_search.iterate_pages(client, "bucket", 50, concurrency=2, cursor=cursor):
+        exporter.write_page(cursor, page)
+    exporter.close()
+
+    opener = gzip.open if use_gzip else open
+    with opener(output, "rt") as f:
+        written = [json.loads(line) for line in f]
+    assert written == client.entries
+
+
+def export(client, output, resume, stop_after=None, window=100):
+    """
+    runs an export like --export does, with a small result window, optionally dying after `stop_after` pages
+    :return: the exporter
+    """
+    exporter = hmac_search.NDJSONExporter(output, "bucket")
+    cursor = exporter.open(resume=resume)
+    if not exporter.finished:
+        pages = hmac_search.iterate_pages(client, "bucket", 30, concurrency=3, cursor=cursor, window=window)
+        for i, (cursor, page) in enumerate(pages):
+            if i==stop_after:
+                pages.close()
+                break
+            exporter.write_page(cursor, page)
+    exporter.close()
+    return exporter
+
+
+@pytest.mark.parametrize("stop_after", [3, 4, 7])
+def test_export_resumes_past_the_result_window(tmp_path, stop_after):
+    client = FakeBrowserClient(500, window=100, latency=0)
+    output = str(tmp_path / "export.ndjson")
+    export(client, output, False, stop_after)
+    checkpoint = hmac_search.NDJSONExporter(output, "bucket").read_checkpoint()
+    # the fourth page is the last of the first window, so the fourth and later checkpoints are in a later one
+    assert (checkpoint["next"]["since"] is None) == (stop_after<4)
+
+    while not export(client, output, True, stop_after=5).finished:
+        pass
+    with open(output) as f:
+        written = [json.loads(line) for line in f]
+    assert written == client.entries
+
+    # resuming a finished export doesn't fetch anything
+    client.calls = []
+    assert export(client, output, True).finished
+    assert client.calls == []
+
+
+def test_offset_checkpoint_is_refused(tmp_path):
+    output = str(tmp_path / "export.ndjson")
+    with open(output + ".checkpoint", "w") as f:
+        json.dump({"collection": "bucket", "next_offset": 20000, "output_bytes": 0}, f)
+    with pytest.raises(ValueError):
+        hmac_search.NDJSONExporter(output, "bucket").open(resume=True)
+
+
+def test_export_checkpoint_for_other_collection(tmp_path):
+    output = str(tmp_path / "export.ndjson")
+    exporter = hmac_search.NDJSONExporter(output, "bucket")
+    exporter.open()
+    exporter.write_checkpoint(None)
+    exporter.close()
+
+    with pytest.raises(ValueError):
+        hmac_search.NDJSONExporter(output, "otherbucket").open(resume=True)
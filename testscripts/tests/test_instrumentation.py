@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient
+from bulk_runner import request_with_backoff
+from hmac_stub_server import StubArchiveHunter
+from instrumentation import Histogram, Metrics, endpoint_name, instrument_boto3
+
+
+@pytest.fixture(autouse=True)
+def disabled_afterwards():
+    yield
+    instrumentation.disable()
+
+
+def test_endpoint_name():
+    assert endpoint_name("GET", "https://host/api/entry/c3R1Yi1idWNrZXQ6cGF0aA==") == "GET /api/entry/:id"
+    assert endpoint_name("POST", "https://host/api/proxy/generate/abc123/thumbnail") == "POST /api/proxy/generate/:id/thumbnail"
+    assert endpoint_name("POST", "https://host/api/search/browser?start=100&size=50") == "POST /api/search/browser"
+    assert endpoint_name("GET", "https://bucket.s3.amazonaws.com/some/key.mxf?X-Amz-Signature=abc") == "GET bucket.s3.amazonaws.com"
+
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    for value in [0.001]*90 + [0.3]*9 + [100]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.95) == 0.5
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_client_is_not_instrumented_unless_enabled():
+    client = ArchiveHunterClient("localhost", "s3cr3t")
+    assert client.metrics is None
+
+
+def test_hmac_requests_are_recorded():
+    metrics = instrumentation.enable()
+    with StubArchiveHunter("s3cr3t", entry_count=20) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        for entry in server.entries[:5]:
+            assert client.get("/api/entry/{0}".format(entry["id"])).status_code == 200
+        client.post("/api/search/browser?start=0&size=10", {"collection": "stub-bucket"})
+        client.get("/api/nonexistent")
+        bad_client = ArchiveHunterClient(server.host, "wrong", scheme="http", timeout=10)
+        bad_client.get("/api/entry/abc123")
+
+    assert sorted(set(e for e, _ in metrics.histograms.keys())) == [
+        "GET /api/entry/:id", "GET /api/nonexistent", "POST /api/search/browser"]
+    assert metrics.histograms[("GET /api/entry/:id", "total")].count == 6
+    assert metrics.histograms[("GET /api/entry/:id", "sign")].count == 6
+    assert metrics.histograms[("GET /api/entry/:id", "headers")].count == 6
+    assert metrics.counters["requests_total"][("GET /api/entry/:id", "200")] == 5
+    assert metrics.counters["errors_total"] == {("GET /api/nonexistent", "404"): 1, ("GET /api/entry/:id", "403"): 1}
+    assert metrics.counters["bytes_sent_total"][("POST /api/search/browser",)] == len(json.dumps({"collection": "stub-bucket"}))
+    assert metrics.counters["bytes_received_total"][("POST /api/search/browser",)]>1000
+    # keep-alive means one connection per client, not one per request
+    assert metrics.gauge_values()["connections_opened"] == 2
+
+    prometheus = metrics.to_prometheus()
+    assert 'archivehunter_tools_request_duration_seconds_count{endpoint="GET /api/entry/:id",phase="total"} 6' in prometheus
+    assert 'archivehunter_tools_request_duration_seconds_bucket{endpoint="GET /api/entry/:id",phase="total",le="+Inf"} 6' in prometheus
+    assert 'archivehunter_tools_errors_total{endpoint="GET /api/nonexistent",error="404"} 1' in prometheus
+    assert json.loads(json.dumps(metrics.to_json()))["gauges"]["connections_opened"] == 2
+    assert metrics.summary_line().startswith("8 requests in")
+
+
+def test_retries_are_counted():
+    metrics = instrumentation.enable()
+
+    class Response(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {"Retry-After": "0"}
+
+    responses = iter([Response(503), Response(429), Response(200)])
+    assert request_with_backoff(lambda: next(responses)).status_code == 200
+    assert metrics.counters["retries_total"] == {("503",): 1, ("429",): 1}
+
+
+def test_boto3_calls_are_recorded(tmpdir):
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    metrics = Metrics()
+    with moto.mock_aws():
+        client = instrument_boto3(boto3.client("s3", region_name="us-east-1"), metrics)
+        client.create_bucket(Bucket="test-bucket")
+        client.put_object(Bucket="test-bucket", Key="file", Body=b"x"*1000)
+        client.list_objects_v2(Bucket="test-bucket")
+        with pytest.raises(Exception):
+            client.list_objects_v2(Bucket="no-such-bucket")
+
+    assert metrics.histograms[("s3 ListObjectsV2", "total")].count == 2
+    assert metrics.counters["errors_total"] == {("s3 ListObjectsV2", "404"): 1}
+    assert metrics.counters["bytes_sent_total"][("s3 PutObject",)] == 1000
+
+    path = str(tmpdir.join("metrics.json"))
+    metrics.write(path)
+    with open(path) as f:
+        assert {h["endpoint"] for h in json.load(f)["histograms"]} == {"s3 CreateBucket", "s3 PutObject", "s3 ListObjectsV2"}
@@ -0,0 +1,154 @@
+import json
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from archivehunter_client import ArchiveHunterClient, parse_zoned_datetime
+from bulk_runner import TokenBucket
+from hmac_stub_server import StubArchiveHunter
+from job_follower import JobFeedError, JobTable, follow, recheck, rerun_failed
+
+
+def make_job(i:int, status:str="ST_ERROR", job_type:str="proxy", transcode:bool=True) -> dict:
+    return {
+        "jobId": str(uuid.UUID(int=i)),
+        "jobType": job_type,
+        "startedAt": "2020-01-01T{0:02d}:{1:02d}:{2:02d}Z".format(i//3600, (i//60)%60, i%60),
+        "completedAt": "2020-01-01T12:00:00Z",
+        "jobStatus": status,
+        "log": None,
+        "sourceId": "entry{0}".format(i),
+        "transcodeInfo": {"destinationBucket": "proxies", "region": "eu-west-1", "proxyType": "VIDEO", "requestType": "PROXY"} if transcode else None,
+        "sourceType": "SRC_MEDIA",
+        "lastUpdatedTS": None,
+    }
+
+
+class JobServer(StubArchiveHunter):
+    """
+    stub server with the job search, lookup, re-run and refresh endpoints.  The search works like a query on the
+    jobStatusIndex: it filters on status and startedAt, returns jobs in start order and honours the misspelt limit.
+    """
+    def __init__(self, jobs):
+        super().__init__("s3cr3t", entry_count=0)
+        self.jobs = {j["jobId"]: j for j in jobs}
+        self.searches = []
+        self.reruns = []
+        self.refreshes = []
+        self.add_route("PUT", r'^/api/job/search$', self._search)
+        self.add_route("GET", r'^/api/job/([^/]+)$', self._get_job)
+        self.add_route("PUT", r'^/api/job/rerunproxy/([^/]+)$', self._rerun)
+        self.add_route("PUT", r'^/api/job/transcode/([^/]+)/refresh$', self._refresh)
+
+    def _search(self, request, match, query, body):
+        search = json.loads(body)
+        limit = int(query.get("linit", ["100"])[0])
+        self.searches.append(search.get("startingTime"))
+        results = [j for j in self.jobs.values() if j["jobStatus"]==search["jobStatus"]]
+        if search.get("startingTime"):
+            since = parse_zoned_datetime(search["startingTime"])
+            results = [j for j in results if parse_zoned_datetime(j["startedAt"])>=since]
+        results.sort(key=lambda j: j["startedAt"])
+        return 200, {"status": "ok", "entityClass": "job", "entries": results[:limit], "entryCount": len(results[:limit])}
+
+    def _get_job(self, request, match, query, body):
+        job = self.jobs.get(match.group(1))
+        if job is None:
+            return 404, {"status": "not_found", "detail": "Job ID is not found"}
+        return 200, {"status": "ok", "objectClass": "job", "entry": job}
+
+    def _rerun(self, request, match, query, body):
+        self.reruns.append(match.group(1))
+        return 200, {"status": "ok", "entityClass": "jobId", "objectId": match.group(1)}
+
+    def _refresh(self, request, match, query, body):
+        self.refreshes.append(match.group(1))
+        return 500, {"status": "not_implemented", "detail": "Not currently implemented"}
+
+
+def now_string() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def test_follow_reads_only_new_jobs(tmpdir):
+    jobs = [make_job(i*60) for i in range(250)] + [make_job(100000 + i, status="ST_SUCCESS") for i in range(10)]
+    with JobServer(jobs) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        table = JobTable(str(tmpdir.join("jobs.db")))
+
+        assert follow(client, table, page_size=100, overlap=0) == (252, 250)
+        assert len(server.searches) == 3
+        assert table.status_counts() == {"ST_ERROR": 250}
+
+        server.searches = []
+        new_job = make_job(250*60)
+        server.jobs[new_job["jobId"]] = new_job
+        read, changed = follow(client, table, page_size=100, overlap=300)
+        # the five minutes before the cursor are read again, which is six more jobs
+        assert (read, changed) == (7, 1)
+        assert len(server.searches) == 1
+        assert parse_zoned_datetime(server.searches[0]) == parse_zoned_datetime(jobs[244]["startedAt"])
+
+
+def test_follow_reports_a_page_that_cannot_advance(tmpdir):
+    jobs = [make_job(i) for i in range(20)]
+    for job in jobs:
+        job["startedAt"] = "2020-01-01T00:00:00Z"
+    with JobServer(jobs) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        with pytest.raises(JobFeedError):
+            follow(client, JobTable(str(tmpdir.join("jobs.db"))), page_size=10)
+
+
+def test_reruns_are_deduplicated(tmpdir):
+    jobs = [make_job(i) for i in range(30)] + [make_job(100, job_type="RESTORE"), make_job(101, transcode=False)]
+    with JobServer(jobs) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        table = JobTable(str(tmpdir.join("jobs.db")))
+        follow(client, table)
+
+        assert rerun_failed(client, table, TokenBucket(0), max_attempts=2, batch_size=7) == {"requested": 30, "failed": 0}
+        assert sorted(server.reruns) == sorted(j["jobId"] for j in jobs[:30])
+
+        # the server still says they failed, but not since they were re-run
+        follow(client, table)
+        assert rerun_failed(client, table, TokenBucket(0), max_attempts=2) == {"requested": 0, "failed": 0}
+
+        server.jobs[jobs[0]["jobId"]]["completedAt"] = now_string()
+        follow(client, table)
+        assert rerun_failed(client, table, TokenBucket(0), max_attempts=2) == {"requested": 1, "failed": 0}
+
+        # two attempts is the limit
+        server.jobs[jobs[0]["jobId"]]["completedAt"] = now_string()
+        follow(client, table)
+        assert rerun_failed(client, table, TokenBucket(0), max_attempts=2) == {"requested": 0, "failed": 0}
+        assert len(server.reruns) == 31
+
+
+def test_recheck_sees_the_outcome_of_reruns(tmpdir):
+    jobs = [make_job(i) for i in range(5)]
+    with JobServer(jobs) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        table = JobTable(str(tmpdir.join("jobs.db")))
+        follow(client, table)
+        rerun_failed(client, table, TokenBucket(0))
+
+        server.jobs[jobs[0]["jobId"]].update(jobStatus="ST_SUCCESS", completedAt=now_string())
+        server.jobs[jobs[1]["jobId"]].update(completedAt=now_string())
+        del server.jobs[jobs[2]["jobId"]]
+        assert recheck(client, table, 0) == 5
+        assert table.status_counts() == {"ST_SUCCESS": 1, "ST_ERROR": 3}
+        assert table.rerun_candidates(["proxy"], 3) == [jobs[1]["jobId"]]
+        # only the two whose outcome is still unknown are looked up again
+        assert recheck(client, table, 0) == 2
+
+
+def test_refresh_stops_when_not_implemented(tmpdir):
+    jobs = [make_job(i) for i in range(10)]
+    with JobServer(jobs) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        table = JobTable(str(tmpdir.join("jobs.db")))
+        follow(client, table)
+        assert rerun_failed(client, table, TokenBucket(0), refresh=True, batch_size=4)["requested"] == 10
+        assert len(server.refreshes) == 4
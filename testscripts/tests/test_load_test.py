@@ -0,0 +1,83 @@
+import pytest
+
+from archivehunter_client import ArchiveHunterClient
+from hmac_stub_server import StubArchiveHunter
+from load_test import RequestMix, compare_runs, discover_targets, parse_mix, run_closed_loop, run_open_loop
+
+
+@pytest.fixture()
+def server():
+    with StubArchiveHunter("s3cr3t", entry_count=300) as stub:
+        yield stub
+
+
+def make_client(server, secret="s3cr3t"):
+    return ArchiveHunterClient(server.host, secret, scheme="http", timeout=10)
+
+
+def test_parse_mix():
+    assert parse_mix("browser=4, entry=1") == {"browser": 4.0, "entry": 1.0}
+    assert parse_mix("suggestions") == {"suggestions": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("browser=1,nonsense=2")
+    with pytest.raises(ValueError):
+        parse_mix("browser=0")
+
+
+def test_stub_server_checks_hmac(server):
+    good = make_client(server)
+    response = good.post("/api/search/browser?start=0&size=10", body={"collection": "stub-bucket"})
+    assert response.status_code == 200
+    assert response.json()["entryCount"] == 300
+    assert len(response.json()["entries"]) == 10
+
+    entry_id = response.json()["entries"][0]["id"]
+    assert good.get_entry(entry_id).json()["entry"]["id"] == entry_id
+
+    bad = make_client(server, secret="wrong")
+    assert bad.get("/api/search/basic?q=clip").status_code == 403
+    assert server.auth_failures == 1
+
+
+def test_closed_loop_run(server):
+    client = make_client(server)
+    entry_ids, terms = discover_targets(client, "stub-bucket")
+    assert len(entry_ids) > 0 and terms == ["project000", "project001"]
+
+    mix = RequestMix(parse_mix("browser=1,basic=1,suggestions=1,entry=1"), terms, entry_ids, "stub-bucket", seed=1)
+    summary = run_closed_loop(client, mix, concurrency=4, max_requests=80).summary()
+
+    assert summary["overall"]["requests"] == 80
+    assert summary["overall"]["error_rate"] == 0.0
+    assert sorted(summary["endpoints"].keys()) == ["basic", "browser", "entry", "suggestions"]
+    assert sum(e["requests"] for e in summary["endpoints"].values()) == 80
+    assert all(e["outcomes"].keys() == {"200"} for e in summary["endpoints"].values())
+
+
+def test_open_loop_run_counts_errors():
+    with StubArchiveHunter("s3cr3t", entry_count=50, error_rate=0.5) as server:
+        client = make_client(server)
+        mix = RequestMix({"entry": 1}, [], [e["id"] for e in server.entries], seed=1)
+        summary = run_open_loop(client, mix, rate=200, concurrency=4, max_requests=60).summary()
+
+    assert summary["overall"]["requests"] == 60
+    outcomes = summary["endpoints"]["entry"]["outcomes"]
+    assert set(outcomes.keys()) == {"200", "503"}
+    assert summary["overall"]["error_rate"] == outcomes["503"]/60
+
+
+def test_request_mix_needs_targets():
+    with pytest.raises(ValueError):
+        RequestMix({"entry": 1}, ["term"], [])
+
+
+def test_compare_runs():
+    def summary(p95, per_second, error_rate=0.0):
+        stats = {"p50": 0.01, "p95": p95, "p99": p95, "per_second": per_second, "error_rate": error_rate}
+        return {"overall": stats, "endpoints": {"browser": stats}}
+
+    assert compare_runs(summary(0.1, 100), summary(0.105, 98)) == []
+    regressions = compare_runs(summary(0.1, 100), summary(0.2, 50, 0.05))
+    assert "overall p95 latency went from 0.100s to 0.200s" in regressions
+    assert "throughput went from 100.0/s to 50.0/s" in regressions
+    assert "browser error rate went from 0.0% to 5.0%" in regressions
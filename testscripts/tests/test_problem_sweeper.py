@@ -0,0 +1,128 @@
+import io
+import json
+
+from archivehunter_client import ArchiveHunterClient
+from bulk_runner import Journal, TokenBucket
+from hmac_stub_server import StubArchiveHunter
+import problem_sweeper
+from problem_sweeper import SweepProgress, generate_uri, iterate_problem_items, list_problem_collections, missing_proxies, sweep
+
+
+def make_item(file_id, collection, thumbnail_missing=True, video_missing=False):
+    return {
+        "fileId": file_id,
+        "collection": collection,
+        "filePath": "path/" + file_id,
+        "esRecordSays": False,
+        "verifyResults": [
+            {"fileId": file_id, "proxyType": "THUMBNAIL", "wantProxy": True, "esRecordSays": False, "haveProxy": not thumbnail_missing},
+            {"fileId": file_id, "proxyType": "VIDEO", "wantProxy": video_missing, "esRecordSays": False, "haveProxy": None},
+            {"fileId": file_id, "proxyType": "AUDIO", "wantProxy": False, "esRecordSays": False, "haveProxy": None},
+        ],
+        "decision": "Unproxied",
+    }
+
+
+class ProblemItemServer(StubArchiveHunter):
+    def __init__(self, items):
+        super().__init__("s3cr3t", entry_count=0)
+        self.items = items
+        self.generated = []
+        self.add_route("GET", r'^/api/proxyhealth/problemitems/collectionlist$', self._collection_list)
+        self.add_route("GET", r'^/api/proxyhealth/problemitems$', self._items_list)
+        self.add_route("POST", r'^/api/proxy/generate/([^/]+)/([^/]+)$', self._generate)
+
+    def _collection_list(self, request, match, query, body):
+        counts = {}
+        for item in self.items:
+            counts[item["collection"]] = counts.get(item["collection"], 0) + 1
+        return 200, {"status": "ok", "entries": [{"key": k, "count": v} for k, v in sorted(counts.items())]}
+
+    def _items_list(self, request, match, query, body):
+        start = int(query["start"][0])
+        size = int(query["size"][0])
+        if start + size>problem_sweeper.RESULT_WINDOW:
+            return 500, {"status": "error", "detail": "Result window is too large, from + size must be less than or equal to: [10000]"}
+        matching = [i for i in self.items if i["collection"]==query["collection"][0]]
+        return 200, {"status": "ok", "entityClass": "ProblemItem", "entries": matching[start:start+size], "entryCount": len(matching)}
+
+    def _generate(self, request, match, query, body):
+        self.generated.append((match.group(1), match.group(2)))
+        if match.group(1).startswith("image"):
+            return 400, {"status": "bad_request", "detail": "Can't make audio or video proxy of an image item"}
+        return 200, {"status": "ok", "objectClass": "task", "entry": "task-id"}
+
+
+def test_missing_proxies():
+    assert missing_proxies(make_item("a", "c", True, True)) == ["THUMBNAIL", "VIDEO"]
+    assert missing_proxies(make_item("a", "c", False, False)) == []
+    assert missing_proxies(make_item("a", "c", True, True), ["VIDEO"]) == ["VIDEO"]
+
+
+def test_generate_uri():
+    assert generate_uri("abc/d+e=", "THUMBNAIL") == "/api/proxy/generate/abc%2Fd%2Be%3D/thumbnail"
+    assert generate_uri("abc", "VIDEO") == "/api/proxy/generate/abc/video"
+
+
+def sample_items():
+    items = [make_item("first{0}".format(i), "first-bucket", video_missing=i%2==0) for i in range(230)]
+    items += [make_item("second{0}".format(i), "second-bucket") for i in range(40)]
+    items += [make_item("image1", "second-bucket", thumbnail_missing=False, video_missing=True)]
+    items.insert(150, items[3])     #the same item on two different pages
+    return items
+
+
+def test_sweep_requests_each_missing_proxy_once(tmpdir):
+    journal_path = str(tmpdir.join("journal.ndjson"))
+    with ProblemItemServer(sample_items()) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        collections = [name for name, _ in list_problem_collections(client)]
+        assert collections == ["first-bucket", "second-bucket"]
+
+        journal = Journal(journal_path)
+        progress = sweep(client, collections, journal, TokenBucket(0), concurrency=4, page_concurrency=3, page_size=50)
+        journal.close()
+
+        assert len(server.generated) == len(set(server.generated)) == 230 + 115 + 40 + 1
+        assert ("first0", "video") in server.generated and ("first1", "thumbnail") in server.generated
+        assert ("first1", "video") not in server.generated
+        assert progress.collections["first-bucket"]["problem_items"] == 231
+        assert progress.collections["first-bucket"]["items_read"] == 231
+        assert progress.collections["first-bucket"]["duplicates"] == 1
+        assert progress.collections["first-bucket"]["requested"] == 345
+        assert progress.collections["second-bucket"]["refused"] == 1
+        assert progress.totals()["failed"] == 0
+
+        # only the refused request is sent again
+        server.generated = []
+        journal = Journal(journal_path)
+        progress = sweep(client, collections, journal, TokenBucket(0), concurrency=4, page_size=50)
+        journal.close()
+        assert server.generated == [("image1", "video")]
+        assert progress.totals()["skipped"] == 385
+
+
+def test_dry_run_sends_nothing():
+    with ProblemItemServer(sample_items()) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        out = io.StringIO()
+        progress = sweep(client, ["second-bucket"], Journal(None), TokenBucket(0), types=["VIDEO"], dry_run_out=out)
+
+        assert server.generated == []
+        assert [json.loads(l)["uri"] for l in out.getvalue().splitlines()] == ["/api/proxy/generate/image1/video"]
+        assert progress.totals()["requested"] == 1
+
+
+def test_paging_stops_at_the_result_window(caplog):
+    items = [make_item("big{0}".format(i), "big-bucket") for i in range(problem_sweeper.RESULT_WINDOW + 150)]
+    items += [make_item("small{0}".format(i), "small-bucket") for i in range(10)]
+    with ProblemItemServer(items) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        progress = SweepProgress()
+        read = list(iterate_problem_items(client, ["big-bucket", "small-bucket"], progress, page_size=300, concurrency=4))
+
+    assert sorted(i["fileId"] for i in read) == sorted(i["fileId"] for i in items[:problem_sweeper.RESULT_WINDOW] + items[-10:])
+    assert progress.collections["big-bucket"]["problem_items"] == problem_sweeper.RESULT_WINDOW + 150
+    assert progress.collections["big-bucket"]["items_read"] == problem_sweeper.RESULT_WINDOW
+    assert progress.totals()["pages_failed"] == 0
+    assert len([r for r in caplog.records if "only the first" in r.getMessage()]) == 1
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import random
+import re
+from urllib.parse import quote
+
+import pytest
+
+from archivehunter_client import ArchiveHunterClient
+from hmac_stub_server import StubArchiveHunter
+from ranged_download import MIB, DownloadError, PartMap, download, download_bulk, local_path, multipart_part_sizes
+
+CONTENT = random.Random(1).randbytes(1000*1000 + 123)
+
+
+def multipart_etag(content, part_size):
+    digests = [hashlib.md5(content[i:i + part_size]).digest() for i in range(0, len(content), part_size)]
+    return '"{0}-{1}"'.format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+class BucketServer(StubArchiveHunter):
+    """
+    stub server that also plays the part of S3: /bucket/:path serves ranges of `files`, and the bulk download endpoints
+    give out links to it
+    """
+    def __init__(self, files, etag_md5=True, upload_part_size=None):
+        super().__init__("s3cr3t", entry_count=0)
+        self.files = files
+        self.etag_md5 = etag_md5
+        self.upload_part_size = upload_part_size     # if set, ETags are multipart ETags for parts of this size
+        self.range_requests = []
+        self.fail_after = None       # if set, every ranged response is cut off after this many bytes
+        self.corrupt = False         # if set, the last byte is changed after the ETag is worked out
+        self.refuse_parts = False    # if set, every ranged request apart from the one-byte probe gets a 503
+        self.add_route("GET", r'^/bucket/(.+)$', self._object)
+        self.add_route("GET", r'^/api/lightbox/bulk/appDownload/([^/]+)$', lambda r, m, q, b: (200, {"status": "ok", "entityClass": "BulkDownload", "objectId": "archivehunter:bulkdownload:code123"}))
+        self.add_route("GET", r'^/api/bulkv2/code123$', lambda r, m, q, b: (200, {"status": "ok", "metadata": {}, "retrievalToken": "token456", "entries": None}))
+        self.add_route("GET", r'^/api/bulkv2/token456/summarystream$', self._summary)
+        self.add_route("GET", r'^/api/bulk/token456/get/([^/]+)$', self._link)
+
+    def authenticate(self, request):
+        # presigned links carry their own signature, so the bucket isn't HMAC-signed
+        return request.path.startswith("/bucket/") or super().authenticate(request)
+
+    def _object(self, request, match, query, body):
+        content = self.files[match.group(1)]
+        if self.upload_part_size:
+            headers = {"ETag": multipart_etag(content, self.upload_part_size)}
+        else:
+            headers = {"ETag": '"{0}"'.format(hashlib.md5(content).hexdigest() if self.etag_md5 else "abc-2")}
+        if self.corrupt:
+            content = content[:-1] + bytes([content[-1] ^ 0xff])
+        range_match = re.match(r'^bytes=(\d+)-(\d+)$', request.headers.get("Range", ""))
+        if range_match is None:
+            return 200, content, headers
+        start, end = int(range_match.group(1)), int(range_match.group(2))
+        self.range_requests.append((match.group(1), start, end))
+        if start>=len(content):
+            # what S3 does for any range of an empty object
+            headers["Content-Range"] = "bytes */{0}".format(len(content))
+            return 416, b"InvalidRange", headers
+        if self.refuse_parts and end>0:
+            return 503, b"Slow Down", headers
+        part = content[start:end + 1]
+        if self.fail_after is not None and len(part)>self.fail_after:
+            # claim the whole range but only send part of it, like a dropped connection
+            part = part[:self.fail_after]
+            end = start + len(part) - 1
+        headers["Content-Range"] = "bytes {0}-{1}/{2}".format(start, end, len(content))
+        return 206, part, headers
+
+    def _summary(self, request, match, query, body):
+        return 200, iter([json.dumps({"entryId": "id-" + name.replace("/", "_"), "path": name, "fileSize": len(data)}).encode("utf-8") + b"\n"
+                          for name, data in sorted(self.files.items())])
+
+    def _link(self, request, match, query, body):
+        name = [n for n in self.files if "id-" + n.replace("/", "_")==match.group(1)][0]
+        return 200, {"status": "ok", "fileId": match.group(1), "restoreStatus": "RS_SUCCESS", "expiry": None,
+                     "downloadLink": "http://{0}/bucket/{1}".format(self.host, quote(name, safe=""))}
+
+
+def test_download_in_parts(tmpdir):
+    with BucketServer({"a.mov": CONTENT}) as server:
+        path = str(tmpdir.join("a.mov"))
+        size = download(lambda: "http://{0}/bucket/a.mov".format(server.host), path, part_size=100*1000, concurrency=4)
+
+        assert size == len(CONTENT)
+        assert open(path, "rb").read() == CONTENT
+        assert not os.path.exists(path + ".parts")
+        # the one-byte probe, then eleven parts
+        assert len(server.range_requests) == 12
+        assert sorted(r[1] for r in server.range_requests[1:]) == list(range(0, len(CONTENT), 100*1000))
+
+
+def test_resume_only_fetches_missing_parts(tmpdir):
+    with BucketServer({"a.mov": CONTENT}) as server:
+        path = str(tmpdir.join("a.mov"))
+        part_map = PartMap(path + ".parts", len(CONTENT), '"{0}"'.format(hashlib.md5(CONTENT).hexdigest()), 100*1000)
+        with open(path, "wb") as f:
+            f.write(CONTENT[:300*1000])
+        for i in range(3):
+            part_map.mark_done(i)
+
+        download(lambda: "http://{0}/bucket/a.mov".format(server.host), path, part_size=100*1000)
+        assert open(path, "rb").read() == CONTENT
+        assert min(r[1] for r in server.range_requests[1:]) == 300*1000
+
+
+def test_interrupted_parts_continue_from_where_they_stopped(tmpdir, monkeypatch):
+    monkeypatch.setattr("ranged_download.sleep", lambda seconds: None)
+    with BucketServer({"a.mov": CONTENT}) as server:
+        server.fail_after = 60*1000
+        path = str(tmpdir.join("a.mov"))
+        download(lambda: "http://{0}/bucket/a.mov".format(server.host), path, part_size=100*1000, retries=2)
+
+        assert open(path, "rb").read() == CONTENT
+        assert (("a.mov", 60*1000, 100*1000 - 1)) in server.range_requests
+
+
+def test_checksum_mismatch_is_detected(tmpdir):
+    with BucketServer({"a.mov": CONTENT}) as server:
+        path = str(tmpdir.join("a.mov"))
+        server.corrupt = True
+        with pytest.raises(DownloadError):
+            download(lambda: "http://{0}/bucket/a.mov".format(server.host), path, part_size=400*1000)
+        # the parts aren't trusted, but the sidecar stays so that the file isn't mistaken for a finished one
+        assert json.load(open(path + ".parts"))["done"] == []
+
+
+def test_multipart_etag_is_checked(tmpdir, caplog):
+    content = random.Random(2).randbytes(11*MIB + 123)
+    assert multipart_part_sizes(len(content), 3) == [5*MIB, 4*MIB]
+    for upload_part_size in [5*MIB, 4*MIB]:
+        with BucketServer({"a.mxf": content}, upload_part_size=upload_part_size) as server:
+            path = str(tmpdir.join("a.mxf"))
+            caplog.clear()
+            with caplog.at_level("INFO"):
+                download(lambda: "http://{0}/bucket/a.mxf".format(server.host), path, part_size=4*MIB)
+            assert "matches its multipart ETag with {0} MiB parts".format(upload_part_size//MIB) in caplog.text
+            assert "UNVERIFIED" not in caplog.text
+
+    with BucketServer({"a.mxf": content}, upload_part_size=5*MIB) as server:
+        server.corrupt = True
+        path = str(tmpdir.join("b.mxf"))
+        caplog.clear()
+        download(lambda: "http://{0}/bucket/a.mxf".format(server.host), path, part_size=4*MIB)
+        assert "b.mxf is UNVERIFIED" in caplog.text
+
+
+def test_empty_file(tmpdir):
+    with BucketServer({"empty": b""}) as server:
+        path = str(tmpdir.join("empty"))
+        assert download(lambda: "http://{0}/bucket/empty".format(server.host), path) == 0
+        assert open(path, "rb").read() == b""
+        assert not os.path.exists(path + ".parts")
+        # just the probe
+        assert len(server.range_requests) == 1
+
+
+def test_download_bulk(tmpdir):
+    files = {"media/one.mov": CONTENT[:250*1000], "media/sub/two.wav": CONTENT[1000:], "../../escape.txt": b"hello",
+             "media/.keep": b""}
+    with BucketServer(files, etag_md5=False) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        succeeded, failed = download_bulk(client, "bulk-id", str(tmpdir), file_concurrency=2, part_size=100*1000)
+
+        assert (succeeded, failed) == (4, 0)
+        assert tmpdir.join("media", ".keep").read_binary() == b""
+        assert tmpdir.join("media", "one.mov").read_binary() == files["media/one.mov"]
+        assert tmpdir.join("media", "sub", "two.wav").read_binary() == files["media/sub/two.wav"]
+        assert tmpdir.join("escape.txt").read_binary() == b"hello"
+
+        # files that are already complete aren't fetched again
+        server.range_requests = []
+        assert download_bulk(client, "bulk-id", str(tmpdir)) == (4, 0)
+        assert server.range_requests == []
+
+
+def test_failed_bulk_download_is_not_taken_as_present(tmpdir, monkeypatch):
+    monkeypatch.setattr("ranged_download.sleep", lambda seconds: None)
+    with BucketServer({"media/one.mov": CONTENT}, etag_md5=False) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        server.refuse_parts = True
+        assert download_bulk(client, "bulk-id", str(tmpdir), part_size=100*1000, retries=1) == (0, 1)
+        # the file is already full size, but the sidecar says none of it has been written
+        assert tmpdir.join("media", "one.mov").size() == len(CONTENT)
+        assert json.load(open(str(tmpdir.join("media", "one.mov.parts"))))["done"] == []
+
+        server.refuse_parts = False
+        assert download_bulk(client, "bulk-id", str(tmpdir), part_size=100*1000) == (1, 0)
+        assert tmpdir.join("media", "one.mov").read_binary() == CONTENT
+        assert not tmpdir.join("media", "one.mov.parts").exists()
+
+
+def test_local_path():
+    assert local_path("/dest", "a/b/c.mov") == "/dest/a/b/c.mov"
+    assert local_path("/dest", "/../a/./b.mov") == "/dest/a/b.mov"
@@ -0,0 +1,55 @@
+import gzip
+import io
+import json
+import os
+import random
+
+import pytest
+
+import reconcile
+
+
+@pytest.mark.parametrize("memory_limit", [10**9, 500])
+def test_external_sort(tmp_path, memory_limit):
+    items = ["id-{0}".format(random.randint(0, 300)) for _ in range(1000)]
+    assert list(reconcile.external_sort(iter(items), memory_limit, str(tmp_path))) == sorted(set(items))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_diff_sorted():
+    result = list(reconcile.diff_sorted(iter(["a", "b", "d", "f"]), iter(["b", "c", "f", "g"])))
+    assert result == [("left", "a"), ("both", "b"), ("right", "c"), ("left", "d"), ("both", "f"), ("right", "g")]
+    assert list(reconcile.diff_sorted(iter([]), iter(["x"]))) == [("right", "x")]
+    assert list(reconcile.diff_sorted(iter(["x"]), iter([]))) == [("left", "x")]
+
+
+@pytest.mark.parametrize("memory_limit", [10**9, 2000])
+def test_reconcile(tmp_path, memory_limit):
+    s3_ids = ["obj-{0:05d}".format(i) for i in range(0, 3000, 2)]
+    index_ids = ["obj-{0:05d}".format(i) for i in range(0, 3000, 3)]
+    random.shuffle(s3_ids)
+    random.shuffle(index_ids)
+    missing, orphans = io.StringIO(), io.StringIO()
+
+    counts = reconcile.reconcile(iter(s3_ids), iter(index_ids + index_ids[:10]), memory_limit, missing, orphans, str(tmp_path))
+
+    expected_missing = sorted(set(s3_ids) - set(index_ids))
+    expected_orphans = sorted(set(index_ids) - set(s3_ids))
+    assert missing.getvalue().splitlines() == expected_missing
+    assert orphans.getvalue().splitlines() == expected_orphans
+    assert counts == {
+        "s3": len(s3_ids),
+        "index": len(index_ids),
+        "matched": len(set(s3_ids) & set(index_ids)),
+        "missing_from_index": len(expected_missing),
+        "missing_from_s3": len(expected_orphans),
+    }
+
+
+def test_read_ids_from_ndjson_export(tmp_path):
+    path = str(tmp_path / "export.ndjson.gz")
+    with gzip.open(path, "wt") as f:
+        f.write(json.dumps({"id": "one", "beenDeleted": False}) + "\n")
+        f.write(json.dumps({"id": "two", "beenDeleted": True}) + "\n")
+        f.write(json.dumps({"id": "three", "beenDeleted": False}) + "\n")
+    assert list(reconcile.read_ids(path)) == ["one", "three"]
@@ -0,0 +1,178 @@
+import threading
+from time import sleep
+
+import response_cache
+from archivehunter_client import ArchiveHunterClient
+from response_cache import CachedResponse, ResponseCache, mutated_entry_ids
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+
+    def json(self):
+        return self.content
+
+
+class FakeSession(object):
+    """
+    records requests and answers GETs with the path that was requested
+    """
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, method, uri, **kwargs):
+        with self._lock:
+            self.requests.append((method, uri))
+        if "missing" in uri:
+            return FakeResponse(404, {"status": "not_found"})
+        return FakeResponse(200, {"uri": uri, "count": len(self.requests)})
+
+    def close(self):
+        pass
+
+
+def make_client(cache):
+    client = ArchiveHunterClient("example.com", "secret", cache=cache)
+    client.session = FakeSession()
+    return client
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache, "time", lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    calls = []
+    loader = lambda: calls.append(1) or CachedResponse(200, {"n": len(calls)})
+
+    assert cache.get_or_load("k", "id", loader).json() == {"n": 1}
+    now[0] = 1009.0
+    assert cache.get_or_load("k", "id", loader).json() == {"n": 1}
+    now[0] = 1010.0
+    assert cache.get_or_load("k", "id", loader).json() == {"n": 2}
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2)
+    for key in ("a", "b"):
+        cache.get_or_load(key, key, lambda: CachedResponse(200, key))
+    cache.get_or_load("a", "a", lambda: CachedResponse(200, "reloaded"))     #touch a so that b is least recently used
+    cache.get_or_load("c", "c", lambda: CachedResponse(200, "c"))
+
+    assert len(cache) == 2
+    assert cache.get_or_load("a", "a", lambda: CachedResponse(200, "reloaded")).json() == "a"
+    assert cache.get_or_load("b", "b", lambda: CachedResponse(200, "reloaded")).json() == "reloaded"
+
+
+def test_errors_are_not_cached():
+    cache = ResponseCache()
+    cache.get_or_load("k", "id", lambda: CachedResponse(404, None))
+    assert len(cache) == 0
+
+
+def test_concurrent_lookups_make_one_request():
+    cache = ResponseCache()
+    calls = []
+    started = threading.Event()
+
+    def slow_loader():
+        calls.append(1)
+        started.set()
+        sleep(0.2)
+        return CachedResponse(200, "value")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", "id", slow_loader))) for _ in range(8)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert [r.json() for r in results] == ["value"]*8
+
+
+def test_sqlite_backing_persists_between_instances(tmpdir):
+    path = str(tmpdir.join("cache.db"))
+    first = ResponseCache(sqlite_path=path)
+    first.get_or_load("k", "id", lambda: CachedResponse(200, {"a": [1, 2]}))
+
+    second = ResponseCache(sqlite_path=path)
+    response = second.get_or_load("k", "id", lambda: CachedResponse(200, "should not load"))
+    assert response.json() == {"a": [1, 2]}
+    assert response.from_cache
+
+    second.invalidate("id")
+    third = ResponseCache(sqlite_path=path)
+    assert third.get_or_load("k", "id", lambda: CachedResponse(200, "loaded")).json() == "loaded"
+
+
+def test_sqlite_backing_keeps_the_original_expiry(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache, "time", lambda: now[0])
+    path = str(tmpdir.join("cache.db"))
+    ResponseCache(ttl=10, sqlite_path=path).get_or_load("k", "id", lambda: CachedResponse(200, "first"))
+
+    now[0] = 1008.0
+    second = ResponseCache(ttl=10, sqlite_path=path)
+    assert second.get_or_load("k", "id", lambda: CachedResponse(200, "second")).json() == "first"
+    # loaded from the file eight seconds in, but it still expires ten seconds after it was first fetched
+    now[0] = 1010.0
+    assert second.get_or_load("k", "id", lambda: CachedResponse(200, "second")).json() == "second"
+
+
+def test_mutated_entry_ids():
+    assert mutated_entry_ids("GET", "/api/entry/abc") == []
+    assert mutated_entry_ids("PUT", "https://host/api/move/ab%2Fc?to=bucket") == ["ab/c"]
+    assert mutated_entry_ids("DELETE", "/api/proxy/abc/VIDEO") == ["abc"]
+    assert mutated_entry_ids("POST", "/api/proxy/generate/abc/thumbnail") == ["abc"]
+    assert mutated_entry_ids("POST", "/api/proxy", {"entryId": "abc", "proxyType": "VIDEO"}) == ["abc"]
+    assert mutated_entry_ids("PUT", "/api/proxy/proxyid/associate?fileId=abc") == ["abc"]
+    assert mutated_entry_ids("POST", "/api/proxy/relink/global") == []
+
+
+def test_client_lookups_are_cached_and_invalidated():
+    client = make_client(ResponseCache())
+
+    first = client.get_all_proxies("abc")
+    again = client.get_all_proxies("abc")
+    assert again.json() == first.json()
+    assert len(client.session.requests) == 1
+
+    client.get_playable("abc", "VIDEO")
+    client.get_playable("abc")
+    client.get_entry("abc")
+    client.get_entry("other")
+    assert [uri for _, uri in client.session.requests[1:]] == [
+        "https://example.com/api/proxy/abc/playable?proxyType=VIDEO",
+        "https://example.com/api/proxy/abc/playable",
+        "https://example.com/api/entry/abc",
+        "https://example.com/api/entry/other",
+    ]
+
+    client.delete("/api/proxy/abc/VIDEO")
+    request_count = len(client.session.requests)
+    client.get_entry("other")
+    assert len(client.session.requests) == request_count
+    client.get_all_proxies("abc")
+    client.get_entry("abc")
+    assert len(client.session.requests) == request_count + 2
+
+
+def test_client_passes_through_errors_and_works_without_cache():
+    client = make_client(ResponseCache())
+    assert client.get_entry("missing").status_code == 404
+    assert client.get_entry("missing").status_code == 404
+    assert len(client.session.requests) == 2
+
+    uncached = make_client(None)
+    uncached.get_entry("abc")
+    uncached.get_entry("abc")
+    assert len(uncached.session.requests) == 2
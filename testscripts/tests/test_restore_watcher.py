@@ -0,0 +1,99 @@
+import asyncio
+
+from restore_watcher import PollSchedule, RestoreWatcher
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = str(content)
+
+    def json(self):
+        return self.content
+
+
+class SimulatedRestores(object):
+    """
+    fake client for a server where each file finishes restoring at a given time on a simulated clock
+    """
+    def __init__(self, bulks):
+        self.bulks = bulks          # bulk ID -> {file ID: completion time, or None if not in Glacier}
+        self.now = 0.0
+        self.paths = []
+
+    def get(self, path):
+        self.paths.append(path)
+        if path.startswith("/api/archive/bulkStatus/"):
+            files = self.bulks[path.split("/")[-1]]
+            done = [t for t in files.values() if t is not None and t<=self.now]
+            return FakeResponse(200, {"status": "ok", "objectClass": "restore_stats", "entry": {
+                "unneeded": len([t for t in files.values() if t is None]),
+                "inProgress": len([t for t in files.values() if t is not None and t>self.now]),
+                "available": len(done), "notRequested": 0, "lost": 0}})
+        elif path.startswith("/api/search/myLightBox"):
+            bulk_id = path.split("bulkId=")[1].split("&")[0]
+            start = int(path.split("start=")[1].split("&")[0])
+            ids = sorted(self.bulks[bulk_id].keys())
+            return FakeResponse(200, {"status": "ok", "entries": [{"id": i} for i in ids[start:start+2]], "entryCount": len(ids)})
+        elif path.startswith("/api/archive/status/"):
+            file_id = path.split("/")[-1].split("?")[0]
+            completes = [files[file_id] for files in self.bulks.values() if file_id in files][0]
+            if completes is None:
+                status = "RS_UNNEEDED"
+            else:
+                status = "RS_SUCCESS" if completes<=self.now else "RS_UNDERWAY"
+            return FakeResponse(200, {"status": "ok", "fileId": file_id, "restoreStatus": status, "expiry": None, "downloadLink": None})
+        return FakeResponse(404, {"status": "not_found"})
+
+
+def test_poll_schedule():
+    schedule = PollSchedule("standard", min_interval=30, max_interval=3600)
+    assert schedule.next_interval(0) == 3600                    #capped
+    assert schedule.next_interval(3*3600 - 1200) == 600         #nearly there: halving the remaining time
+    assert schedule.next_interval(3*3600 - 400) == 360          #but no faster than the in-window rate
+    assert schedule.next_interval(4*3600) == 360                #in the window: (5h-3h)/20
+    assert schedule.next_interval(5*3600 + 3600) == 1260        #overdue: backing off
+    assert PollSchedule("expedited", min_interval=30).next_interval(120) == 30
+
+
+def run_watcher(client, bulks):
+    async def fake_sleep(seconds):
+        client.now += seconds
+
+    events = []
+    watcher = RestoreWatcher(client, schedule=PollSchedule("standard"), on_event=events.append, concurrency=4,
+                             page_size=2, clock=lambda: client.now, sleep=fake_sleep)
+    results = asyncio.run(watcher.watch(bulks))
+    return watcher, events, results
+
+
+def test_watcher_reports_files_soon_after_they_become_available():
+    client = SimulatedRestores({"bulk-a": {"a1": 3.2*3600, "a2": 3.5*3600, "a3": 4.9*3600, "a4": 3.1*3600, "a5": None}})
+    watcher, events, results = run_watcher(client, {"bulk-a": 0.0})
+
+    available = {e["fileId"]: e["time"] for e in events if e["event"]=="file_available"}
+    assert sorted(available.keys()) == ["a1", "a2", "a3", "a4", "a5"]
+    # each file is picked up within one in-window poll interval of finishing
+    for file_id, completes in client.bulks["bulk-a"].items():
+        if completes is not None:
+            assert completes <= available[file_id] <= completes + 360
+
+    assert [e["event"] for e in events][-1] == "bulk_complete"
+    assert results[0].pending == set()
+    # polling every minute for five hours would have made hundreds of requests
+    assert watcher.requests == len(client.paths) < 60
+
+
+def test_watcher_tracks_several_bulks():
+    # the simulated clock is shared, so each bulk's sleeps move time on for the others too; only check the outcome
+    client = SimulatedRestores({
+        "bulk-a": {"a1": 3.2*3600, "a2": 4.9*3600, "a3": None},
+        "bulk-b": {"b1": 3.1*3600, "b2": 3.1*3600, "b3": 3.3*3600},
+        "bulk-c": {"c1": None},
+    })
+    watcher, events, results = run_watcher(client, {"bulk-a": 0.0, "bulk-b": 0.0, "bulk-c": 0.0})
+
+    assert sorted(e["fileId"] for e in events if e["event"]=="file_available") == ["a1", "a2", "a3", "b1", "b2", "b3", "c1"]
+    assert sorted(e["bulkId"] for e in events if e["event"]=="bulk_complete") == ["bulk-a", "bulk-b", "bulk-c"]
+    assert all(r.pending == set() for r in results)
@@ -0,0 +1,43 @@
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import s3_lister
+
+KEYS = sorted([
+    "a.txt", "a/1.mxf", "a/2.mxf", "a/b/c/d.mov", "a/b/e.mov", "a-file", "b/", "b/x", "c/deep/er/file.mp4",
+    "top-level", "with\nnewline/file", "z/last",
+] + ["bulk/{0:05d}.wav".format(i) for i in range(250)])
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test-bucket")
+        client.create_bucket(Bucket="empty-bucket")
+        for key in KEYS:
+            client.put_object(Bucket="test-bucket", Key=key, Body=b"")
+        yield client
+
+
+def test_iterate_keys(s3):
+    assert list(s3_lister.iterate_keys(s3, "test-bucket", page_size=100)) == KEYS
+    assert list(s3_lister.iterate_keys(s3, "test-bucket", "a/b/")) == ["a/b/c/d.mov", "a/b/e.mov"]
+
+
+def test_iterate_keys_empty(s3):
+    assert list(s3_lister.iterate_keys(s3, "empty-bucket")) == []
+    assert list(s3_lister.iterate_keys(s3, "test-bucket", "nonexistent/")) == []
+
+
+@pytest.mark.parametrize("depth,concurrency", [(1, 1), (1, 4), (2, 3), (3, 8)])
+def test_list_sharded_matches_serial_order(s3, depth, concurrency):
+    result = list(s3_lister.list_sharded(s3, "test-bucket", concurrency=concurrency, depth=depth, page_size=100, spool_size=1024))
+    assert result == KEYS
+
+
+def test_list_sharded_with_prefix(s3):
+    assert list(s3_lister.list_sharded(s3, "test-bucket", "a/", concurrency=2)) == ["a/1.mxf", "a/2.mxf", "a/b/c/d.mov", "a/b/e.mov"]
+    assert list(s3_lister.list_sharded(s3, "empty-bucket", concurrency=2)) == []
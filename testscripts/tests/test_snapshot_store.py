@@ -0,0 +1,128 @@
+import json
+import re
+
+import pytest
+
+from archivehunter_client import ArchiveHunterClient, parse_zoned_datetime
+from hmac_stub_server import StubArchiveHunter, make_entries
+from snapshot_store import SnapshotError, SnapshotStore, count, load, parse_size, query
+
+
+class WindowedSearchServer(StubArchiveHunter):
+    """
+    stub server whose browser search sorts by last_modified, understands the path and last_modified range filters, and
+    refuses to page past `window` like Elasticsearch does
+    """
+    def __init__(self, entries, window):
+        super().__init__("s3cr3t", entry_count=0)
+        self.entries = entries
+        self.window = window
+        self.searches = []
+        self.add_route("POST", r'^/api/search/browser$', self._windowed_search)
+
+    def _windowed_search(self, request, match, query, body):
+        search = json.loads(body)
+        start = int(query["start"][0])
+        size = int(query["size"][0])
+        self.searches.append((search.get("q"), start))
+        if start + size>self.window:
+            return 500, {"status": "search_error", "detail": "Result window is too large"}
+        results = [e for e in self.entries if e["bucket"]==search["collection"]]
+        if search.get("path"):
+            results = [e for e in results if e["path"].startswith(search["path"] + "/")]
+        if search.get("q"):
+            since = parse_zoned_datetime(re.match(r'^last_modified:\["(.*)" TO \*\]$', search["q"]).group(1))
+            results = [e for e in results if parse_zoned_datetime(e["last_modified"])>=since]
+        results.sort(key=lambda e: (e["last_modified"], e["id"]))
+        return 200, {"status": "ok", "entityClass": "entry", "entries": results[start:start+size], "entryCount": len(results)}
+
+
+def sample_entries(count=250):
+    entries = make_entries(count)
+    for i, entry in enumerate(entries):
+        # a few entries share each modification time, so window boundaries fall in the middle of them
+        entry["last_modified"] = "2020-01-01T00:{0:02d}:{1:02d}Z".format(i//180, (i//3)%60)
+    return entries
+
+
+def test_load_reads_past_the_result_window(tmpdir):
+    entries = sample_entries()
+    with WindowedSearchServer(entries, window=100) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        store = SnapshotStore(str(tmpdir.join("snapshot.db")))
+        counts = load(client, store, "stub-bucket", page_size=20, concurrency=3, window=100)
+
+        assert counts["removed"] == 0
+        assert counts["loaded"]>=250       # the boundaries overlap
+        assert count(store, collection="stub-bucket") == (250, sum(e["size"] for e in entries))
+        assert len([s for s in server.searches if s[1]==0]) == 3
+
+
+def test_refresh_and_reload(tmpdir):
+    entries = sample_entries()
+    with WindowedSearchServer(entries, window=100) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        store = SnapshotStore(str(tmpdir.join("snapshot.db")))
+        load(client, store, "stub-bucket", page_size=50, window=100)
+
+        new_entry = dict(entries[0], id="new-entry", path="project099/new.mxf", last_modified="2020-02-01T00:00:00Z")
+        server.entries = entries[10:] + [new_entry]
+        server.searches = []
+        counts = load(client, store, "stub-bucket", refresh=True, page_size=50, window=100)
+        # only the entries at or after the newest one in the snapshot are read, and nothing is removed
+        assert counts["loaded"] == 2 and counts["removed"] == 0
+        assert count(store)[0] == 251
+
+        counts = load(client, store, "stub-bucket", page_size=50, window=100)
+        assert counts["removed"] == 10
+        assert count(store)[0] == 241
+
+
+def test_load_under_a_path_only_removes_within_it(tmpdir):
+    entries = sample_entries()
+    with WindowedSearchServer(entries, window=1000) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        store = SnapshotStore(str(tmpdir.join("snapshot.db")))
+        load(client, store, "stub-bucket")
+
+        server.entries = [e for e in entries if e["path"]!="project001/media/clip_000150.wav" and e["path"]!="project000/media/clip_000001.mp4"]
+        counts = load(client, store, "stub-bucket", path="project001")
+        assert counts == {"loaded": 99, "removed": 1}
+        assert count(store, path="project000/")[0] == 100
+
+
+def test_stuck_window_is_reported(tmpdir):
+    entries = sample_entries(30)
+    for entry in entries:
+        entry["last_modified"] = "2020-01-01T00:00:00Z"
+    with WindowedSearchServer(entries, window=10) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        with pytest.raises(SnapshotError):
+            load(client, SnapshotStore(str(tmpdir.join("snapshot.db"))), "stub-bucket", page_size=5, window=10)
+
+
+def test_query_filters(tmpdir):
+    entries = sample_entries()
+    with WindowedSearchServer(entries, window=1000) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        store = SnapshotStore(str(tmpdir.join("snapshot.db")))
+        load(client, store, "stub-bucket")
+    store.close()
+
+    store = SnapshotStore(str(tmpdir.join("snapshot.db")), read_only=True)
+    big_glacier = list(query(store, path="project002", min_size=parse_size("5G"), storage_class="GLACIER"))
+    expected = [e for e in entries if e["path"].startswith("project002/") and e["size"]>=5*1024**3 and e["storageClass"]=="GLACIER"]
+    assert [e["id"] for e in big_glacier] == [e["id"] for e in expected]
+    assert len(expected)>0
+
+    videos = list(query(store, mime="video/mp4", limit=5))
+    assert len(videos) == 5 and all(e["mimeType"]["major"]=="video" for e in videos)
+    assert count(store, mime="audio", deleted=True) == (0, 0)
+    with pytest.raises(Exception):
+        store.conn.execute("DELETE FROM entries")
+
+
+def test_parse_size():
+    assert parse_size("10G") == 10*1024**3
+    assert parse_size("1.5k") == 1536
+    assert parse_size("500") == 500
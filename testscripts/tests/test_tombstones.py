@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+from archivehunter_client import ArchiveHunterClient
+from bulk_runner import Journal, TokenBucket
+from hmac_stub_server import StubArchiveHunter
+from tombstones import TombstoneStreamError, delete_tombstones, deleted_search_uri, spool_ids, stream_tombstones, write_listing
+
+
+class TombstoneServer(StubArchiveHunter):
+    """
+    stub server with the deleted-items routes, streaming the listing in small uneven chunks
+    """
+    def __init__(self, tombstone_count, **kwargs):
+        super().__init__("s3cr3t", entry_count=tombstone_count*2, **kwargs)
+        for entry in self.entries[::2]:
+            entry["beenDeleted"] = True
+        self.deletes = []
+        self.add_route("PUT", r'^/api/deleted/([^/]+)/search$', self._deleted_search)
+        self.add_route("DELETE", r'^/api/deleted/([^/]+)/([^/]+)$', self._remove_tombstone)
+
+    def _deleted_search(self, request, match, query, body):
+        limit = int(query.get("limit", ["1000"])[0])
+        prefix = query.get("prefix", [""])[0]
+        tombstones = [e for e in self.entries if e["beenDeleted"] and e["bucket"]==match.group(1) and e["path"].startswith(prefix)][:limit]
+
+        def chunks():
+            data = b"".join(json.dumps(e).encode("UTF-8") + b"\n" for e in tombstones)
+            for i in range(0, len(data), 777):
+                yield data[i:i+777]
+        return 200, chunks()
+
+    def _remove_tombstone(self, request, match, query, body):
+        self.deletes.append(match.group(2))
+        entry = self.entries_by_id.get(match.group(2))
+        if entry is None or not entry["beenDeleted"]:
+            return 404, {"status": "not_found", "detail": match.group(2)}
+        self.entries.remove(entry)
+        del self.entries_by_id[entry["id"]]
+        return 200, {"status": "ok", "detail": "item deleted"}
+
+
+def make_client(server):
+    return ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+
+
+def test_deleted_search_uri():
+    assert deleted_search_uri("my-bucket") == "/api/deleted/my-bucket/search?limit=9223372036854775807"
+    assert deleted_search_uri("my-bucket", "path/to", 10) == "/api/deleted/my-bucket/search?limit=10&prefix=path%2Fto"
+
+
+def test_stream_and_list_tombstones():
+    with TombstoneServer(150) as server:
+        out = io.StringIO()
+        count = write_listing(stream_tombstones(make_client(server), "stub-bucket", chunk_size=100), out, ids_only=True)
+
+        assert count == 150
+        assert out.getvalue().splitlines() == [e["id"] for e in server.entries if e["beenDeleted"]]
+
+        limited = list(stream_tombstones(make_client(server), "stub-bucket", prefix="project001/", limit=5))
+        assert len(limited) == 5
+        assert all(e["path"].startswith("project001/") for e in limited)
+
+
+def test_stream_reports_server_errors():
+    with TombstoneServer(5) as server:
+        client = ArchiveHunterClient(server.host, "wrong", scheme="http", timeout=10)
+        with pytest.raises(TombstoneStreamError):
+            list(stream_tombstones(client, "stub-bucket"))
+
+
+def test_delete_tombstones_with_journal(tmpdir):
+    journal_path = str(tmpdir.join("journal.ndjson"))
+    with TombstoneServer(40) as server:
+        client = make_client(server)
+        spool = io.StringIO()
+        assert spool_ids(stream_tombstones(client, "stub-bucket"), spool) == 40
+        ids = spool.getvalue().splitlines()
+
+        journal = Journal(journal_path)
+        counts = delete_tombstones(client, "stub-bucket", ids[:25], journal, TokenBucket(0), concurrency=4)
+        journal.close()
+        assert counts == {"deleted": 25, "already_gone": 0, "failed": 0, "skipped": 0}
+
+        journal = Journal(journal_path)
+        counts = delete_tombstones(client, "stub-bucket", ids + [ids[0] + "x"], journal, TokenBucket(0), concurrency=4)
+        journal.close()
+        assert counts == {"deleted": 15, "already_gone": 1, "failed": 0, "skipped": 25}
+
+        assert list(stream_tombstones(client, "stub-bucket")) == []
+        assert len(server.entries) == 40
@@ -0,0 +1,127 @@
+import json
+
+from archivehunter_client import ArchiveHunterClient
+from hmac_stub_server import StubArchiveHunter
+from tree_walker import ROOT, FolderIndex, format_report, parent_of, walk
+
+
+class TreeServer(StubArchiveHunter):
+    """
+    stub server answering the browse endpoints from a dict of path -> (size, storage class)
+    """
+    def __init__(self, files):
+        super().__init__("s3cr3t", entry_count=0)
+        self.files = files
+        self.listed = []
+        self.summarised = []
+        self.add_route("GET", r'^/api/browse/([^/]+)$', self._folders)
+        self.add_route("PUT", r'^/api/browse/([^/]+)/summary$', self._summary)
+
+    def _folders(self, request, match, query, body):
+        # like the path cache: every key at the next level down that starts with the prefix
+        prefix = query.get("prefix", [""])[0]
+        self.listed.append(prefix)
+        level = len(prefix.rstrip("/").split("/")) + 1 if prefix else 1
+        keys = set()
+        for path in self.files:
+            parts = path.split("/")[:-1]
+            if len(parts)>=level and path.startswith(prefix):
+                keys.add("/".join(parts[:level]) + "/")
+        return 200, {"status": "ok", "entityClass": "folder", "entries": sorted(keys), "entryCount": -1}
+
+    def _summary(self, request, match, query, body):
+        prefix = query.get("prefix", [None])[0]
+        search = json.loads(body)
+        self.summarised.append((prefix, search.get("q")))
+        matching = [(p, f) for p, f in self.files.items() if prefix is None or p.startswith(prefix + "/")]
+        if search.get("q"):
+            storage_class = search["q"].split(":")[1]
+            matching = [(p, f) for p, f in matching if f[1]==storage_class]
+        return 200, {"status": "ok", "totalHits": len(matching), "totalSize": sum(f[0] for _, f in matching),
+                     "deletedCounts": {}, "proxiedCounts": {}, "typesCount": {}}
+
+
+def sample_files():
+    return {
+        "news/2019/a.mxf": (100, "GLACIER"),
+        "news/2019/b.mxf": (200, "STANDARD"),
+        "news/2020/jan/c.mp4": (300, "STANDARD"),
+        "news/2020/feb/d.mp4": (400, "STANDARD_IA"),
+        "sport/e.wav": (500, "STANDARD"),
+        "sport/football/f.wav": (600, "STANDARD"),
+        "top.txt": (1, "STANDARD"),
+    }
+
+
+def test_parent_of():
+    assert parent_of("a/b/c/") == "a/b/"
+    assert parent_of("a/") == ROOT
+    assert parent_of(ROOT) is None
+
+
+def test_walk_builds_the_index(tmpdir):
+    with TreeServer(sample_files()) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        index = FolderIndex(str(tmpdir.join("index.db")))
+        stats = walk(client, index, "bucket", concurrency=4)
+
+        assert stats.walked == 8 and stats.failed == 0
+        folders = {f["prefix"]: f for f in index.folders("bucket")}
+        assert sorted(folders.keys()) == ["", "news/", "news/2019/", "news/2020/", "news/2020/feb/", "news/2020/jan/", "sport/", "sport/football/"]
+        assert folders[""]["summary"]["totalSize"] == 2101
+        assert folders["news/"]["summary"]["storageClasses"] == {
+            "STANDARD": {"count": 2, "size": 500}, "GLACIER": {"count": 1, "size": 100}, "STANDARD_IA": {"count": 1, "size": 400}}
+        assert folders["news/2020/jan/"]["depth"] == 3
+        # sport/ has no glacier or IA content, so its subfolders are not asked about those classes
+        assert [q for prefix, q in server.summarised if prefix=="sport/football"] == [None]
+
+        report = format_report(index.folders("bucket", "news/", 2))
+        assert "2019/" in report and "jan/" not in report
+
+
+def test_refresh_only_walks_changed_subtrees(tmpdir):
+    files = sample_files()
+    with TreeServer(files) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        index = FolderIndex(str(tmpdir.join("index.db")))
+        walk(client, index, "bucket")
+
+        # nothing changed: only the root is summarised
+        server.listed = []
+        stats = walk(client, index, "bucket")
+        assert (stats.walked, stats.unchanged) == (0, 1)
+        assert server.listed == []
+
+        # a file moves to Glacier, one folder goes away and another appears
+        files["news/2020/feb/d.mp4"] = (400, "GLACIER")
+        del files["sport/football/f.wav"]
+        files["sport/rugby/g.wav"] = (700, "STANDARD")
+        server.listed = []
+        stats = walk(client, index, "bucket")
+
+        assert sorted(server.listed) == ["", "news/", "news/2020/", "news/2020/feb/", "sport/", "sport/rugby/"]
+        assert stats.removed == 1
+        folders = {f["prefix"]: f["summary"] for f in index.folders("bucket")}
+        assert "sport/football/" not in folders and "sport/rugby/" in folders
+        assert folders["news/2020/"]["storageClasses"]["GLACIER"] == {"count": 1, "size": 400}
+
+
+def test_interrupted_walk_is_not_trusted(tmpdir):
+    with TreeServer(sample_files()) as server:
+        client = ArchiveHunterClient(server.host, "s3cr3t", scheme="http", timeout=10)
+        index = FolderIndex(str(tmpdir.join("index.db")))
+        original = server._folders
+
+        def failing_folders(request, match, query, body):
+            if query.get("prefix")==["news/2020/"]:
+                return 500, {"status": "error", "detail": "test"}
+            return original(request, match, query, body)
+        server.add_route("GET", r'^/api/browse/([^/]+)$', failing_folders)
+        stats = walk(client, index, "bucket", retries=0)
+        assert stats.failed == 1
+
+        # with the server working again, the tree is walked again rather than skipped
+        server.add_route("GET", r'^/api/browse/([^/]+)$', original)
+        stats = walk(client, index, "bucket")
+        assert stats.failed == 0 and stats.walked == 8
+        assert "news/2020/jan/" in [f["prefix"] for f in index.folders("bucket")]
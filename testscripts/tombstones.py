@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+"""
+Lists the tombstones (entries flagged beenDeleted) in a collection and, optionally, removes them one at a time.
+
+The listing comes from PUT /api/deleted/:collection/search, which streams NDJSON from an index scroll.  The response is
+read and parsed a line at a time, so memory use stays the same however many tombstones there are.  Output is NDJSON
+(the full entries) or bare IDs.
+
+With --delete, each tombstone is removed with DELETE /api/deleted/:collection/:id, which checks on the server side that
+the item really is a deleted item in that collection.  The IDs are spooled to a temporary file before the deletes start,
+so that a slow or rate-limited delete run can't hold the server's scroll open until it times out.  Deletes are
+rate-limited, retried on throttling and can be journalled so that an interrupted run can be resumed.
+"""
+
+import json
+import logging
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import monotonic
+from typing import Iterable, Iterator, Union
+from urllib.parse import quote, urlencode
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import Journal, TokenBucket, TruncatedStreamError, iter_lines, request_with_backoff, run_bulk
+
+logger = logging.getLogger(__name__)
+
+# the server only returns the first 1000 items if no limit is given
+NO_LIMIT = 2**63 - 1
+
+
+class TombstoneStreamError(Exception):
+    pass
+
+
+def deleted_search_uri(collection:str, prefix:Union[str,None]=None, limit:Union[int,None]=None) -> str:
+    params = {"limit": limit if limit is not None else NO_LIMIT}
+    if prefix:
+        params["prefix"] = prefix
+    return "/api/deleted/{0}/search?{1}".format(quote(collection, safe=""), urlencode(params))
+
+
+def stream_tombstones(client:ArchiveHunterClient, collection:str, prefix:Union[str,None]=None, limit:Union[int,None]=None,
+                      search:Union[dict,None]=None, chunk_size:int=64*1024) -> Iterator[dict]:
+    """
+    Generator that yields each tombstone entry from the streaming deleted-items search
+    :param search: optional SearchRequest document to narrow the search with, e.g. {"q": "..."}
+    """
+    response = client.put(deleted_search_uri(collection, prefix, limit), body=search or {}, stream=True)
+    try:
+        if response.status_code!=200:
+            raise TombstoneStreamError("Server returned {0}: {1}".format(response.status_code, response.text))
+        for line in iter_lines(response.iter_content(chunk_size=chunk_size)):
+            yield json.loads(line)
+    finally:
+        response.close()
+
+
+def write_listing(entries:Iterable[dict], out, ids_only:bool=False) -> int:
+    """
+    writes the entries to `out` as NDJSON, or just their IDs
+    :return: the number written
+    """
+    count = 0
+    for entry in entries:
+        if ids_only:
+            out.write(entry["id"])
+        else:
+            out.write(json.dumps(entry, separators=(",", ":")))
+        out.write("\n")
+        count += 1
+        if count%10000==0:
+            logger.info("{0} tombstones listed".format(count))
+    return count
+
+
+def spool_ids(entries:Iterable[dict], spool) -> int:
+    """
+    writes the IDs of the entries to `spool` and rewinds it
+    :return: the number written
+    """
+    count = 0
+    for entry in entries:
+        spool.write(entry["id"] + "\n")
+        count += 1
+    spool.seek(0)
+    return count
+
+
+def delete_tombstones(client:ArchiveHunterClient, collection:str, ids:Iterable[str], journal:Journal, limiter:TokenBucket,
+                      concurrency:int, retries:int=5) -> dict:
+    """
+    Removes each tombstone, skipping any that the journal says are already done.  A 404 means that the item has
+    already gone, and counts as done.
+    :return: dictionary of counts
+    """
+    counts = {"deleted": 0, "already_gone": 0, "failed": 0, "skipped": 0}
+
+    def pending_ids():
+        for entry_id in ids:
+            entry_id = entry_id.strip()
+            if entry_id=="":
+                continue
+            if journal.is_done(entry_id):
+                counts["skipped"] += 1
+            else:
+                yield entry_id
+
+    def request_delete(entry_id):
+        uri = "/api/deleted/{0}/{1}".format(quote(collection, safe=""), quote(entry_id, safe=""))
+        return request_with_backoff(lambda: client.delete(uri), limiter, max_retries=retries)
+
+    start_time = monotonic()
+    for entry_id, response, error in run_bulk(pending_ids(), request_delete, concurrency):
+        if error:
+            counts["failed"] += 1
+            journal.record(entry_id, False, error=str(error))
+            logger.error("{0}: {1}".format(entry_id, error))
+        elif response.status_code in (200, 404):
+            counts["deleted" if response.status_code==200 else "already_gone"] += 1
+            journal.record(entry_id, True, status=response.status_code)
+        else:
+            counts["failed"] += 1
+            journal.record(entry_id, False, status=response.status_code, detail=response.text[:512])
+            logger.error("{0}: server returned {1} {2}".format(entry_id, response.status_code, response.text[:512]))
+
+        done = counts["deleted"] + counts["already_gone"] + counts["failed"]
+        if done%1000==0:
+            logger.info("{0} deletes requested, {1} failed, {2:.1f}/s".format(done, counts["failed"], done/(monotonic()-start_time)))
+    return counts
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="List the tombstones in a collection, and optionally remove them")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", required=True, help="shared secret to use")
+    parser.add_argument("-c", "--collection", dest="collection", required=True, help="collection (bucket) to list tombstones for")
+    parser.add_argument("--prefix", dest="prefix", help="only list tombstones under this path prefix")
+    parser.add_argument("-q", "--query", dest="query", help="only list tombstones matching this search string")
+    parser.add_argument("--limit", dest="limit", type=int, help="stop after this many tombstones. Defaults to all of them")
+    parser.add_argument("--ids", dest="ids_only", action="store_true", default=False, help="output bare IDs rather than NDJSON")
+    parser.add_argument("-o", "--output", dest="output", help="write the listing here rather than stdout")
+    parser.add_argument("--delete", dest="delete", action="store_true", default=False, help="remove the tombstones as well as listing them")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=4, help="number of delete requests in flight at once")
+    parser.add_argument("--rate", dest="rate", type=float, default=10, help="maximum delete requests per second. 0 for no limit")
+    parser.add_argument("--journal", dest="journal", help="record the outcome for each delete here, and skip IDs that already succeeded")
+    parser.add_argument("--retries", dest="retries", type=int, default=5, help="number of times to retry a request that was throttled")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    client = ArchiveHunterClient.from_options(args, pool_size=max(args.concurrency, 1))
+    search = {"q": args.query} if args.query else None
+    entries = stream_tombstones(client, args.collection, args.prefix, args.limit, search)
+
+    try:
+        if args.delete:
+            with tempfile.TemporaryFile("w+", encoding="UTF-8") as spool:
+                listed = spool_ids(entries, spool)
+                logger.info("{0} tombstones found, removing them".format(listed))
+                if args.output:
+                    with open(args.output, "w") as out:
+                        write_listing(({"id": line.rstrip("\n")} for line in spool), out, ids_only=True)
+                    spool.seek(0)
+                journal = Journal(args.journal)
+                try:
+                    counts = delete_tombstones(client, args.collection, spool, journal, TokenBucket(args.rate), args.concurrency, args.retries)
+                finally:
+                    journal.close()
+            counts["listed"] = listed
+            print(json.dumps(counts))
+            if counts["failed"]>0:
+                exit(1)
+        else:
+            out = open(args.output, "w") if args.output else sys.stdout
+            try:
+                listed = write_listing(entries, out, args.ids_only)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            logger.info("{0} tombstones listed".format(listed))
+    except (TombstoneStreamError, TruncatedStreamError) as e:
+        logger.error(str(e))
+        exit(2)
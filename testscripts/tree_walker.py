@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+Crawls the folder tree of a collection and keeps the size of every folder in a local SQLite index.  Capacity reports
+and Glacier cost estimates can then be read from the index instead of calling the server.
+
+Folders are listed with GET /api/browse/:collection?prefix=, which is backed by the path cache index.  Each one is
+summarised with PUT /api/browse/:collection/summary?prefix=.  Summaries cover the whole subtree, and the walk is
+breadth-first with a bounded number of folders in flight.
+
+Storage classes are counted by sending the summary again with a query string for each non-standard class.  The
+STANDARD count is what is left over, because the server treats a missing storage class as STANDARD.  A class is only
+queried for a folder if the parent folder has any of it, so mostly-standard trees cost little more than one summary per
+folder.
+
+A refresh compares each folder's new summary with the one in the index.  If they are the same, and the last walk of
+that subtree finished, the subtree is skipped.  Only the parts of the tree that changed are walked again.  Folders that
+have gone from the listing are removed from the index along with everything under them.  A change that leaves every
+count and size in a summary exactly as it was, such as a file renamed within its folder, is not picked up.  Run with
+--full now and then to catch those.
+"""
+
+import json
+import logging
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, time
+from typing import Iterator, Union
+from urllib.parse import quote, urlencode
+from uuid import uuid4
+
+import instrumentation
+from archivehunter_client import ArchiveHunterClient, DEFAULT_HOST
+from bulk_runner import request_with_backoff
+
+logger = logging.getLogger(__name__)
+
+# as in common/StorageClass.scala; the first one is the default for entries with none set
+STORAGE_CLASSES = ["STANDARD", "STANDARD_IA", "GLACIER", "REDUCED_REDUNDANCY"]
+ROOT = ""
+
+# us-east-1 list prices in USD per GB, for S3 Glacier Flexible Retrieval
+DEFAULT_GLACIER_STORAGE_RATE = 0.0036
+DEFAULT_GLACIER_RETRIEVAL_RATE = 0.01
+
+
+class TreeWalkError(Exception):
+    pass
+
+
+def parent_of(prefix:str) -> Union[str,None]:
+    """
+    the folder containing `prefix` in the path cache's key format, e.g. "a/b/" for "a/b/c/".  The parent of a
+    top-level folder is the root, and the root has none.
+    """
+    if prefix==ROOT:
+        return None
+    return prefix.rstrip("/").rpartition("/")[0] + "/" if "/" in prefix.rstrip("/") else ROOT
+
+
+def list_folders(client:ArchiveHunterClient, collection:str, prefix:str, retries:int=3) -> list:
+    """
+    :param prefix: folder to list, with a trailing slash so that "a/b" doesn't also match "a/bc"; ROOT for the top level
+    :return: list of the sub-folder keys, each with a trailing slash
+    """
+    uri = "/api/browse/{0}".format(quote(collection, safe=""))
+    if prefix!=ROOT:
+        uri += "?" + urlencode({"prefix": prefix})
+    response = request_with_backoff(lambda: client.get(uri), max_retries=retries)
+    if response.status_code!=200:
+        raise TreeWalkError("Could not list {0}, server returned {1}: {2}".format(prefix or "/", response.status_code, response.text[:512]))
+    return response.json()["entries"]
+
+
+def fetch_summary(client:ArchiveHunterClient, collection:str, prefix:str, query:Union[str,None]=None, retries:int=3) -> dict:
+    uri = "/api/browse/{0}/summary".format(quote(collection, safe=""))
+    if prefix!=ROOT:
+        # the path field is indexed with a path hierarchy tokenizer, whose tokens have no trailing slash
+        uri += "?" + urlencode({"prefix": prefix.rstrip("/")})
+    body = {"q": query} if query else {}
+    response = request_with_backoff(lambda: client.put(uri, body), max_retries=retries)
+    if response.status_code!=200:
+        raise TreeWalkError("Could not summarise {0}, server returned {1}: {2}".format(prefix or "/", response.status_code, response.text[:512]))
+    return response.json()
+
+
+def summarise_folder(client:ArchiveHunterClient, collection:str, prefix:str, parent_classes:Union[dict,None]=None,
+                     retries:int=3) -> dict:
+    """
+    Gets the summary of a folder, with a count and size for each storage class.
+    :param parent_classes: the parent folder's storage classes.  If given, any class the parent has none of is not queried
+    """
+    base = fetch_summary(client, collection, prefix, retries=retries)
+    storage = {}
+    for storage_class in STORAGE_CLASSES[1:]:
+        if base["totalHits"]==0 or (parent_classes is not None and parent_classes.get(storage_class, {}).get("count", 0)==0):
+            continue
+        result = fetch_summary(client, collection, prefix, "storageClass:{0}".format(storage_class), retries)
+        if result["totalHits"]>0:
+            storage[storage_class] = {"count": result["totalHits"], "size": result["totalSize"]}
+    storage[STORAGE_CLASSES[0]] = {
+        "count": base["totalHits"] - sum(s["count"] for s in storage.values()),
+        "size": base["totalSize"] - sum(s["size"] for s in storage.values()),
+    }
+    return {
+        "totalHits": base["totalHits"],
+        "totalSize": base["totalSize"],
+        "deletedCounts": base.get("deletedCounts", {}),
+        "proxiedCounts": base.get("proxiedCounts", {}),
+        "typesCount": base.get("typesCount", {}),
+        "storageClasses": storage,
+    }
+
+
+class FolderIndex(object):
+    """
+    SQLite store of folder summaries.  It is only used from the thread that created it.
+
+    A folder is marked complete once a walk has finished with everything under it.  Only complete folders are trusted
+    when deciding whether a subtree can be skipped, so a walk that was interrupted picks up the rest next time.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS folders (collection TEXT NOT NULL, prefix TEXT NOT NULL, parent TEXT, "
+                          "depth INTEGER NOT NULL, total_hits INTEGER NOT NULL, total_size INTEGER NOT NULL, summary TEXT NOT NULL, "
+                          "walked_at REAL NOT NULL, walk_id TEXT NOT NULL, complete INTEGER NOT NULL DEFAULT 0, "
+                          "PRIMARY KEY (collection, prefix))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS folders_parent ON folders (collection, parent)")
+        self.conn.commit()
+
+    def get(self, collection:str, prefix:str) -> Union[dict,None]:
+        row = self.conn.execute("SELECT summary, walked_at, complete FROM folders WHERE collection=? AND prefix=?", (collection, prefix)).fetchone()
+        if row is None:
+            return None
+        return {"summary": json.loads(row[0]), "walked_at": row[1], "complete": row[2]==1}
+
+    def children(self, collection:str, prefix:str) -> list:
+        return [r[0] for r in self.conn.execute("SELECT prefix FROM folders WHERE collection=? AND parent=?", (collection, prefix))]
+
+    def save(self, collection:str, prefix:str, summary:dict, walk_id:str):
+        depth = len(prefix.rstrip("/").split("/")) if prefix!=ROOT else 0
+        self.conn.execute("INSERT OR REPLACE INTO folders (collection, prefix, parent, depth, total_hits, total_size, summary, walked_at, walk_id, complete) "
+                          "VALUES (?,?,?,?,?,?,?,?,?,0)",
+                          (collection, prefix, parent_of(prefix), depth, summary["totalHits"], summary["totalSize"],
+                           json.dumps(summary, sort_keys=True), time(), walk_id))
+
+    def remove_subtree(self, collection:str, prefix:str) -> int:
+        """
+        removes a folder and everything under it
+        :return: the number of folders removed
+        """
+        cursor = self.conn.execute("DELETE FROM folders WHERE collection=? AND substr(prefix, 1, ?)=?", (collection, len(prefix), prefix))
+        return cursor.rowcount
+
+    def mark_complete(self, collection:str, walk_id:str):
+        self.conn.execute("UPDATE folders SET complete=1 WHERE collection=? AND walk_id=?", (collection, walk_id))
+        self.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def folders(self, collection:str, prefix:str=ROOT, max_depth:Union[int,None]=None) -> Iterator[dict]:
+        """
+        Generator that yields the stored summaries of `prefix` and the folders under it, in path order
+        """
+        sql = "SELECT prefix, depth, summary, walked_at FROM folders WHERE collection=? AND substr(prefix, 1, ?)=?"
+        params = [collection, len(prefix), prefix]
+        if max_depth is not None:
+            sql += " AND depth<=?"
+            params.append(max_depth)
+        for row in self.conn.execute(sql + " ORDER BY prefix", params):
+            yield {"prefix": row[0], "depth": row[1], "summary": json.loads(row[2]), "walked_at": row[3]}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class WalkStats(object):
+    def __init__(self):
+        self.walked = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.failed = 0
+
+    def format(self) -> str:
+        return "{0} folders walked, {1} unchanged subtrees skipped, {2} folders removed, {3} failed".format(
+            self.walked, self.unchanged, self.removed, self.failed)
+
+
+def walk(client:ArchiveHunterClient, index:FolderIndex, collection:str, start:str=ROOT, concurrency:int=8,
+         full:bool=False, retries:int=3, progress_interval:float=30) -> WalkStats:
+    """
+    Walks the tree from `start` breadth-first, updating the index.
+    :param full: if True, every folder is walked again even if its summary hasn't changed
+    :return: WalkStats
+    """
+    walk_id = uuid4().hex
+    stats = WalkStats()
+    queue = deque([(start, None)])      #(prefix, parent's storage classes)
+    in_flight = {}
+
+    def visit(prefix, parent_classes, previous):
+        summary = summarise_folder(client, collection, prefix, parent_classes, retries)
+        if not full and previous is not None and previous["complete"] and previous["summary"]==summary:
+            return summary, None
+        children = list_folders(client, collection, prefix, retries) if summary["totalHits"]>0 else []
+        return summary, children
+
+    last_report = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while len(queue)>0 or len(in_flight)>0:
+            # only `concurrency` folders are handed to the pool at a time, so the rest of the frontier stays in order
+            while len(queue)>0 and len(in_flight)<concurrency:
+                prefix, parent_classes = queue.popleft()
+                future = executor.submit(visit, prefix, parent_classes, index.get(collection, prefix))
+                in_flight[future] = prefix
+
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = in_flight.pop(future)
+                try:
+                    summary, children = future.result()
+                except Exception as e:
+                    logger.error("Could not walk {0}: {1}".format(prefix or "/", e))
+                    stats.failed += 1
+                    continue
+                if children is None:
+                    stats.unchanged += 1
+                    continue
+
+                stats.walked += 1
+                index.save(collection, prefix, summary, walk_id)
+                for gone in set(index.children(collection, prefix)) - set(children):
+                    stats.removed += index.remove_subtree(collection, gone)
+                queue.extend((child, summary["storageClasses"]) for child in children)
+
+            if monotonic() - last_report>=progress_interval:
+                index.commit()
+                logger.info("{0}, {1} queued".format(stats.format(), len(queue)))
+                last_report = monotonic()
+
+    index.commit()
+    if stats.failed==0:
+        index.mark_complete(collection, walk_id)
+    else:
+        logger.warning("Some folders could not be walked, so this walk will not be used to skip subtrees next time")
+    return stats
+
+
+def glacier_costs(summary:dict, storage_rate:float=DEFAULT_GLACIER_STORAGE_RATE,
+                  retrieval_rate:float=DEFAULT_GLACIER_RETRIEVAL_RATE) -> (float, float):
+    """
+    :return: tuple of (monthly storage cost, cost to retrieve all of it) for the Glacier content of a folder
+    """
+    glacier_gb = summary["storageClasses"].get("GLACIER", {}).get("size", 0)/1e9
+    return glacier_gb*storage_rate, glacier_gb*retrieval_rate
+
+
+def format_report(folders:Iterator[dict], storage_rate:float=DEFAULT_GLACIER_STORAGE_RATE,
+                  retrieval_rate:float=DEFAULT_GLACIER_RETRIEVAL_RATE) -> str:
+    lines = ["{0:<60} {1:>10} {2:>12} {3:>12} {4:>12} {5:>12}".format("folder", "files", "size GB", "glacier GB", "$/month", "$ restore")]
+    for folder in folders:
+        summary = folder["summary"]
+        storage_cost, retrieval_cost = glacier_costs(summary, storage_rate, retrieval_rate)
+        name = "  "*folder["depth"] + (folder["prefix"].rstrip("/").rpartition("/")[2] + "/" if folder["prefix"]!=ROOT else "/")
+        lines.append("{0:<60} {1:>10} {2:>12.1f} {3:>12.1f} {4:>12.2f} {5:>12.2f}".format(
+            name, summary["totalHits"], summary["totalSize"]/1e9,
+            summary["storageClasses"].get("GLACIER", {}).get("size", 0)/1e9, storage_cost, retrieval_cost))
+    return "\n".join(lines)
+
+
+if __name__=="__main__":
+    parser = ArgumentParser(description="Walk a collection's folder tree into a local index of folder sizes, or report from the index")
+    parser.add_argument("--host", dest="host", default=DEFAULT_HOST, help="host to access")
+    parser.add_argument("--no-verify", dest="sslnoverify", action="store_true", default=False, help="set this to disable SSL cert checking")
+    parser.add_argument("-s", "--secret", dest="secret", help="shared secret to use. Not needed for --report")
+    parser.add_argument("-c", "--collection", dest="collection", required=True, help="collection to walk")
+    parser.add_argument("-i", "--index", dest="index", required=True, help="SQLite file to keep the index in")
+    parser.add_argument("-p", "--prefix", dest="prefix", default=ROOT, help="only walk or report this folder, e.g. path/to/")
+    parser.add_argument("-j", "--concurrency", dest="concurrency", type=int, default=8, help="number of folders to walk at once")
+    parser.add_argument("--full", dest="full", action="store_true", default=False, help="walk every folder again, even if its summary is unchanged")
+    parser.add_argument("--report", dest="report", action="store_true", default=False, help="print sizes and Glacier costs from the index instead of walking")
+    parser.add_argument("--depth", dest="depth", type=int, default=2, help="number of levels below --prefix to include in the report")
+    parser.add_argument("--glacier-rate", dest="glacier_rate", type=float, default=DEFAULT_GLACIER_STORAGE_RATE, help="Glacier storage cost per GB-month")
+    parser.add_argument("--retrieval-rate", dest="retrieval_rate", type=float, default=DEFAULT_GLACIER_RETRIEVAL_RATE, help="Glacier retrieval cost per GB")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.from_args(args)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    prefix = args.prefix if args.prefix in (ROOT, "/") or args.prefix.endswith("/") else args.prefix + "/"
+    prefix = ROOT if prefix=="/" else prefix
+    index = FolderIndex(args.index)
+    try:
+        if args.report:
+            depth = len(prefix.rstrip("/").split("/")) if prefix!=ROOT else 0
+            print(format_report(index.folders(args.collection, prefix, depth + args.depth), args.glacier_rate, args.retrieval_rate))
+        else:
+            if not args.secret:
+                parser.error("--secret is required to walk")
+            client = ArchiveHunterClient.from_options(args, pool_size=args.concurrency)
+            stats = walk(client, index, args.collection, prefix, args.concurrency, args.full)
+            logger.info(stats.format())
+            if stats.failed>0:
+                exit(1)
+    finally:
+        index.close()
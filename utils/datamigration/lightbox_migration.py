@@ -1,39 +1,396 @@
 #!/usr/bin/env python3
 
 import boto3
+import json
 import logging
+import os
+import queue
+import random
+import threading
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from botocore.exceptions import ClientError
 
-source_table = ""
+try:
+    import instrumentation      # testscripts/instrumentation.py, if it is on the PYTHONPATH
+except ImportError:
+    instrumentation = None
 
-ddb = boto3.resource("dynamodb")
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Limits the rate of BatchWriteItem calls, backing off multiplicatively when the table throttles and recovering
+    additively while it doesn't.  Until the first throttle there is no limit.
+    """
+    def __init__(self, min_rate:float=1.0, increase:float=0.5):
+        self.rate = None
+        self.min_rate = min_rate
+        self.increase = increase
+        self._lock = threading.Lock()
+        self._next_send = monotonic()
+        self._recent = deque(maxlen=200)
+
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            self._recent.append(now)
+            if self.rate is None:
+                return
+            wait_until = max(self._next_send, now)
+            self._next_send = wait_until + 1.0/self.rate
+        sleep(max(0.0, wait_until - now))
+
+    def observed_rate(self) -> float:
+        with self._lock:
+            if len(self._recent)<2:
+                return self.min_rate
+            return (len(self._recent)-1)/max(self._recent[-1] - self._recent[0], 0.001)
+
+    def throttled(self):
+        current = self.rate if self.rate is not None else self.observed_rate()
+        with self._lock:
+            self.rate = max(self.min_rate, current/2)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate is not None:
+                self.rate += self.increase
 
 
 class OperationBuffer(object):
-    def __init__(self):
-        pass
+    """
+    Accumulates write requests for a table and sends them with BatchWriteItem in groups of up to 25, from several
+    flusher threads at once.  UnprocessedItems are re-submitted with jittered exponential backoff, and the send rate is
+    reduced while the table is throttling.
+    Batches are handed to the flushers over a bounded queue, so `put` blocks if writing falls behind.
+    """
+    BATCH_SIZE = 25
+
+    def __init__(self, client, table_name:str, flushers:int=4, max_retries:int=10, limiter:AdaptiveRateLimiter=None):
+        self.client = client
+        self.table_name = table_name
+        self.max_retries = max_retries
+        self.limiter = limiter if limiter else AdaptiveRateLimiter()
+        self.logger = logging.getLogger("OperationBuffer")
+
+        self._pending = []
+        self._batches = queue.Queue(maxsize=flushers*2)
+        self._stats_lock = threading.Lock()
+        self.items_written = 0
+        self.consumed_capacity = 0.0
+        self.throttle_events = 0
+        self.errors = []
+        self._start_time = monotonic()
+
+        self._flushers = [threading.Thread(target=self._flusher, daemon=True) for _ in range(flushers)]
+        for t in self._flushers:
+            t.start()
+
+    def put(self, item:dict):
+        self._add({"PutRequest": {"Item": item}})
 
+    def delete(self, key:dict):
+        self._add({"DeleteRequest": {"Key": key}})
 
-def iterate_source_records(source_table_name:str):
+    def _add(self, request:dict):
+        if len(self.errors)>0:
+            raise self.errors[0]
+        self._pending.append(request)
+        if len(self._pending)>=self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        hands any buffered requests to the flushers, even if there are fewer than a full batch
+        """
+        if len(self._pending)>0:
+            self._batches.put(self._pending)
+            self._pending = []
+
+    def drain(self):
+        """
+        sends any buffered requests and waits until everything handed to the flushers so far has been written. Raises
+        the first write error, if any, so that a checkpoint taken after it can't skip records that were not written.
+        """
+        self.flush()
+        self._batches.join()
+        if len(self.errors)>0:
+            raise self.errors[0]
+
+    def close(self):
+        """
+        sends any remaining requests and waits for the flushers to finish. Raises the first write error, if any.
+        """
+        self.flush()
+        for _ in self._flushers:
+            self._batches.put(None)
+        for t in self._flushers:
+            t.join()
+        if len(self.errors)>0:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _flusher(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                self._batches.task_done()
+                return
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.logger.error("Could not write batch of {0} items: {1}".format(len(batch), e))
+                self.errors.append(e)
+            finally:
+                self._batches.task_done()
+
+    def _write_batch(self, batch:list):
+        attempt = 0
+        while len(batch)>0:
+            self.limiter.acquire()
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: batch}, ReturnConsumedCapacity="TOTAL")
+                unprocessed = response.get("UnprocessedItems", {}).get(self.table_name, [])
+                with self._stats_lock:
+                    self.items_written += len(batch) - len(unprocessed)
+                    for capacity in response.get("ConsumedCapacity", []):
+                        self.consumed_capacity += capacity.get("CapacityUnits", 0)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in THROTTLING_ERRORS:
+                    raise
+                unprocessed = batch
+
+            if len(unprocessed)==0:
+                self.limiter.succeeded()
+                return
+
+            with self._stats_lock:
+                self.throttle_events += 1
+            self.limiter.throttled()
+            attempt += 1
+            if attempt>self.max_retries:
+                raise RuntimeError("{0} items were still unprocessed after {1} attempts".format(len(unprocessed), attempt))
+            delay = random.uniform(0, min(20.0, 0.05*(2**attempt)))
+            self.logger.debug("{0} unprocessed items, retrying in {1:.2f}s".format(len(unprocessed), delay))
+            sleep(delay)
+            batch = unprocessed
+
+    def report(self) -> str:
+        elapsed = max(monotonic() - self._start_time, 0.001)
+        rate = self.limiter.rate
+        return "{0} items written, {1:.0f} items/s, {2:.1f} capacity units consumed, {3} throttle events, send rate {4}".format(
+            self.items_written, self.items_written/elapsed, self.consumed_capacity, self.throttle_events,
+            "unlimited" if rate is None else "{0:.1f} batches/s".format(rate))
+
+
+def iterate_source_records(source_table_name:str, client=None):
     """
-    a generator that yields records from the source table
-    :param source_table_name:
+    a generator that yields records from the source table, scanning it serially
+    :param source_table_name: table to scan
+    :param client: boto3 dynamodb client. A default one is created if this is not given.
     :return:
     """
     logger = logging.getLogger("iterate_source_records")
-    continuation = None
+    if client is None:
+        client = boto3.client("dynamodb")
+    scan_args = {"TableName": source_table_name}
     while True:
-        response = ddb.scan(
-            TableName=source_table_name,
-            ExclusiveStartKey=continuation
-        )
+        response = client.scan(**scan_args)
         logger.debug("page response is {}".format(response))
-        if response["LastEvaluatedKey"] is None:
-            break
 
         for entry in response["Items"]:
             yield entry
 
-        continuation = {"S":response["LastEvaluatedKey"]}
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
     logger.info("Finished iterating source records")
 
+
+class SegmentCheckpoint(object):
+    """
+    Records the LastEvaluatedKey that each segment of a parallel scan has reached, so that an interrupted scan can be
+    resumed.  The file is rewritten atomically every time a segment moves on.
+    """
+    def __init__(self, path:str, table_name:str, total_segments:int):
+        self.path = path
+        self.table_name = table_name
+        self.total_segments = total_segments
+        self._lock = threading.Lock()
+        self.segments = {}
+
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                content = json.load(f)
+            if content["table"]!=table_name or content["total_segments"]!=total_segments:
+                raise ValueError("Checkpoint {0} is for {1} in {2} segments, not {3} in {4} segments".format(
+                    path, content["table"], content["total_segments"], table_name, total_segments))
+            self.segments = {int(k): v for k, v in content["segments"].items()}
+
+    def start_key(self, segment:int):
+        return self.segments.get(segment, {}).get("last_key")
+
+    def is_done(self, segment:int) -> bool:
+        return self.segments.get(segment, {}).get("done", False)
+
+    def update(self, segment:int, last_key, done:bool):
+        with self._lock:
+            self.segments[segment] = {"last_key": last_key, "done": done}
+            if self.path:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"table": self.table_name, "total_segments": self.total_segments, "segments": self.segments}, f)
+                os.replace(tmp_path, self.path)
+
+
+class _SegmentFailed(object):
+    def __init__(self, segment:int, error:Exception):
+        self.segment = segment
+        self.error = error
+
+
+def parallel_scan(client, table_name:str, total_segments:int, workers:int=None, checkpoint:SegmentCheckpoint=None,
+                  queue_pages:int=None, page_limit:int=None, before_checkpoint=None):
+    """
+    a generator that yields every record from the table using a DynamoDB parallel scan.
+    Each segment is scanned by a worker thread, which puts its pages onto a bounded queue; when the consumer falls
+    behind the workers block, so memory use is limited to `queue_pages` pages.
+    A segment's position is checkpointed once all of the records from a page have been yielded, so a resumed scan
+    delivers each record at least once.
+    :param client: boto3 dynamodb client
+    :param table_name: table to scan
+    :param total_segments: number of segments to split the table into
+    :param workers: number of segments to scan at once. Defaults to total_segments.
+    :param checkpoint: optional SegmentCheckpoint to resume from and update
+    :param queue_pages: maximum number of pages buffered between the workers and the consumer. Defaults to 2*workers.
+    :param page_limit: optional Limit for each scan request
+    :param before_checkpoint: optional callable that is run before each checkpoint update, e.g. to make sure that the
+    records yielded so far have been written
+    """
+    logger = logging.getLogger("parallel_scan")
+    workers = workers if workers else total_segments
+    pages = queue.Queue(maxsize=queue_pages if queue_pages else 2*workers)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan_segment(segment:int):
+        try:
+            scan_args = {"TableName": table_name, "Segment": segment, "TotalSegments": total_segments}
+            if page_limit:
+                scan_args["Limit"] = page_limit
+            if checkpoint and checkpoint.start_key(segment):
+                scan_args["ExclusiveStartKey"] = checkpoint.start_key(segment)
+            while not stop.is_set():
+                response = client.scan(**scan_args)
+                last_key = response.get("LastEvaluatedKey")
+                if not put((segment, response["Items"], last_key)):
+                    return
+                if last_key is None:
+                    break
+                scan_args["ExclusiveStartKey"] = last_key
+        except Exception as e:
+            put(_SegmentFailed(segment, e))
+        finally:
+            put(finished)
+
+    segments = [s for s in range(total_segments) if not (checkpoint and checkpoint.is_done(s))]
+    if len(segments)<total_segments:
+        logger.info("{0} of {1} segments were already completed".format(total_segments - len(segments), total_segments))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for segment in segments:
+            executor.submit(scan_segment, segment)
+
+        remaining = len(segments)
+        while remaining>0:
+            item = pages.get()
+            if item is finished:
+                remaining -= 1
+                continue
+            if isinstance(item, _SegmentFailed):
+                raise item.error
+
+            segment, items, last_key = item
+            for entry in items:
+                yield entry
+            if checkpoint:
+                if before_checkpoint:
+                    before_checkpoint()
+                checkpoint.update(segment, last_key, last_key is None)
+        logger.info("Finished scanning {0}".format(table_name))
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def transform_record(record:dict) -> dict:
+    """
+    converts a record from the source table into the form it should have in the destination table
+    """
+    return record
+
+
 ###START MAIN
+if __name__=="__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--source", dest="source_table", required=True, help="table to migrate records from")
+    parser.add_argument("--dest", dest="dest_table", help="table to migrate records to. If not given then the source is only scanned.")
+    parser.add_argument("--flushers", dest="flushers", type=int, default=4, help="number of batch writes to have in flight at once")
+    parser.add_argument("--segments", dest="segments", type=int, default=8, help="number of segments for the parallel scan. 1 does a serial scan.")
+    parser.add_argument("--workers", dest="workers", type=int, help="number of segments to scan at once. Defaults to --segments")
+    parser.add_argument("--checkpoint", dest="checkpoint", help="file to record scan progress in, so that an interrupted migration can be resumed")
+    parser.add_argument("--region", dest="region", help="AWS region")
+    if instrumentation:
+        instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("main")
+    ddb = boto3.client("dynamodb", region_name=args.region)
+    if instrumentation and instrumentation.from_args(args):
+        instrumentation.instrument_boto3(ddb)
+
+    buffer = OperationBuffer(ddb, args.dest_table, args.flushers) if args.dest_table else None
+    if args.segments>1 or args.checkpoint:
+        checkpoint = SegmentCheckpoint(args.checkpoint, args.source_table, args.segments)
+        # don't record a segment's progress until the records from it have actually been written
+        records = parallel_scan(ddb, args.source_table, args.segments, args.workers, checkpoint,
+                                before_checkpoint=buffer.drain if buffer else None)
+    else:
+        records = iterate_source_records(args.source_table, ddb)
+
+    count = 0
+    start_time = monotonic()
+    try:
+        for record in records:
+            if buffer:
+                buffer.put(transform_record(record))
+            count += 1
+            if count%10000==0:
+                logger.info("Scanned {0} records, {1:.0f}/s".format(count, count/(monotonic()-start_time)))
+                if buffer:
+                    logger.info(buffer.report())
+    finally:
+        if buffer:
+            buffer.close()
+            logger.info(buffer.report())
+    logger.info("Scanned {0} records from {1}".format(count, args.source_table))
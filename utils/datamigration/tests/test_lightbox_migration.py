@@ -0,0 +1,191 @@
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import lightbox_migration
+
+RECORD_COUNT = 500
+
+
+@pytest.fixture
+def ddb(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    with moto.mock_aws():
+        client = boto3.client("dynamodb", region_name="eu-west-1")
+        client.create_table(TableName="lightbox",
+                            KeySchema=[{"AttributeName": "userEmail", "KeyType": "HASH"}, {"AttributeName": "fileId", "KeyType": "RANGE"}],
+                            AttributeDefinitions=[{"AttributeName": "userEmail", "AttributeType": "S"}, {"AttributeName": "fileId", "AttributeType": "S"}],
+                            BillingMode="PAY_PER_REQUEST")
+        for i in range(RECORD_COUNT):
+            client.put_item(TableName="lightbox", Item={"userEmail": {"S": "user{0}@example.com".format(i % 7)},
+                                                        "fileId": {"S": "file-{0}".format(i)},
+                                                        "restoreStatus": {"S": "RS_SUCCESS"}})
+        yield client
+
+
+def file_ids(records):
+    return sorted(r["fileId"]["S"] for r in records)
+
+
+ALL_IDS = sorted("file-{0}".format(i) for i in range(RECORD_COUNT))
+
+
+def test_iterate_source_records(ddb):
+    assert file_ids(lightbox_migration.iterate_source_records("lightbox", ddb)) == ALL_IDS
+
+
+@pytest.mark.parametrize("segments,workers", [(1, 1), (4, 4), (8, 3)])
+def test_parallel_scan(ddb, segments, workers):
+    records = list(lightbox_migration.parallel_scan(ddb, "lightbox", segments, workers, queue_pages=2, page_limit=25))
+    assert file_ids(records) == ALL_IDS
+
+
+def test_parallel_scan_resumes_from_checkpoint(ddb, tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = lightbox_migration.SegmentCheckpoint(path, "lightbox", 4)
+    scan = lightbox_migration.parallel_scan(ddb, "lightbox", 4, checkpoint=checkpoint, page_limit=20)
+    first_run = [next(scan) for _ in range(230)]
+    scan.close()
+
+    checkpoint = lightbox_migration.SegmentCheckpoint(path, "lightbox", 4)
+    second_run = list(lightbox_migration.parallel_scan(ddb, "lightbox", 4, checkpoint=checkpoint, page_limit=20))
+
+    assert len(second_run) < RECORD_COUNT
+    assert sorted(set(file_ids(first_run + second_run))) == ALL_IDS
+    assert all(checkpoint.is_done(s) for s in range(4))
+
+
+def test_checkpoint_mismatch(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    lightbox_migration.SegmentCheckpoint(path, "lightbox", 4).update(0, None, True)
+    with pytest.raises(ValueError):
+        lightbox_migration.SegmentCheckpoint(path, "lightbox", 8)
+
+
+def test_parallel_scan_raises_segment_errors():
+    class BrokenClient(object):
+        def scan(self, **kwargs):
+            raise RuntimeError("no table")
+
+    with pytest.raises(RuntimeError):
+        list(lightbox_migration.parallel_scan(BrokenClient(), "lightbox", 2))
+
+
+def test_operation_buffer_copies_table(ddb):
+    ddb.create_table(TableName="lightbox-copy",
+                     KeySchema=[{"AttributeName": "userEmail", "KeyType": "HASH"}, {"AttributeName": "fileId", "KeyType": "RANGE"}],
+                     AttributeDefinitions=[{"AttributeName": "userEmail", "AttributeType": "S"}, {"AttributeName": "fileId", "AttributeType": "S"}],
+                     BillingMode="PAY_PER_REQUEST")
+    with lightbox_migration.OperationBuffer(ddb, "lightbox-copy", flushers=3) as buffer:
+        for record in lightbox_migration.parallel_scan(ddb, "lightbox", 4):
+            buffer.put(lightbox_migration.transform_record(record))
+
+    assert buffer.items_written == RECORD_COUNT
+    assert file_ids(lightbox_migration.iterate_source_records("lightbox-copy", ddb)) == ALL_IDS
+
+
+class ThrottlingClient(object):
+    """
+    returns half of every batch as unprocessed the first time it is seen, and throttles every third call
+    """
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.written = []
+        self.batch_sizes = []
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+        from botocore.exceptions import ClientError
+        batch = RequestItems["table"]
+        with self.lock:
+            self.calls += 1
+            self.batch_sizes.append(len(batch))
+            if self.calls % 3 == 0:
+                raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "slow down"}}, "BatchWriteItem")
+            retried = [r for r in batch if r["PutRequest"]["Item"].get("retry")]
+            fresh = [r for r in batch if not r["PutRequest"]["Item"].get("retry")]
+            for r in fresh[len(fresh)//2:]:
+                r["PutRequest"]["Item"]["retry"] = True
+            unprocessed = fresh[len(fresh)//2:]
+            processed = retried + fresh[:len(fresh)//2]
+            self.written.extend(r["PutRequest"]["Item"]["n"] for r in processed)
+        return {"UnprocessedItems": {"table": unprocessed} if unprocessed else {},
+                "ConsumedCapacity": [{"TableName": "table", "CapacityUnits": float(len(processed))}]}
+
+
+def test_operation_buffer_retries_unprocessed(monkeypatch):
+    monkeypatch.setattr(lightbox_migration, "sleep", lambda s: None)
+    client = ThrottlingClient()
+    buffer = lightbox_migration.OperationBuffer(client, "table", flushers=2)
+    for n in range(260):
+        buffer.put({"n": n})
+    buffer.close()
+
+    assert sorted(client.written) == list(range(260))
+    assert buffer.items_written == 260
+    assert buffer.consumed_capacity == 260.0
+    assert buffer.throttle_events > 0
+    assert buffer.limiter.rate is not None
+    assert max(client.batch_sizes) <= 25
+
+
+def test_operation_buffer_gives_up(monkeypatch):
+    monkeypatch.setattr(lightbox_migration, "sleep", lambda s: None)
+
+    class AlwaysUnprocessed(object):
+        def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+            return {"UnprocessedItems": RequestItems}
+
+    buffer = lightbox_migration.OperationBuffer(AlwaysUnprocessed(), "table", flushers=1, max_retries=3)
+    buffer.put({"n": 1})
+    with pytest.raises(RuntimeError):
+        buffer.close()
+
+
+def test_checkpoint_waits_for_writes(ddb, tmp_path):
+    class SlowClient(object):
+        def __init__(self):
+            self.written = set()
+
+        def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+            import time
+            time.sleep(0.01)
+            self.written.update(r["PutRequest"]["Item"]["fileId"]["S"] for r in RequestItems["dest"])
+            return {}
+
+    writer = SlowClient()
+    buffer = lightbox_migration.OperationBuffer(writer, "dest", flushers=2)
+    checkpoint = lightbox_migration.SegmentCheckpoint(str(tmp_path / "checkpoint.json"), "lightbox", 2)
+    seen = []
+
+    def check_written():
+        buffer.drain()
+        assert set(seen) <= writer.written
+
+    for record in lightbox_migration.parallel_scan(ddb, "lightbox", 2, checkpoint=checkpoint, page_limit=30, before_checkpoint=check_written):
+        seen.append(record["fileId"]["S"])
+        buffer.put(record)
+    buffer.close()
+    assert writer.written == set(ALL_IDS)
+
+
+def test_checkpoint_does_not_pass_failed_writes(ddb, tmp_path):
+    from botocore.exceptions import ClientError
+
+    class RejectingClient(object):
+        def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "bad item"}}, "BatchWriteItem")
+
+    buffer = lightbox_migration.OperationBuffer(RejectingClient(), "dest", flushers=1)
+    checkpoint = lightbox_migration.SegmentCheckpoint(str(tmp_path / "checkpoint.json"), "lightbox", 2)
+    with pytest.raises(ClientError):
+        for record in lightbox_migration.parallel_scan(ddb, "lightbox", 2, checkpoint=checkpoint, page_limit=30, before_checkpoint=buffer.drain):
+            buffer.put(record)
+
+    # a resumed run starts both segments from the beginning again
+    resumed = lightbox_migration.SegmentCheckpoint(str(tmp_path / "checkpoint.json"), "lightbox", 2)
+    for segment in range(2):
+        assert resumed.start_key(segment) is None
+        assert not resumed.is_done(segment)